@@ -0,0 +1,652 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO,
+    stream=sys.stdout
+)
+
+logger = logging.getLogger(__name__)
+
+BENCH_TOKEN = '123456:BENCHMARK'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+
+# Пакетный запрос CommentBatcher: на него фейковый OpenAI отвечает JSON-массивом
+_BATCH_RE = re.compile(r'Ответь отдельно на каждый из (\d+)')
+
+# Типовые комментарии для доли повторов (кэш ответов и фильтр дублей)
+TYPICAL_COMMENTS = (
+    'Спасибо за пост!', 'Где можно купить?', 'Сколько стоит доставка?', 'Когда следующий выпуск?',
+    'Очень полезно, спасибо', 'А есть ссылка на источник?'
+)
+
+# Пороги сравнения с базовым прогоном: абсолютный запас не даёт шуму долей миллисекунды стать регрессией
+LATENCY_SLACK_MS = 1.0
+
+
+# ---- Фейковые Bot API и OpenAI ----
+
+async def _read_request(reader: asyncio.StreamReader):
+    """Разбор запроса HTTP/1.1: (метод, путь, заголовки, тело) или None, если соединение закрыто"""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    body = await reader.readexactly(length) if length else b''
+    return method, path, headers, body
+
+
+def _json_response(status: int, payload: Any) -> bytes:
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    return (
+        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+    ).encode('latin-1') + body
+
+
+def _write_chunk(writer: asyncio.StreamWriter, data: bytes):
+    writer.write(f"{len(data):x}\r\n".encode('latin-1') + data + b'\r\n')
+
+
+class FakeService:
+    """
+    Фейковый HTTP-сервис с keep-alive: задержка ответа (медиана latency_ms, хвост задаёт jitter
+    логнормального распределения), доля ошибок error_rate и счётчики вызовов по методам
+    """
+
+    def __init__(self, latency_ms: float = 0.0, jitter: float = 0.5, error_rate: float = 0.0, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def delay(self) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        return self.latency_ms / 1000 * self.random.lognormvariate(0, self.jitter)
+
+    def failed(self) -> bool:
+        return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                await self.respond(writer, *request)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, method: str, path: str, headers: Dict[str, str], body: bytes):
+        raise NotImplementedError
+
+    def report(self) -> Dict[str, Dict[str, int]]:
+        return {'calls': dict(self.calls), 'errors': dict(self.errors)}
+
+
+class FakeBotAPI(FakeService):
+    """Bot API: getMe, sendMessage и editMessageText возвращают правдоподобные объекты, ошибки - 429 с retry_after"""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._message_ids = itertools.count(1000000)
+
+    async def respond(self, writer, method, path, headers, body):
+        api_method = path.split('?')[0].rsplit('/', 1)[-1]
+        params = self._params(headers, body)
+        self.calls[api_method] += 1
+        await asyncio.sleep(self.delay())
+        if api_method != 'getMe' and self.failed():
+            self.errors[api_method] += 1
+            writer.write(_json_response(429, {
+                'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1}
+            }))
+            return
+        writer.write(_json_response(200, {'ok': True, 'result': self._result(api_method, params)}))
+
+    @staticmethod
+    def _params(headers: Dict[str, str], body: bytes) -> Dict[str, Any]:
+        if not body:
+            return {}
+        if headers.get('content-type', '').startswith('application/json'):
+            return json.loads(body)
+        return dict(parse_qsl(body.decode('utf-8')))
+
+    def _result(self, api_method: str, params: Dict[str, Any]):
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            message_id = int(params['message_id']) if 'message_id' in params else next(self._message_ids)
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+                'from': BOT_USER,
+                'text': params.get('text', '')
+            }
+        return True
+
+
+class FakeOpenAI(FakeService):
+    """Chat Completions: обычный ответ с usage, потоковый (SSE) и JSON-массив для пакетных запросов"""
+
+    def __init__(self, reply_words: int = 30, token_interval_ms: float = 0.0, **options):
+        super().__init__(**options)
+        self.reply_words = reply_words
+        self.token_interval_ms = token_interval_ms
+
+    async def respond(self, writer, method, path, headers, body):
+        self.calls['chat.completions'] += 1
+        request = json.loads(body or b'{}')
+        await asyncio.sleep(self.delay())
+        if self.failed():
+            self.errors['chat.completions'] += 1
+            writer.write(_json_response(500, {'error': {'message': 'Fake server error', 'type': 'server_error'}}))
+            return
+        content = self._content(request)
+        prompt_tokens = sum(len(str(message.get('content', ''))) for message in request.get('messages', [])) // 4
+        completion_tokens = len(content) // 4
+        if request.get('stream'):
+            await self._stream(writer, request, content)
+            return
+        writer.write(_json_response(200, {
+            'id': 'chatcmpl-bench',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'gpt-3.5-turbo'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens
+            }
+        }))
+
+    def _content(self, request: Dict[str, Any]) -> str:
+        messages = request.get('messages') or [{}]
+        match = _BATCH_RE.search(str(messages[-1].get('content', '')))
+        reply = 'Спасибо за комментарий, ' + ' '.join(['ответ'] * max(self.reply_words - 3, 1))
+        if match:
+            return json.dumps([f"{reply} {i}" for i in range(1, int(match.group(1)) + 1)], ensure_ascii=False)
+        return reply
+
+    async def _stream(self, writer: asyncio.StreamWriter, request: Dict[str, Any], content: str):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n"
+        )
+        base = {'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                'model': request.get('model', 'gpt-3.5-turbo')}
+        words = content.split(' ')
+        for index, word in enumerate(words):
+            delta = {'content': word if index == 0 else ' ' + word}
+            chunk = dict(base, choices=[{'index': 0, 'delta': delta, 'finish_reason': None}])
+            _write_chunk(writer, f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            await writer.drain()
+            if self.token_interval_ms > 0:
+                await asyncio.sleep(self.token_interval_ms / 1000)
+        chunk = dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+        _write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        _write_chunk(writer, b"data: [DONE]\n\n")
+        writer.write(b"0\r\n\r\n")
+
+
+def run_fake_services(options: Dict[str, Any], conn):
+    """
+    Отдельный процесс с фейковыми сервисами, чтобы они не делили цикл событий и процессор с ботом:
+    в conn отправляются порты, по сообщению stop - счётчики вызовов
+    """
+    asyncio.run(_serve_fake_services(options, conn))
+
+
+async def _serve_fake_services(options: Dict[str, Any], conn):
+    bot_api = FakeBotAPI(latency_ms=options['bot_latency_ms'], jitter=options['jitter'],
+                         error_rate=options['bot_error_rate'], seed=options['seed'])
+    openai_api = FakeOpenAI(latency_ms=options['openai_latency_ms'], jitter=options['jitter'],
+                            error_rate=options['openai_error_rate'], seed=options['seed'] + 1,
+                            reply_words=options['reply_words'], token_interval_ms=options['token_interval_ms'])
+    servers = [
+        await asyncio.start_server(service.handle, '127.0.0.1', 0, backlog=1024)
+        for service in (bot_api, openai_api)
+    ]
+    conn.send([server.sockets[0].getsockname()[1] for server in servers])
+    await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+    conn.send({'bot_api': bot_api.report(), 'openai': openai_api.report()})
+    for server in servers:
+        server.close()
+
+
+# ---- Синтетические обновления ----
+
+class UpdateFactory:
+    """Обновления Telegram в формате Bot API (dict), как их присылает getUpdates или вебхук"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _update(self, **payload) -> Dict[str, Any]:
+        return dict(update_id=next(self._update_ids), **payload)
+
+    def _message(self, chat: Dict[str, Any], sender: Optional[Dict[str, Any]], text: str, **fields) -> Dict[str, Any]:
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': chat, 'text': text}
+        if sender is not None:
+            message['from'] = sender
+        message.update(fields)
+        return message
+
+    @staticmethod
+    def _private_chat(user: Dict[str, Any]) -> Dict[str, Any]:
+        return {'id': user['id'], 'type': 'private', 'first_name': user['first_name']}
+
+    def command(self, user: Dict[str, Any], command: str) -> Dict[str, Any]:
+        return self._update(message=self._message(
+            self._private_chat(user), user, command,
+            entities=[{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}]
+        ))
+
+    def text(self, user: Dict[str, Any], text: str) -> Dict[str, Any]:
+        return self._update(message=self._message(self._private_chat(user), user, text))
+
+    def forward(self, user: Dict[str, Any], channel: Dict[str, Any]) -> Dict[str, Any]:
+        """Пересланный пост канала (шаг мастера подключения)"""
+        return self._update(message=self._message(
+            self._private_chat(user), user, 'Пост канала',
+            forward_origin={'type': 'channel', 'chat': channel, 'message_id': 1, 'date': int(time.time())},
+            forward_from_chat=channel
+        ))
+
+    def callback(self, user: Dict[str, Any], data: str) -> Dict[str, Any]:
+        return self._update(callback_query={
+            'id': str(next(self._message_ids)),
+            'from': user,
+            'chat_instance': str(user['id']),
+            'data': data,
+            'message': self._message(self._private_chat(user), BOT_USER, 'Меню')
+        })
+
+    def comment(self, channel: Dict[str, Any], author: Dict[str, Any], text: str) -> Dict[str, Any]:
+        """Комментарий в чате обсуждения канала"""
+        chat = {'id': channel['id'], 'type': 'group', 'title': channel['title']}
+        return self._update(message=self._message(chat, author, text))
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+
+def _channel(index: int, prefix: str) -> Dict[str, Any]:
+    return {'id': -1000000000000 - index, 'type': 'channel', 'title': f'{prefix} {index}', 'username': f'{prefix}_{index}'}
+
+
+def wizard_updates(factory: UpdateFactory, user: Dict[str, Any], channel: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Мастер подключения канала от /start до экрана статистики"""
+    return [
+        factory.command(user, '/start'),
+        factory.callback(user, 'add_channel'),
+        factory.text(user, f"@{channel['username']}"),
+        factory.forward(user, channel),
+        factory.text(user, 'Отвечай кратко и дружелюбно'),
+        factory.callback(user, 'ready'),
+        factory.callback(user, 'my_channels'),
+        factory.callback(user, f"channel_{channel['id']}"),
+        factory.callback(user, 'assistant_settings'),
+        factory.callback(user, 'stats'),
+        factory.callback(user, 'back'),
+    ]
+
+
+def storm_updates(factory: UpdateFactory, channel: Dict[str, Any], comments: int, authors: List[Dict[str, Any]],
+                  duplicate_ratio: float, rng: random.Random) -> List[Dict[str, Any]]:
+    """Всплеск комментариев в канале: доля duplicate_ratio - типовые комментарии, остальные уникальные"""
+    updates = []
+    for index in range(comments):
+        if rng.random() < duplicate_ratio:
+            text = rng.choice(TYPICAL_COMMENTS)
+        else:
+            text = f"Интересно, а как это связано с темой номер {rng.randrange(1000000)}? Вопрос {index}"
+        updates.append(factory.comment(channel, rng.choice(authors), text))
+    return updates
+
+
+def interleave(streams: List[List[Dict[str, Any]]], rng: random.Random) -> List[Dict[str, Any]]:
+    """Случайное перемешивание потоков с сохранением порядка внутри каждого (шаги одного пользователя)"""
+    order = [index for index, stream in enumerate(streams) for _ in stream]
+    rng.shuffle(order)
+    iterators = [iter(stream) for stream in streams]
+    return [next(iterators[index]) for index in order]
+
+
+# ---- Прогон ----
+
+def percentile(values: List[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def _latency_summary(values: List[float]) -> Dict[str, float]:
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(max(values) * 1000, 3) if values else 0.0
+    }
+
+
+def _process_write_bytes() -> Optional[int]:
+    """Байты, записанные процессом на диск (Linux, /proc/self/io)"""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split(':')[1])
+    except OSError:
+        return None
+    return None
+
+
+def _configure_environment(args, workdir: str, openai_port: int):
+    """Настройки echo_bot до его импорта: база во временном каталоге, OpenAI - фейковый сервер"""
+    os.environ['DATABASE_BACKEND'] = args.backend
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'database.sqlite3' if args.backend == 'sqlite' else 'database.json')
+    os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{openai_port}/v1'
+    os.environ['METRICS_PORT'] = '0'
+    # Индекс постов - тоже во временном каталоге, а не в рабочем каталоге бота
+    os.environ['POST_INDEX_DIR'] = os.path.join(workdir, 'post_index')
+    # Снимки пишут на диск и смешались бы с записью хранилища
+    for name in ('STATE_SNAPSHOT_PATH', 'CONTEXT_SNAPSHOT_PATH', 'RESPONSE_CACHE_PATH',
+                 'DEDUP_SNAPSHOT_PATH'):
+        os.environ[name] = ''
+    # Лимиты OpenAI по умолчанию рассчитаны на один ключ; переменные окружения имеют приоритет
+    os.environ.setdefault('LLM_REQUESTS_PER_MINUTE', '1000000')
+    os.environ.setdefault('LLM_TOKENS_PER_MINUTE', '1000000000')
+    os.environ.setdefault('LLM_MAX_CONCURRENCY', '64')
+
+
+async def run_benchmark(args, bot_api_port: int) -> Dict[str, Any]:
+    """Прогон нагрузки через настоящие обработчики echo_bot"""
+    from telegram import Update
+    from telegram.ext import Application
+
+    import echo_bot
+    from update_processor import OrderedUpdateProcessor
+
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+    rng = random.Random(args.seed)
+    factory = UpdateFactory()
+    db = echo_bot.db
+
+    # Каналы для комментариев заводятся напрямую: ключ OpenAI в интерфейсе бота не задаётся
+    storm_channels = [_channel(index, 'storm') for index in range(args.channels)]
+    for index, channel in enumerate(storm_channels):
+        owner_id = 900000000 + index
+        db.add_user(owner_id, f'owner{index}', f'Owner{index}')
+        db.add_channel(channel['id'], channel['title'], owner_id, channel['username'])
+        db.set_user_openai_key(owner_id, f'sk-bench-{index}')
+        if args.stream:
+            settings = db.get_channel(channel['id'])['settings']
+            settings['assistant_settings']['stream_replies'] = True
+            db.update_channel_settings(channel['id'], settings)
+    db.flush()
+
+    authors = [_user(100000000 + index) for index in range(args.authors)]
+    streams = [wizard_updates(factory, _user(1000 + index), _channel(args.channels + index, 'wizard'))
+               for index in range(args.users)]
+    streams += [storm_updates(factory, channel, args.comments, authors, args.duplicate_ratio, rng)
+                for channel in storm_channels]
+    payloads = interleave(streams, rng)
+
+    application = (
+        Application.builder()
+        .token(BENCH_TOKEN)
+        .base_url(f'http://127.0.0.1:{bot_api_port}/bot')
+        .concurrent_updates(OrderedUpdateProcessor(args.concurrency) if args.concurrency > 1 else False)
+        .updater(None)
+        .build()
+    )
+    echo_bot.register_handlers(application)
+
+    # Время каждого обработчика и путь обновления от постановки в очередь до конца обработки
+    handler_latency: Dict[str, List[float]] = defaultdict(list)
+    handler_errors: Dict[str, int] = defaultdict(int)
+    end_to_end: List[float] = []
+    enqueued_at: Dict[int, float] = {}
+    finished = asyncio.Event()
+    remaining = [len(payloads)]
+
+    def timed(callback):
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                handler_errors[callback.__name__] += 1
+                raise
+            finally:
+                now = time.perf_counter()
+                handler_latency[callback.__name__].append(now - started)
+                end_to_end.append(now - enqueued_at.pop(update.update_id, now))
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    finished.set()
+        return wrapper
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = timed(handler.callback)
+
+    async def on_error(update, context):
+        # Ошибки уже учтены в wrapper, стандартный вывод трейсбеков на каждое обновление не нужен
+        logger.debug(f"Ошибка обработчика: {context.error}")
+
+    application.add_error_handler(on_error)
+
+    write_bytes_before = _process_write_bytes()
+    await application.initialize()
+    await application.start()
+    started = time.perf_counter()
+    interval = 1 / args.rate if args.rate > 0 else 0
+    for index, payload in enumerate(payloads):
+        if interval:
+            delay = started + index * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        update = Update.de_json(payload, application.bot)
+        enqueued_at[update.update_id] = time.perf_counter()
+        await application.update_queue.put(update)
+    try:
+        await asyncio.wait_for(finished.wait(), timeout=args.drain_timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Не дождались обработки {remaining[0]} обновлений за {args.drain_timeout} с")
+    duration = time.perf_counter() - started
+
+    await application.stop()
+    await application.shutdown()
+    await echo_bot.post_shutdown(application)
+    echo_bot.stats_aggregator.close()
+    db.close()
+    write_bytes_after = _process_write_bytes()
+
+    processed = len(payloads) - remaining[0]
+    return {
+        'scenario': {
+            'backend': args.backend, 'users': args.users, 'channels': args.channels, 'comments': args.comments,
+            'concurrency': args.concurrency, 'rate': args.rate, 'stream': args.stream,
+            'duplicate_ratio': args.duplicate_ratio, 'openai_latency_ms': args.openai_latency_ms,
+            'bot_latency_ms': args.bot_latency_ms
+        },
+        'updates': len(payloads),
+        'processed': processed,
+        'duration_s': round(duration, 3),
+        'updates_per_s': round(processed / duration, 2) if duration else 0.0,
+        'handlers': {
+            name: dict(_latency_summary(values), errors=handler_errors.get(name, 0))
+            for name, values in sorted(handler_latency.items())
+        },
+        'end_to_end': _latency_summary(end_to_end),
+        'db_bytes_written': (write_bytes_after - write_bytes_before)
+        if write_bytes_before is not None and write_bytes_after is not None else None,
+        'db_size_bytes': sum(
+            os.path.getsize(os.path.join(args.workdir, name)) for name in os.listdir(args.workdir)
+        ),
+        'triage': echo_bot.comment_triage.report(),
+        'llm_scheduler': echo_bot.llm_scheduler.stats()
+    }
+
+
+def compare_with_baseline(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Регрессии относительно базового прогона: пропускная способность, хвосты задержек, запись на диск"""
+    regressions = []
+    if result['scenario'] != baseline.get('scenario'):
+        regressions.append("сценарий отличается от базового прогона, сравнение некорректно")
+        return regressions
+    if result['updates_per_s'] < baseline['updates_per_s'] * (1 - tolerance):
+        regressions.append(f"обновлений в секунду: {result['updates_per_s']} (было {baseline['updates_per_s']})")
+    for name, current in result['handlers'].items():
+        previous = baseline['handlers'].get(name)
+        if previous is None:
+            continue
+        for key in ('p95_ms', 'p99_ms'):
+            if current[key] > previous[key] * (1 + tolerance) + LATENCY_SLACK_MS:
+                regressions.append(f"{name} {key}: {current[key]} (было {previous[key]})")
+    if result['db_bytes_written'] is not None and baseline.get('db_bytes_written') and \
+            result['db_bytes_written'] > baseline['db_bytes_written'] * (1 + tolerance):
+        regressions.append(f"записано на диск: {result['db_bytes_written']} байт (было {baseline['db_bytes_written']})")
+    return regressions
+
+
+def format_report(result: Dict[str, Any]) -> str:
+    lines = [
+        f"Хранилище: {result['scenario']['backend']}, обновлений: {result['processed']}/{result['updates']} "
+        f"за {result['duration_s']} с ({result['updates_per_s']}/с)",
+        f"{'обработчик':<28}{'вызовов':>9}{'ошибок':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}"
+    ]
+    rows = list(result['handlers'].items()) + [('от очереди до ответа', dict(result['end_to_end'], errors=''))]
+    for name, row in rows:
+        lines.append(f"{name:<28}{row['count']:>9}{row['errors']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    written = result['db_bytes_written']
+    lines.append(f"Записано на диск: {'нет данных' if written is None else f'{written} байт'}, "
+                 f"размер файлов базы: {result['db_size_bytes']} байт")
+    lines.append(f"Bot API: {result['fake_services']['bot_api']['calls']}, "
+                 f"ошибки {result['fake_services']['bot_api']['errors']}")
+    lines.append(f"OpenAI: {result['fake_services']['openai']['calls']}, "
+                 f"ошибки {result['fake_services']['openai']['errors']}")
+    lines.append(f"Фильтр комментариев: {result['triage']}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Нагрузочный прогон обработчиков бота с фейковыми Bot API и OpenAI'
+    )
+    parser.add_argument('--backend', choices=('json', 'journal', 'sqlite'), default=os.getenv('DATABASE_BACKEND', 'json'))
+    parser.add_argument('--users', type=int, default=100, help='пользователей, проходящих мастер подключения канала')
+    parser.add_argument('--channels', type=int, default=20, help='каналов со всплеском комментариев')
+    parser.add_argument('--comments', type=int, default=50, help='комментариев на канал')
+    parser.add_argument('--authors', type=int, default=1000, help='разных авторов комментариев')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2, help='доля типовых (повторяющихся) комментариев')
+    parser.add_argument('--stream', action='store_true', help='потоковые ответы в каналах')
+    parser.add_argument('--concurrency', type=int, default=int(os.getenv('BOT_CONCURRENT_UPDATES', '32')),
+                        help='параллельных обновлений (как BOT_CONCURRENT_UPDATES)')
+    parser.add_argument('--rate', type=float, default=0, help='обновлений в секунду (0 - все сразу)')
+    parser.add_argument('--openai-latency-ms', type=float, default=300, help='медиана задержки фейкового OpenAI')
+    parser.add_argument('--openai-error-rate', type=float, default=0.01)
+    parser.add_argument('--token-interval-ms', type=float, default=10, help='пауза между фрагментами потокового ответа')
+    parser.add_argument('--reply-words', type=int, default=30)
+    parser.add_argument('--bot-latency-ms', type=float, default=20, help='медиана задержки фейкового Bot API')
+    parser.add_argument('--bot-error-rate', type=float, default=0.0, help='доля ответов 429 от Bot API')
+    parser.add_argument('--jitter', type=float, default=0.5, help='разброс задержек (sigma логнормального распределения)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--drain-timeout', type=float, default=300, help='сколько ждать обработки всех обновлений, с')
+    parser.add_argument('--workdir', help='каталог для файлов базы (по умолчанию временный)')
+    parser.add_argument('--output', help='сохранить результат в JSON')
+    parser.add_argument('--baseline', help='JSON базового прогона для сравнения')
+    parser.add_argument('--save-baseline', action='store_true', help='записать результат в --baseline')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='допустимое ухудшение относительно базового прогона')
+    parser.add_argument('--log-level', default='WARNING', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'))
+    args = parser.parse_args()
+
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='agentzero-bench-')
+    os.makedirs(args.workdir, exist_ok=True)
+    if os.listdir(args.workdir):
+        raise SystemExit(f"Каталог {args.workdir} не пуст: прогон должен начинаться с пустой базы")
+
+    # Фейковые сервисы запускаются до импорта echo_bot, spawn - чтобы не наследовать его состояние
+    context = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = context.Pipe()
+    fake_options = {
+        'bot_latency_ms': args.bot_latency_ms, 'bot_error_rate': args.bot_error_rate,
+        'openai_latency_ms': args.openai_latency_ms, 'openai_error_rate': args.openai_error_rate,
+        'token_interval_ms': args.token_interval_ms, 'reply_words': args.reply_words,
+        'jitter': args.jitter, 'seed': args.seed
+    }
+    fake_services = context.Process(target=run_fake_services, args=(fake_options, child_conn), daemon=True)
+    fake_services.start()
+    try:
+        bot_api_port, openai_port = parent_conn.recv()
+        _configure_environment(args, args.workdir, openai_port)
+        result = asyncio.run(run_benchmark(args, bot_api_port))
+        parent_conn.send('stop')
+        result['fake_services'] = parent_conn.recv()
+    finally:
+        fake_services.join(timeout=5)
+        if fake_services.is_alive():
+            fake_services.terminate()
+
+    print(format_report(result))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Базовый прогон сохранён в {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(result, baseline, args.tolerance)
+        if regressions:
+            print("Регрессии относительно базового прогона:")
+            for regression in regressions:
+                print(f"- {regression}")
+            sys.exit(1)
+        print("Регрессий относительно базового прогона нет")
+
+
+if __name__ == '__main__':
+    main()
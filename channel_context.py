@@ -0,0 +1,77 @@
+import logging
+import os
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple
+
+import jsoncodec
+from fileutils import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelContextBuffer:
+    """
+    Последние сообщения чатов в памяти процесса: посты, комментарии и ответы бота
+    складываются сюда из уже полученных обновлений, поэтому контекст читается без запросов к API.
+
+    На чат хранится не больше max_messages сообщений (каждое обрезается до max_chars символов),
+    число отслеживаемых чатов ограничено max_chats - давно молчавшие чаты вытесняются (LRU).
+    """
+
+    def __init__(self, max_messages: int = 10, max_chars: int = 1000, max_chats: int = 10000,
+                 snapshot_path: str = None):
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self.max_chats = max_chats
+        self.snapshot_path = snapshot_path
+        # chat_id -> кольцевой буфер (роль, текст)
+        self._chats: 'OrderedDict[str, Deque[Tuple[str, str]]]' = OrderedDict()
+        if self.snapshot_path:
+            self.load_snapshot()
+
+    def record(self, chat_id, text: str, role: str = 'user'):
+        """Добавление сообщения в буфер чата"""
+        if not text:
+            return
+        chat_id = str(chat_id)
+        buffer = self._chats.get(chat_id)
+        if buffer is None:
+            buffer = self._chats[chat_id] = deque(maxlen=self.max_messages)
+            while len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        buffer.append((role, text[:self.max_chars]))
+
+    def get(self, chat_id, limit: int = None) -> List[Dict[str, str]]:
+        """Последние сообщения чата в хронологическом порядке в формате сообщений OpenAI"""
+        buffer = self._chats.get(str(chat_id))
+        if not buffer:
+            return []
+        items = list(buffer)
+        if limit is not None:
+            items = items[-limit:]
+        return [{"role": role, "content": text} for role, text in items]
+
+    def __len__(self):
+        return len(self._chats)
+
+    def load_snapshot(self):
+        """Прогрев буферов из снимка, сохранённого перед остановкой"""
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            chats = jsoncodec.load_file(self.snapshot_path)
+        except ValueError as e:
+            logger.error(f"Не удалось прочитать снимок контекста {self.snapshot_path}: {e}")
+            return
+        for chat_id, items in chats.items():
+            for role, text in items:
+                self.record(chat_id, text, role)
+
+    def save_snapshot(self):
+        """Сохранение буферов на диск"""
+        if not self.snapshot_path:
+            return
+        payload = jsoncodec.dumps({chat_id: list(buffer) for chat_id, buffer in self._chats.items()})
+        write_atomic(self.snapshot_path, payload)
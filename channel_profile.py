@@ -0,0 +1,191 @@
+import logging
+from collections import deque
+from datetime import datetime, time
+from typing import Any, Dict, List, Optional, Tuple
+
+from prompt_builder import DEFAULT_INPUT_TOKEN_BUDGET
+
+logger = logging.getLogger(__name__)
+
+# Интервал между редактированиями потокового ответа по умолчанию, секунды
+DEFAULT_STREAM_EDIT_INTERVAL = 1.5
+
+DEFAULT_SYSTEM_PROMPT = (
+    'Ты - дружелюбный ассистент, который отвечает на сообщения в Telegram канале. '
+    'Отвечай кратко и по существу. Используй контекст предыдущих сообщений для более релевантных ответов.'
+)
+
+
+def build_system_prompt(assistant_settings: Dict[str, Any]) -> str:
+    """Системный промпт с ограничениями по темам и словам"""
+    system_prompt = assistant_settings.get('system_prompt', DEFAULT_SYSTEM_PROMPT)
+
+    # Добавляем ограничения по темам и словам
+    allowed_topics = assistant_settings.get('allowed_topics', [])
+    forbidden_words = assistant_settings.get('forbidden_words', [])
+
+    if allowed_topics:
+        system_prompt += f"\nОтвечай только на темы: {', '.join(allowed_topics)}"
+    if forbidden_words:
+        system_prompt += f"\nНе используй слова: {', '.join(forbidden_words)}"
+    return system_prompt
+
+
+class WordMatcher:
+    """
+    Поиск любого слова из списка за один проход по тексту (автомат Ахо-Корасик):
+    время проверки линейно по длине текста и не зависит от числа слов.
+    Совпадением считается целое слово или фраза, без учёта регистра
+    """
+
+    __slots__ = ('_goto', '_fail', '_out', 'max_length')
+
+    def __init__(self, words):
+        # Бор: переходы, суффиксные ссылки и длины слов, заканчивающихся в узле
+        self._goto: List[Dict[str, int]] = [{}]
+        self._out: List[Tuple[int, ...]] = [()]
+        self.max_length = 0
+        for word in words:
+            self.max_length = max(self.max_length, len(word))
+            node = 0
+            for char in word:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = self._goto[node][char] = len(self._goto)
+                    self._goto.append({})
+                    self._out.append(())
+                node = next_node
+            self._out[node] += (len(word),)
+
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] += self._out[self._fail[child]]
+
+    def search(self, text: str, since: int = 0) -> Optional[str]:
+        """
+        Первое найденное слово или None. since - начало ещё не проверенной части дописываемого текста:
+        просматривается только она и перекрытие длиной в самое длинное слово перед ней
+        """
+        begin = max(0, since - self.max_length)
+        # Символ перед окном нужен только для проверки границы слова
+        context = 1 if begin else 0
+        text = text[begin - context:].casefold()
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length in out[node]:
+                start = end - length + 1
+                # Границы слова: до и после совпадения не должно быть букв и цифр
+                if (start == 0 and not context or start > 0 and not _is_word_char(text[start - 1])) and \
+                        (end + 1 == len(text) or not _is_word_char(text[end + 1])):
+                    return text[start:end + 1]
+        return None
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+
+def compile_word_matcher(words) -> Optional[WordMatcher]:
+    """Автомат поиска по всем словам списка; None, если список пуст"""
+    words = {word.strip().casefold() for word in words or () if word and word.strip()}
+    if not words:
+        return None
+    return WordMatcher(sorted(words))
+
+
+class ChannelProfile:
+    """
+    Скомпилированные настройки канала для горячего пути: окно активности уже разобрано,
+    системный промпт собран, параметры модели подставлены, списки слов скомпилированы.
+    Строится один раз и пересобирается только при изменении канала.
+    """
+
+    __slots__ = ('channel_id', 'owner_id', 'settings', 'auto_reply_enabled', 'active_start', 'active_end',
+                 'system_prompt', 'model', 'temperature', 'max_tokens', 'input_token_budget',
+                 'stream_replies', 'stream_edit_interval', 'triage_settings', 'forbidden_matcher', 'topic_matcher',
+                 'routing')
+
+    def __init__(self, channel: Dict[str, Any]):
+        settings = channel['settings']
+        assistant_settings = settings.get('assistant_settings', {})
+        self.channel_id = str(channel['id'])
+        self.owner_id = int(channel['owner_id'])
+        self.settings = settings
+        self.auto_reply_enabled = settings.get('auto_reply_enabled', True)
+        self.active_start, self.active_end = self._parse_active_hours(settings.get('restrictions', {}))
+        self.system_prompt = build_system_prompt(assistant_settings)
+        self.model = assistant_settings.get('model', 'gpt-3.5-turbo')
+        self.temperature = assistant_settings.get('temperature', 0.7)
+        self.max_tokens = assistant_settings.get('max_tokens', 150)
+        self.input_token_budget = assistant_settings.get('input_token_budget', DEFAULT_INPUT_TOKEN_BUDGET)
+        # Потоковый ответ с редактированием сообщения по мере генерации
+        self.stream_replies = assistant_settings.get('stream_replies', False)
+        self.stream_edit_interval = assistant_settings.get('stream_edit_interval_s', DEFAULT_STREAM_EDIT_INTERVAL)
+        # Пороги фильтра комментариев, переопределённые для канала
+        self.triage_settings = assistant_settings.get('triage') or {}
+        self.forbidden_matcher = compile_word_matcher(assistant_settings.get('forbidden_words'))
+        self.topic_matcher = compile_word_matcher(assistant_settings.get('allowed_topics'))
+        # Переопределения маршрутизации по уровням моделей для канала
+        self.routing = assistant_settings.get('routing') or {}
+
+    def _parse_active_hours(self, restrictions: Dict[str, Any]):
+        """Разбор окна активности 'HH:MM'-'HH:MM'; без ограничений - (None, None)"""
+        active_hours = restrictions.get('active_hours')
+        if not active_hours:
+            return None, None
+        try:
+            start = datetime.strptime(active_hours['start'], '%H:%M').time()
+            end = datetime.strptime(active_hours['end'], '%H:%M').time()
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Некорректное окно активности канала {self.channel_id}: {e}")
+            return None, None
+        return start, end
+
+    def is_active(self, now: time) -> bool:
+        """Попадает ли время в окно активности (окно может переходить через полночь)"""
+        if self.active_start is None:
+            return True
+        if self.active_start <= self.active_end:
+            return self.active_start <= now <= self.active_end
+        return now >= self.active_start or now <= self.active_end
+
+    def contains_forbidden(self, text: str, since: int = 0) -> bool:
+        """Есть ли в тексте запрещённые слова канала (since - см. WordMatcher.search)"""
+        return self.forbidden_matcher is not None and self.forbidden_matcher.search(text, since) is not None
+
+
+class ChannelProfileCache:
+    """Профили каналов по id; профиль пересобирается, только когда хранилище сообщает об изменении канала"""
+
+    def __init__(self, db):
+        self.db = db
+        self._profiles: Dict[str, ChannelProfile] = {}
+        db.add_channel_listener(self.invalidate)
+
+    def get(self, channel_id) -> Optional[ChannelProfile]:
+        """Профиль канала или None, если канала нет в базе"""
+        channel_id = str(channel_id)
+        profile = self._profiles.get(channel_id)
+        if profile is None:
+            channel = self.db.get_channel(channel_id)
+            if channel is None:
+                return None
+            profile = self._profiles[channel_id] = ChannelProfile(channel)
+        return profile
+
+    def invalidate(self, channel_id):
+        """Сброс профиля канала"""
+        self._profiles.pop(str(channel_id), None)
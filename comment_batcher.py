@@ -0,0 +1,76 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+BatchRunner = Callable[[List[str]], Awaitable[List[str]]]
+
+
+class _Batch:
+    __slots__ = ('comments', 'futures', 'runner', 'timer')
+
+    def __init__(self, runner: BatchRunner):
+        self.comments: List[str] = []
+        self.futures: List[asyncio.Future] = []
+        self.runner = runner
+        self.timer: Optional[asyncio.Task] = None
+
+
+class CommentBatcher:
+    """
+    Микро-пакетирование комментариев: комментарии одного чата, пришедшие в течение window_ms
+    (но не больше max_batch), отправляются в LLM одним запросом. Каждый отправитель получает
+    свой ответ и сам отвечает на своё сообщение.
+    """
+
+    def __init__(self, window_ms: int = 1500, max_batch: int = 8):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._batches: Dict[str, _Batch] = {}
+        self.stats = {'comments': 0, 'batches': 0}
+
+    async def submit(self, chat_id, comment: str, runner: BatchRunner) -> str:
+        """
+        Добавление комментария в пакет чата. runner(comments) -> replies выполняет запрос
+        для всего пакета; используется runner первого комментария пакета
+        """
+        chat_id = str(chat_id)
+        batch = self._batches.get(chat_id)
+        if batch is None:
+            batch = self._batches[chat_id] = _Batch(runner)
+            batch.timer = asyncio.get_running_loop().create_task(self._flush_later(chat_id, batch))
+        future = asyncio.get_running_loop().create_future()
+        batch.comments.append(comment)
+        batch.futures.append(future)
+        self.stats['comments'] += 1
+        if len(batch.comments) >= self.max_batch:
+            batch.timer.cancel()
+            self._start_flush(chat_id, batch)
+        return await future
+
+    async def _flush_later(self, chat_id: str, batch: _Batch):
+        await asyncio.sleep(self.window)
+        self._start_flush(chat_id, batch)
+
+    def _start_flush(self, chat_id: str, batch: _Batch):
+        # Новые комментарии этого чата пойдут уже в следующий пакет
+        if self._batches.get(chat_id) is batch:
+            del self._batches[chat_id]
+            asyncio.get_running_loop().create_task(self._run(batch))
+
+    async def _run(self, batch: _Batch):
+        self.stats['batches'] += 1
+        try:
+            replies = await batch.runner(batch.comments)
+            if len(replies) != len(batch.futures):
+                raise ValueError(f"ожидалось ответов: {len(batch.futures)}, получено: {len(replies)}")
+        except Exception as e:
+            logger.error(f"Ошибка при обработке пакета комментариев: {e}")
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, reply in zip(batch.futures, replies):
+            if not future.done():
+                future.set_result(reply)
@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from response_cache import normalize_message
+
+logger = logging.getLogger(__name__)
+
+# Правила в порядке проверки: сначала дешёвые и без состояния
+TRIAGE_RULES = ('bot_message', 'automatic_forward', 'no_text', 'too_short', 'too_long', 'no_words',
+                'symbols', 'link_only', 'forbidden_words', 'duplicate', 'cooldown')
+
+# Значения по умолчанию; канал переопределяет их в assistant_settings['triage']
+DEFAULT_TRIAGE_SETTINGS = {
+    'min_chars': 2,
+    'max_chars': 2000,
+    'min_letters': 2,
+    'max_symbol_ratio': 0.5,
+    'duplicate_window_s': 300,
+    'cooldown_s': 0,
+}
+
+_LINK_RE = re.compile(r'(?:https?://|www\.|t\.me/)\S+|@\w+', re.IGNORECASE)
+
+
+class CommentTriage:
+    """
+    Фильтр перед запросом к LLM: отсекает комментарии, на которые отвечать не нужно
+    (сообщения ботов, эмодзи и "+1", голые ссылки, запрещённые слова, повторы, флуд одного автора).
+
+    check() возвращает имя сработавшего правила или None; по каждому правилу ведётся счётчик
+    пропусков - это число сэкономленных запросов к OpenAI
+    """
+
+    def __init__(self, enabled_rules=TRIAGE_RULES, max_tracked: int = 100000, **defaults):
+        self.enabled_rules = frozenset(enabled_rules)
+        unknown = self.enabled_rules - set(TRIAGE_RULES)
+        if unknown:
+            raise ValueError(f"Неизвестные правила фильтра: {', '.join(sorted(unknown))}")
+        self.defaults = dict(DEFAULT_TRIAGE_SETTINGS, **defaults)
+        self.max_tracked = max_tracked
+        # (чат, хэш текста) -> время последнего появления
+        self._recent_texts: 'OrderedDict[tuple, float]' = OrderedDict()
+        # (чат, автор) -> время последнего пропущенного к LLM комментария
+        self._last_passed: 'OrderedDict[tuple, float]' = OrderedDict()
+        self.stats: Dict[str, int] = {'checked': 0, 'passed': 0, 'skipped': 0}
+        self.skipped_by_rule: Dict[str, int] = {rule: 0 for rule in TRIAGE_RULES}
+
+    def check(self, message, profile, now: float = None) -> Optional[str]:
+        """Правило, по которому комментарий пропускается, или None, если нужен ответ LLM"""
+        self.stats['checked'] += 1
+        reason = self._check(message, profile, time.monotonic() if now is None else now)
+        if reason is None:
+            self.stats['passed'] += 1
+        else:
+            self.stats['skipped'] += 1
+            self.skipped_by_rule[reason] += 1
+            logger.debug(f"Комментарий в чате {message.chat_id} пропущен: {reason}")
+        return reason
+
+    def _check(self, message, profile, now: float) -> Optional[str]:
+        rules = self.enabled_rules
+        settings = self.defaults
+        if profile.triage_settings:
+            settings = dict(settings, **profile.triage_settings)
+
+        sender = message.from_user
+        if 'bot_message' in rules and sender is not None and sender.is_bot:
+            return 'bot_message'
+        # Пост канала, автоматически пересланный в группу обсуждения, - это контекст, а не вопрос
+        if 'automatic_forward' in rules and message.is_automatic_forward:
+            return 'automatic_forward'
+
+        text = message.text
+        if 'no_text' in rules and not text:
+            return 'no_text'
+        text = (text or '').strip()
+        if 'too_short' in rules and len(text) < settings['min_chars']:
+            return 'too_short'
+        if 'too_long' in rules and len(text) > settings['max_chars']:
+            return 'too_long'
+
+        letters = sum(1 for char in text if char.isalpha())
+        if 'no_words' in rules and letters < settings['min_letters']:
+            return 'no_words'
+        visible = sum(1 for char in text if not char.isspace())
+        symbols = sum(1 for char in text if not char.isalnum() and not char.isspace())
+        if 'symbols' in rules and visible and symbols / visible > settings['max_symbol_ratio']:
+            return 'symbols'
+        if 'link_only' in rules and _LINK_RE.search(text) and \
+                not any(char.isalpha() for char in _LINK_RE.sub('', text)):
+            return 'link_only'
+
+        if 'forbidden_words' in rules and profile.contains_forbidden(text):
+            return 'forbidden_words'
+
+        chat_id = message.chat_id
+        if 'duplicate' in rules and settings['duplicate_window_s'] > 0:
+            text_key = (chat_id, hashlib.sha1(normalize_message(text).encode('utf-8')).digest())
+            seen_at = self._recent_texts.get(text_key)
+            self._remember(self._recent_texts, text_key, now)
+            if seen_at is not None and now - seen_at < settings['duplicate_window_s']:
+                return 'duplicate'
+
+        if 'cooldown' in rules and settings['cooldown_s'] > 0:
+            author = sender.id if sender is not None else (message.sender_chat.id if message.sender_chat else None)
+            author_key = (chat_id, author)
+            passed_at = self._last_passed.get(author_key)
+            if passed_at is not None and now - passed_at < settings['cooldown_s']:
+                return 'cooldown'
+            self._remember(self._last_passed, author_key, now)
+        return None
+
+    def _remember(self, entries: 'OrderedDict[tuple, float]', key: tuple, now: float):
+        """Запись времени с вытеснением самых старых ключей"""
+        entries[key] = now
+        entries.move_to_end(key)
+        while len(entries) > self.max_tracked:
+            entries.popitem(last=False)
+
+    def report(self) -> Dict[str, Any]:
+        """Счётчики: проверено, пропущено к LLM, отсеяно всего и по правилам"""
+        return dict(self.stats, by_rule={rule: count for rule, count in self.skipped_by_rule.items() if count})
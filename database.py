@@ -1,96 +1,477 @@
-import json
+import atexit
+import functools
+import logging
 import os
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import Dict, Any, List, Optional
+from typing import Callable, Dict, Any, List, Optional
 
-class UserDatabase:
-    def __init__(self):
+import jsoncodec
+from fileutils import write_atomic
+from metrics import registry
+from state_store import StateStore
+from stats_aggregator import merge_windows
+
+logger = logging.getLogger(__name__)
+
+SAVE_SECONDS = registry.histogram(
+    'database_save_seconds', 'Время сохранения базы на диск', ('backend', 'mode')
+)
+
+
+def _timed_save(mode: str):
+    """Замер сохранения базы; вызовы, которым нечего было записывать (вернули False), не учитываются"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            started = time.perf_counter()
+            result = method(self, *args, **kwargs)
+            if result is not False:
+                SAVE_SECONDS.observe(time.perf_counter() - started, self.backend_name, mode)
+            return result
+        return wrapper
+    return decorator
+
+def merge_channel_stats(stats: Dict[str, Any], delta: Dict[str, Any]):
+    """Прибавление приращений счётчиков к блоку stats канала; last_activity заменяется, бакеты окон складываются"""
+    for key, value in delta.items():
+        if key == 'last_activity':
+            stats[key] = value
+        elif key == 'windows':
+            stats[key] = merge_windows(stats.get(key), value)
+        else:
+            stats[key] = (stats.get(key) or 0) + value
+
+
+class BaseUserDatabase(ABC):
+    """
+    Интерфейс хранилища пользователей, каналов и состояний диалогов.
+    Состояния диалогов короткоживущие и хранятся не в основном хранилище, а в state_store
+    """
+
+    def __init__(self, state_store: StateStore = None):
+        self.state_store = state_store if state_store is not None else StateStore()
+        self._channel_listeners: List[Callable[[str], None]] = []
+
+    def add_channel_listener(self, listener: Callable[[str], None]):
+        """Подписка на изменения каналов: listener(channel_id) вызывается после любого изменения канала"""
+        self._channel_listeners.append(listener)
+
+    def _notify_channel_changed(self, channel_id):
+        """Оповещение подписчиков об изменении канала"""
+        for listener in self._channel_listeners:
+            try:
+                listener(str(channel_id))
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике изменения канала {channel_id}: {e}")
+
+    @abstractmethod
+    def add_user(self, user_id, username=None, first_name=None, last_name=None) -> bool:
+        """Добавление нового пользователя"""
+
+    @abstractmethod
+    def update_user_activity(self, user_id, command=None):
+        """Обновление активности пользователя"""
+
+    @abstractmethod
+    def add_channel(self, channel_id: int, channel_title: str, user_id: int, channel_username: str = None, system_prompt: str = None) -> bool:
+        """Добавление нового канала"""
+
+    @abstractmethod
+    def update_channel_settings(self, channel_id: int, settings: Dict[str, Any]) -> bool:
+        """Обновление настроек канала"""
+
+    @abstractmethod
+    def get_channel(self, channel_id) -> Optional[Dict[str, Any]]:
+        """Получение канала по id"""
+
+    def get_user_state(self, user_id) -> Optional[Dict[str, Any]]:
+        """Получение состояния пользователя"""
+        return self.state_store.get(str(user_id))
+
+    def set_user_state(self, user_id, state, data=None):
+        """Установка состояния пользователя"""
+        self.state_store.set(str(user_id), {
+            'state': state,
+            'data': data or {},
+            'updated_at': datetime.now().isoformat()
+        })
+
+    def clear_user_state(self, user_id):
+        """Очистка состояния пользователя"""
+        self.state_store.delete(str(user_id))
+
+    @abstractmethod
+    def remove_channel(self, channel_id: int) -> bool:
+        """Удаление канала"""
+
+    @abstractmethod
+    def transfer_channel(self, channel_id: int, new_owner_id: int) -> bool:
+        """Передача канала другому владельцу"""
+
+    @abstractmethod
+    def get_user_channels(self, user_id: int) -> List[Dict[str, Any]]:
+        """Получение списка каналов пользователя"""
+
+    @abstractmethod
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получение статистики пользователя"""
+
+    @abstractmethod
+    def get_all_users(self) -> Dict[str, Any]:
+        """Получение всех пользователей"""
+
+    @abstractmethod
+    def set_user_openai_key(self, user_id: int, key: str) -> bool:
+        """Установка ключа OpenAI для пользователя"""
+
+    @abstractmethod
+    def get_user_openai_key(self, user_id: int) -> Optional[str]:
+        """Получение ключа OpenAI пользователя"""
+
+    @abstractmethod
+    def add_channel_stats(self, deltas: Dict[str, Dict[str, Any]]):
+        """Прибавление накопленных счётчиков к статистике каналов одной операцией"""
+
+    def poll_external_changes(self) -> int:
+        """
+        Оповещение слушателей об изменениях каналов, сделанных другими процессами.
+        Хранилища, которыми владеет один процесс, внешних изменений не видят
+        """
+        return 0
+
+    def flush(self) -> bool:
+        """Сохранение отложенных изменений"""
+        return False
+
+    def close(self):
+        """Освобождение ресурсов при завершении работы"""
+        self.state_store.close()
+
+
+class UserDatabase(BaseUserDatabase):
+    """Хранилище в памяти с сохранением в один JSON-файл"""
+
+    backend_name = 'json'
+
+    def __init__(self, path: str = 'database.json', write_behind: bool = False,
+                 flush_interval_ms: int = 1000, flush_max_mutations: int = 100,
+                 state_store: StateStore = None, pretty: bool = False):
+        """
+        write_behind=False - каждое изменение сразу сохраняется на диск (как раньше).
+        write_behind=True - изменения только помечают базу "грязной", а фоновый поток
+        сохраняет её не чаще раза в flush_interval_ms или после flush_max_mutations изменений.
+        Файл пишется компактным JSON (быстрее и разбирается, и пишется); pretty=True - с отступами
+        для правки руками. Читаются оба вида.
+        """
+        super().__init__(state_store)
+        self.path = path
+        self.pretty = pretty
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_mutations = flush_max_mutations
         self.users = {
             'users': {},
-            'channels': {},
-            'user_states': {},
-            'user_channels': {}
+            'channels': {}
         }
+        # Вторичный индекс: владелец -> id его каналов (dict как упорядоченное множество).
+        # Не сохраняется на диск, строится при загрузке и поддерживается при каждом изменении
+        self._owner_channels: Dict[str, Dict[str, None]] = {}
+        # _lock защищает self.users от сериализации во время изменения,
+        # _write_lock гарантирует, что снимки попадают на диск по порядку
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._pending_mutations = 0
+        self._flush_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._flusher = None
         self.load_data()
+        if self.write_behind:
+            self._start_flusher()
 
     def load_data(self):
         """Загрузка данных из файла"""
-        if os.path.exists('database.json'):
-            with open('database.json', 'r', encoding='utf-8') as f:
-                self.users = json.load(f)
+        if os.path.exists(self.path):
+            self.users = jsoncodec.load_file(self.path)
+        self._rebuild_channel_index()
+        self._import_legacy_states()
+
+    def _rebuild_channel_index(self):
+        """Полное построение индекса владелец -> каналы (только при загрузке)"""
+        # Старые версии хранили этот список в файле с ключами разных типов - он больше не нужен
+        self.users.pop('user_channels', None)
+        self._owner_channels = {}
+        for channel_id, channel in self.users['channels'].items():
+            self._index_channel(channel_id, channel['owner_id'])
+
+    def _import_legacy_states(self):
+        """Перенос состояний диалогов, которые старые версии хранили в файле, в state_store"""
+        legacy_states = self.users.pop('user_states', None)
+        if legacy_states is None:
+            return
+        for user_id, state in legacy_states.items():
+            self.state_store.set(user_id, state)
+        # Перезапишем файл уже без состояний
+        self._dirty = True
 
+    def _index_channel(self, channel_id: str, owner_id):
+        """Добавление канала в индекс владельца"""
+        self._owner_channels.setdefault(str(owner_id), {})[channel_id] = None
+
+    def _unindex_channel(self, channel_id: str, owner_id):
+        """Удаление канала из индекса владельца"""
+        owned = self._owner_channels.get(str(owner_id))
+        if owned is None:
+            return
+        owned.pop(channel_id, None)
+        if not owned:
+            del self._owner_channels[str(owner_id)]
+
+    def check_channel_index(self) -> List[str]:
+        """Проверка согласованности индекса владелец -> каналы. Возвращает список найденных расхождений"""
+        problems = []
+        with self._lock:
+            expected: Dict[str, Dict[str, None]] = {}
+            for channel_id, channel in self.users['channels'].items():
+                expected.setdefault(str(channel['owner_id']), {})[channel_id] = None
+            for owner_id in expected.keys() | self._owner_channels.keys():
+                indexed = set(self._owner_channels.get(owner_id, ()))
+                actual = set(expected.get(owner_id, ()))
+                for channel_id in sorted(actual - indexed):
+                    problems.append(f"канал {channel_id} владельца {owner_id} отсутствует в индексе")
+                for channel_id in sorted(indexed - actual):
+                    problems.append(f"в индексе владельца {owner_id} лишний канал {channel_id}")
+        return problems
+
+    @_timed_save('save')
     def save_data(self):
         """Сохранение данных в файл"""
-        with open('database.json', 'w', encoding='utf-8') as f:
-            json.dump(self.users, f, ensure_ascii=False, indent=4)
+        with self._write_lock:
+            with self._lock:
+                payload = jsoncodec.dumps(self.users, pretty=self.pretty)
+                self._dirty = False
+                self._pending_mutations = 0
+            try:
+                write_atomic(self.path, payload)
+            except Exception:
+                # Изменения не записаны - их сохранит следующий сброс
+                with self._lock:
+                    self._dirty = True
+                raise
+
+    def _mark_dirty(self):
+        """Фиксация изменения: сразу сохраняем или откладываем до фонового сброса"""
+        if not self.write_behind:
+            self.save_data()
+            return
+        with self._lock:
+            self._dirty = True
+            self._pending_mutations += 1
+            if self._pending_mutations >= self.flush_max_mutations:
+                self._flush_event.set()
+
+    def _start_flusher(self):
+        """Запуск фонового потока сохранения"""
+        self._flusher = threading.Thread(target=self._flusher_loop, name='database-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _flusher_loop(self):
+        """Фоновый цикл: сохраняем базу по таймеру или по количеству изменений"""
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при фоновом сохранении базы данных: {e}")
+
+    @_timed_save('flush')
+    def flush(self) -> bool:
+        """Принудительное сохранение накопленных изменений. Возвращает True, если что-то было записано"""
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                payload = jsoncodec.dumps(self.users, pretty=self.pretty)
+                self._dirty = False
+                self._pending_mutations = 0
+            try:
+                write_atomic(self.path, payload)
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+                raise
+        return True
+
+    def close(self):
+        """Остановка фонового потока и сохранение всех изменений (вызывать при завершении работы)"""
+        if self._flusher is not None:
+            self._stop_event.set()
+            self._flush_event.set()
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        self.state_store.close()
+
+    def _commit(self, record: Dict[str, Any]):
+        """Применение изменения к данным в памяти и его сохранение"""
+        with self._lock:
+            self._apply_record(record)
+            self._append_locked(record)
+        self._persist(record)
+        if 'channel_id' in record:
+            self._notify_channel_changed(record['channel_id'])
+
+    def _append_locked(self, record: Dict[str, Any]):
+        """
+        Запись изменения под той же блокировкой, что и его применение, - снимок не может попасть
+        между ними. JSON-хранилищу не нужна: оно сохраняет базу целиком
+        """
+
+    def _persist(self, record: Dict[str, Any]):
+        """Сохранение изменения: в JSON-хранилище просто помечаем базу изменённой"""
+        self._mark_dirty()
+
+    def _apply_record(self, record: Dict[str, Any]):
+        """Применение одной записи об изменении (используется и при работе, и при воспроизведении журнала)"""
+        op = record['op']
+        if op == 'add_user':
+            self.users['users'][record['user_id']] = record['user']
+        elif op == 'touch_user':
+            user = self.users['users'].get(record['user_id'])
+            if user is None:
+                return
+            user['last_activity'] = record['at']
+            command = record.get('command')
+            if command:
+                if command not in user['commands_used']:
+                    user['commands_used'][command] = 0
+                user['commands_used'][command] += 1
+        elif op == 'add_channel':
+            channel = record['channel']
+            self.users['channels'][str(channel['id'])] = channel
+            # Добавляем канал в список каналов пользователя
+            self._index_channel(str(channel['id']), channel['owner_id'])
+        elif op == 'remove_channel':
+            channel = self.users['channels'].pop(record['channel_id'], None)
+            if channel is not None:
+                self._unindex_channel(record['channel_id'], channel['owner_id'])
+        elif op == 'transfer_channel':
+            channel = self.users['channels'].get(record['channel_id'])
+            if channel is None:
+                return
+            self._unindex_channel(record['channel_id'], channel['owner_id'])
+            channel['owner_id'] = record['owner_id']
+            self._index_channel(record['channel_id'], record['owner_id'])
+        elif op == 'update_channel_settings':
+            channel = self.users['channels'].get(record['channel_id'])
+            if channel is None:
+                return
+            settings = record['settings']
+            if 'assistant_settings' in settings:
+                channel['settings']['assistant_settings'].update(settings['assistant_settings'])
+            else:
+                channel['settings'].update(settings)
+        elif op == 'add_channel_stats':
+            for channel_id, delta in record['deltas'].items():
+                channel = self.users['channels'].get(channel_id)
+                if channel is not None:
+                    merge_channel_stats(channel.setdefault('stats', {}), delta)
+        elif op == 'set_state':
+            # Состояния теперь живут в state_store, такие записи есть только в старых журналах
+            self.state_store.set(record['user_id'], record['state'])
+        elif op == 'clear_state':
+            self.state_store.delete(record['user_id'])
+        elif op == 'set_openai_key':
+            user = self.users['users'].get(record['user_id'])
+            if user is not None:
+                user['openai_key'] = record['key']
+        else:
+            raise ValueError(f"Неизвестная операция: {op}")
 
     def add_user(self, user_id, username=None, first_name=None, last_name=None):
         """Добавление нового пользователя"""
-        if str(user_id) not in self.users['users']:
-            self.users['users'][str(user_id)] = {
-                'username': username,
-                'first_name': first_name,
-                'last_name': last_name,
-                'created_at': datetime.now().isoformat(),
-                'last_activity': datetime.now().isoformat(),
-                'commands_used': {},
-                'openai_key': None  # Добавляем поле для хранения ключа OpenAI
+        user_id = str(user_id)
+        with self._lock:
+            if user_id in self.users['users']:
+                return False
+            record = {
+                'op': 'add_user',
+                'user_id': user_id,
+                'user': {
+                    'username': username,
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'created_at': datetime.now().isoformat(),
+                    'last_activity': datetime.now().isoformat(),
+                    'commands_used': {},
+                    'openai_key': None  # Добавляем поле для хранения ключа OpenAI
+                }
             }
-            self.save_data()
-            return True
-        return False
+            self._apply_record(record)
+            self._append_locked(record)
+        self._persist(record)
+        return True
 
     def update_user_activity(self, user_id, command=None):
         """Обновление активности пользователя"""
         user_id = str(user_id)
-        if user_id in self.users['users']:
-            self.users['users'][user_id]['last_activity'] = datetime.now().isoformat()
-            if command:
-                if command not in self.users['users'][user_id]['commands_used']:
-                    self.users['users'][user_id]['commands_used'][command] = 0
-                self.users['users'][user_id]['commands_used'][command] += 1
-            self.save_data()
+        if user_id not in self.users['users']:
+            return
+        self._commit({
+            'op': 'touch_user',
+            'user_id': user_id,
+            'at': datetime.now().isoformat(),
+            'command': command
+        })
 
     def add_channel(self, channel_id: int, channel_title: str, user_id: int, channel_username: str = None, system_prompt: str = None):
         """Добавление нового канала"""
         try:
             channel_id_str = str(channel_id)
-            if channel_id_str in self.users['channels']:
-                return False
-            
-            # Создаем базовые настройки канала
-            channel_settings = {
-                'auto_reply_enabled': True,
-                'assistant_settings': {
-                    'model': 'gpt-3.5-turbo',
-                    'temperature': 0.7,
-                    'max_tokens': 150,
-                    'system_prompt': system_prompt or "Отвечай кратко и по существу",
-                    'response_style': 'friendly'
+            with self._lock:
+                if channel_id_str in self.users['channels']:
+                    return False
+                
+                # Создаем базовые настройки канала
+                channel_settings = {
+                    'auto_reply_enabled': True,
+                    'assistant_settings': {
+                        'model': 'gpt-3.5-turbo',
+                        'temperature': 0.7,
+                        'max_tokens': 150,
+                        'system_prompt': system_prompt or "Отвечай кратко и по существу",
+                        'response_style': 'friendly'
+                    }
                 }
-            }
-            
-            # Добавляем канал в базу
-            self.users['channels'][channel_id_str] = {
-                'id': channel_id,
-                'title': channel_title,
-                'username': channel_username,
-                'owner_id': user_id,
-                'settings': channel_settings,
-                'stats': {
-                    'total_messages': 0,
-                    'total_replies': 0,
-                    'last_activity': None
+                
+                # Добавляем канал в базу
+                record = {
+                    'op': 'add_channel',
+                    'channel': {
+                        'id': channel_id,
+                        'title': channel_title,
+                        'username': channel_username,
+                        'owner_id': user_id,
+                        'settings': channel_settings,
+                        'stats': {
+                            'total_messages': 0,
+                            'total_replies': 0,
+                            'last_activity': None
+                        }
+                    }
                 }
-            }
-            
-            # Добавляем канал в список каналов пользователя
-            if user_id not in self.users['user_channels']:
-                self.users['user_channels'][user_id] = []
-            self.users['user_channels'][user_id].append(channel_id)
+                self._apply_record(record)
+                self._append_locked(record)
             
             # Сохраняем изменения
-            self.save_data()
+            self._persist(record)
+            self._notify_channel_changed(channel_id_str)
             return True
         except Exception as e:
             logger.error(f"Ошибка при добавлении канала: {e}")
@@ -103,51 +484,41 @@ class UserDatabase:
             if channel_id_str not in self.users['channels']:
                 return False
             
-            channel = self.users['channels'][channel_id_str]
-            
-            # Обновляем настройки
-            if 'assistant_settings' in settings:
-                channel['settings']['assistant_settings'].update(settings['assistant_settings'])
-            else:
-                channel['settings'].update(settings)
-            
-            # Сохраняем изменения
-            self.save_data()
+            # Обновляем настройки и сохраняем изменения
+            self._commit({
+                'op': 'update_channel_settings',
+                'channel_id': channel_id_str,
+                'settings': settings
+            })
             return True
         except Exception as e:
             logger.error(f"Ошибка при обновлении настроек канала: {e}")
             return False
 
-    def get_user_state(self, user_id):
-        """Получение состояния пользователя"""
-        user_id = str(user_id)
-        return self.users['user_states'].get(user_id)
+    def get_channel(self, channel_id) -> Optional[Dict[str, Any]]:
+        """Получение канала по id"""
+        return self.users['channels'].get(str(channel_id))
 
-    def set_user_state(self, user_id, state, data=None):
-        """Установка состояния пользователя"""
-        user_id = str(user_id)
-        self.users['user_states'][user_id] = {
-            'state': state,
-            'data': data or {},
-            'updated_at': datetime.now().isoformat()
-        }
-        self.save_data()
+    def remove_channel(self, channel_id: int) -> bool:
+        """Удаление канала"""
+        channel_id_str = str(channel_id)
+        if channel_id_str not in self.users['channels']:
+            return False
+        self._commit({'op': 'remove_channel', 'channel_id': channel_id_str})
+        return True
 
-    def clear_user_state(self, user_id):
-        """Очистка состояния пользователя"""
-        user_id = str(user_id)
-        if user_id in self.users['user_states']:
-            del self.users['user_states'][user_id]
-            self.save_data()
+    def transfer_channel(self, channel_id: int, new_owner_id: int) -> bool:
+        """Передача канала другому владельцу"""
+        channel_id_str = str(channel_id)
+        if channel_id_str not in self.users['channels']:
+            return False
+        self._commit({'op': 'transfer_channel', 'channel_id': channel_id_str, 'owner_id': new_owner_id})
+        return True
 
     def get_user_channels(self, user_id: int) -> List[Dict[str, Any]]:
-        """Получение списка каналов пользователя"""
-        user_id_str = str(user_id)
-        channels = []
-        for channel_id, channel_data in self.users['channels'].items():
-            if channel_data['owner_id'] == user_id_str:
-                channels.append(channel_data)
-        return channels
+        """Получение списка каналов пользователя (по индексу, за O(число каналов владельца))"""
+        channels = self.users['channels']
+        return [channels[channel_id] for channel_id in self._owner_channels.get(str(user_id), ())]
 
     def get_user_stats(self, user_id: int) -> Dict[str, Any]:
         """Получение статистики пользователя"""
@@ -161,13 +532,172 @@ class UserDatabase:
     def set_user_openai_key(self, user_id: int, key: str):
         """Установка ключа OpenAI для пользователя"""
         user_id_str = str(user_id)
-        if user_id_str in self.users['users']:
-            self.users['users'][user_id_str]['openai_key'] = key
-            self.save_data()
-            return True
-        return False
+        if user_id_str not in self.users['users']:
+            return False
+        self._commit({'op': 'set_openai_key', 'user_id': user_id_str, 'key': key})
+        return True
 
     def get_user_openai_key(self, user_id: int) -> Optional[str]:
         """Получение ключа OpenAI пользователя"""
         user_id_str = str(user_id)
-        return self.users['users'].get(user_id_str, {}).get('openai_key') 
\ No newline at end of file
+        return self.users['users'].get(user_id_str, {}).get('openai_key')
+
+    def add_channel_stats(self, deltas: Dict[str, Dict[str, Any]]):
+        """Прибавление накопленных счётчиков к статистике каналов: одна запись на весь пакет"""
+        if deltas:
+            self._commit({'op': 'add_channel_stats', 'deltas': {str(k): v for k, v in deltas.items()}})
+
+
+class JournaledUserDatabase(UserDatabase):
+    """
+    Хранилище с журналом: каждое изменение дописывается компактной строкой в журнал,
+    а фоновое уплотнение периодически сворачивает журнал в снимок database.json.
+    Стоимость записи пропорциональна размеру изменения, а не размеру базы.
+    """
+
+    backend_name = 'journal'
+
+    def __init__(self, path: str = 'database.json', journal_path: str = None,
+                 compact_every: int = 10000, compact_interval_ms: int = 60000, fsync: bool = False,
+                 state_store: StateStore = None):
+        self.journal_path = journal_path or path + '.journal'
+        # Журнал, который сейчас сворачивается в снимок (или остался после неудачного уплотнения)
+        self.old_journal_path = self.journal_path + '.old'
+        self.fsync = fsync
+        self._seq = 0
+        self._journal = None
+        super().__init__(path, write_behind=True,
+                         flush_interval_ms=compact_interval_ms, flush_max_mutations=compact_every,
+                         state_store=state_store)
+
+    def load_data(self):
+        """Загрузка снимка и воспроизведение хвоста журнала"""
+        snapshot_seq = 0
+        if os.path.exists(self.path):
+            data = jsoncodec.load_file(self.path)
+            snapshot_seq = data.pop('_journal_seq', 0)
+            self.users = data
+        self._rebuild_channel_index()
+        self._import_legacy_states()
+        self._seq = snapshot_seq
+        replayed = 0
+        for journal_path in (self.old_journal_path, self.journal_path):
+            if os.path.exists(journal_path):
+                replayed += self._replay_journal(journal_path)
+        if replayed:
+            logger.info(f"Воспроизведено записей журнала: {replayed}")
+            # Свернём воспроизведённый хвост в снимок при первом уплотнении
+            self._dirty = True
+        # Журнал открывается до запуска фонового потока: если открыть не удалось,
+        # ни поток, ни обработчик atexit ещё не созданы
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def _replay_journal(self, journal_path: str) -> int:
+        """Воспроизведение записей журнала, которых ещё нет в снимке"""
+        replayed = 0
+        good_offset = 0
+        with open(journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = jsoncodec.loads(line)
+                except ValueError:
+                    # Недописанная строка после аварийного завершения - всё после неё отбрасываем
+                    logger.warning(f"Повреждённая запись в журнале {journal_path}, хвост отброшен")
+                    break
+                good_offset += len(line)
+                if record['seq'] <= self._seq:
+                    continue
+                self._apply_record(record)
+                self._seq = record['seq']
+                replayed += 1
+        if good_offset < os.path.getsize(journal_path):
+            with open(journal_path, 'r+b') as f:
+                f.truncate(good_offset)
+        return replayed
+
+    @_timed_save('append')
+    def _append_locked(self, record: Dict[str, Any]):
+        """
+        Дописывание изменения в журнал. Вызывается под _lock сразу после применения: иначе уплотнение
+        между ними сохранит изменение в снимке со старым seq, и при запуске журнал применит его второй раз
+        """
+        with self._lock:
+            self._seq += 1
+            record['seq'] = self._seq
+            self._journal.write(jsoncodec.dumps(record).decode('utf-8') + '\n')
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self._dirty = True
+            self._pending_mutations += 1
+            if self._pending_mutations >= self.flush_max_mutations:
+                self._flush_event.set()
+
+    def _persist(self, record: Dict[str, Any]):
+        """Изменение уже в журнале (_append_locked), снимок пишет фоновое уплотнение"""
+
+    def save_data(self):
+        """Сохранение полного снимка с уплотнением журнала"""
+        with self._lock:
+            self._dirty = True
+        self.flush()
+
+    @_timed_save('compact')
+    def flush(self) -> bool:
+        """Уплотнение: сворачиваем журнал в снимок. Возвращает True, если снимок был записан"""
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                snapshot = dict(self.users, _journal_seq=self._seq)
+                payload = jsoncodec.dumps(snapshot)
+                self._rotate_journal()
+                self._dirty = False
+                self._pending_mutations = 0
+            try:
+                write_atomic(self.path, payload)
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+                raise
+            # Снимок на диске - старый журнал больше не нужен
+            os.remove(self.old_journal_path)
+        return True
+
+    def _rotate_journal(self):
+        """Перенос текущего журнала в .old, новые записи пойдут в чистый файл"""
+        if self._journal is not None:
+            self._journal.close()
+        if os.path.exists(self.old_journal_path):
+            # Предыдущее уплотнение не удалось - дописываем, чтобы не потерять записи
+            with open(self.old_journal_path, 'ab') as dst, open(self.journal_path, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.journal_path)
+        elif os.path.exists(self.journal_path):
+            os.replace(self.journal_path, self.old_journal_path)
+        else:
+            open(self.old_journal_path, 'a').close()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+
+    def close(self):
+        """Финальное уплотнение и закрытие журнала"""
+        super().close()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+def create_database(backend: str = 'json', path: str = None, **kwargs) -> BaseUserDatabase:
+    """
+    Создание хранилища по имени: 'json' - один JSON-файл, 'journal' - журнал со снимками,
+    'sqlite' - база SQLite с индексами
+    """
+    if backend == 'json':
+        return UserDatabase(path or 'database.json', **kwargs)
+    if backend == 'journal':
+        return JournaledUserDatabase(path or 'database.json', **kwargs)
+    if backend == 'sqlite':
+        from sqlite_database import SQLiteUserDatabase
+        return SQLiteUserDatabase(path or 'database.sqlite3', **kwargs)
+    raise ValueError(f"Неизвестный тип хранилища: {backend}")
@@ -1,10 +1,38 @@
+import asyncio
+import gc
 import logging
+import os
+import re
 import sys
+import time
 from datetime import datetime
+
+# Отсчёт времени запуска - до импорта telegram и модулей бота
+STARTUP_STARTED = time.perf_counter()
+
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from database import UserDatabase
-from openai_client import OpenAIClient
+from database import create_database
+from state_store import StateStore
+from openai_client import ERROR_REPLY, OpenAIClientRegistry
+from llm_scheduler import LLMScheduler, SchedulerQueueFull, estimate_request_tokens
+from comment_batcher import CommentBatcher
+from response_cache import ResponseCache
+from channel_context import ChannelContextBuffer
+from channel_profile import ChannelProfileCache
+from streaming_reply import stream_reply
+from update_processor import OrderedUpdateProcessor
+from sharding import run_worker
+from comment_triage import CommentTriage, TRIAGE_RULES
+from stats_aggregator import StatsAggregator
+from prompt_builder import count_tokens
+from post_index import PostIndex
+from model_router import ModelRouter
+from update_dedup import UpdateDeduplicator
+from outbound_dispatcher import OutboundDispatcher
+import jsoncodec
+from metrics import StageClock, StartupTimer, count_error, registry
 
 # Настройка логирования
 logging.basicConfig(
@@ -15,14 +43,180 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Этапы запуска: импорт, загрузка базы, компоненты, приложение, обработчики, инициализация
+startup_timer = StartupTimer(
+    registry.histogram('startup_phase_seconds', 'Время этапов запуска бота', ('phase',)),
+    started=STARTUP_STARTED
+)
+startup_timer.mark('imports')
+
+# Воркер за ingress.py владеет состоянием только своих чатов (кольцо шардов по WORKER_ID),
+# поэтому снимки и индекс постов у каждого воркера свои; общая у воркеров только база SQLite
+WORKER_ID = os.getenv('WORKER_ID', str(os.getpid())) if os.getenv('BOT_MODE') == 'worker' else None
+
+def process_path(path: str) -> str:
+    """Путь к файлу или каталогу состояния процесса: у воркера - с суффиксом WORKER_ID"""
+    if not path or WORKER_ID is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{WORKER_ID}{ext}"
+
 # Инициализация базы данных
 try:
-    db = UserDatabase()
+    # Состояния диалогов живут в памяти с ограниченным сроком жизни
+    state_store = StateStore(
+        ttl_seconds=float(os.getenv('STATE_TTL_SECONDS', '3600')),
+        capacity=int(os.getenv('STATE_CAPACITY', '100000')),
+        snapshot_path=process_path(os.getenv('STATE_SNAPSHOT_PATH')) or None,
+        snapshot_interval_s=float(os.getenv('STATE_SNAPSHOT_INTERVAL_S', '60'))
+    )
+    database_backend = os.getenv('DATABASE_BACKEND', 'json')
+    if database_backend == 'journal':
+        db = create_database(
+            'journal',
+            path=os.getenv('DATABASE_PATH'),
+            compact_every=int(os.getenv('DATABASE_COMPACT_EVERY', '10000')),
+            compact_interval_ms=int(os.getenv('DATABASE_COMPACT_INTERVAL_MS', '60000')),
+            state_store=state_store
+        )
+    elif database_backend == 'sqlite':
+        db = create_database('sqlite', path=os.getenv('DATABASE_PATH'), state_store=state_store)
+    else:
+        db = create_database(
+            database_backend,
+            path=os.getenv('DATABASE_PATH'),
+            write_behind=os.getenv('DATABASE_WRITE_BEHIND', '0') == '1',
+            flush_interval_ms=int(os.getenv('DATABASE_FLUSH_INTERVAL_MS', '1000')),
+            flush_max_mutations=int(os.getenv('DATABASE_FLUSH_MAX_MUTATIONS', '100')),
+            state_store=state_store,
+            pretty=os.getenv('DATABASE_PRETTY_JSON', '0') == '1'
+        )
+    startup_timer.mark('database')
     logger.info("База данных успешно инициализирована")
 except Exception as e:
     logger.error(f"Ошибка при инициализации базы данных: {e}")
     raise
 
+# Маршрутизация комментариев: простые - быстрой дешёвой модели, сложные - модели канала.
+# По умолчанию выключена: каналы включают её в assistant_settings['routing']
+model_router = ModelRouter(
+    enabled=os.getenv('ROUTER_ENABLED', '0') == '1',
+    fast_model=os.getenv('ROUTER_FAST_MODEL', 'gpt-4o-mini'),
+    threshold=int(os.getenv('ROUTER_THRESHOLD', '3')),
+    min_tokens=int(os.getenv('ROUTER_MIN_TOKENS', '40'))
+)
+
+# Клиенты OpenAI по ключам владельцев каналов: переиспользуют соединения и не блокируют цикл событий
+openai_clients = OpenAIClientRegistry(
+    max_clients=int(os.getenv('OPENAI_MAX_CLIENTS', '256')),
+    timeout=float(os.getenv('OPENAI_TIMEOUT', '30')),
+    connect_timeout=float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5')),
+    max_retries=int(os.getenv('OPENAI_MAX_RETRIES', '1')),
+    router=model_router
+)
+
+# Планировщик запросов к LLM: лимиты на ключ владельца, общий лимит параллельности, очереди каналов
+llm_scheduler = LLMScheduler(
+    max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', '16')),
+    requests_per_minute=float(os.getenv('LLM_REQUESTS_PER_MINUTE', '60')),
+    tokens_per_minute=float(os.getenv('LLM_TOKENS_PER_MINUTE', '40000')),
+    max_queue=int(os.getenv('LLM_MAX_QUEUE', '1000')),
+    max_queue_per_channel=int(os.getenv('LLM_MAX_QUEUE_PER_CHANNEL', '50')),
+    overflow_policy=os.getenv('LLM_OVERFLOW_POLICY', 'drop_new')
+)
+
+# Микро-пакетирование комментариев (0 - выключено)
+comment_batch_window_ms = int(os.getenv('COMMENT_BATCH_WINDOW_MS', '0'))
+comment_batcher = CommentBatcher(
+    window_ms=comment_batch_window_ms,
+    max_batch=int(os.getenv('COMMENT_BATCH_MAX_SIZE', '8'))
+) if comment_batch_window_ms > 0 else None
+
+# Кэш ответов на типовые комментарии (RESPONSE_CACHE_MAX_BYTES=0 - выключен)
+response_cache_max_bytes = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+response_cache = ResponseCache(
+    max_bytes=response_cache_max_bytes,
+    ttl_seconds=float(os.getenv('RESPONSE_CACHE_TTL_SECONDS', '3600')),
+    include_context=os.getenv('RESPONSE_CACHE_INCLUDE_CONTEXT', '0') == '1',
+    disk_path=os.getenv('RESPONSE_CACHE_PATH') or None
+) if response_cache_max_bytes > 0 else None
+if response_cache is not None:
+    # Изменение настроек канала сбрасывает его кэш
+    db.add_channel_listener(response_cache.invalidate_channel)
+
+# Скомпилированные профили каналов, пересобираются при изменении канала
+channel_profiles = ChannelProfileCache(db)
+
+# Фильтр комментариев перед LLM: правила через запятую, пороги по умолчанию (канал переопределяет их в assistant_settings.triage)
+comment_triage = CommentTriage(
+    enabled_rules=[rule.strip() for rule in (os.getenv('TRIAGE_RULES') or ','.join(TRIAGE_RULES)).split(',') if rule.strip()],
+    min_chars=int(os.getenv('TRIAGE_MIN_CHARS', '2')),
+    max_chars=int(os.getenv('TRIAGE_MAX_CHARS', '2000')),
+    min_letters=int(os.getenv('TRIAGE_MIN_LETTERS', '2')),
+    max_symbol_ratio=float(os.getenv('TRIAGE_MAX_SYMBOL_RATIO', '0.5')),
+    duplicate_window_s=float(os.getenv('TRIAGE_DUPLICATE_WINDOW_S', '300')),
+    cooldown_s=float(os.getenv('TRIAGE_COOLDOWN_S', '0'))
+)
+
+# Статистика каналов: итоговые счётчики и бакеты окон сохраняются в хранилище пакетами
+stats_aggregator = StatsAggregator(db, flush_interval_s=float(os.getenv('STATS_FLUSH_INTERVAL_S', '30')))
+
+# Последние сообщения чатов для контекста ответов
+context_buffer = ChannelContextBuffer(
+    max_messages=int(os.getenv('CONTEXT_MAX_MESSAGES', '10')),
+    max_chars=int(os.getenv('CONTEXT_MAX_CHARS', '1000')),
+    max_chats=int(os.getenv('CONTEXT_MAX_CHATS', '10000')),
+    snapshot_path=process_path(os.getenv('CONTEXT_SNAPSHOT_PATH')) or None
+)
+
+# Индекс постов каналов: к каждому комментарию подбираются релевантные посты (RETRIEVAL_TOP_K=0 - выключен)
+retrieval_top_k = int(os.getenv('RETRIEVAL_TOP_K', '3'))
+post_index = PostIndex(
+    process_path(os.getenv('POST_INDEX_DIR', 'post_index')),
+    max_channels=int(os.getenv('POST_INDEX_MAX_CHANNELS', '1000')),
+    segment_size=int(os.getenv('POST_INDEX_SEGMENT_SIZE', '256')),
+    max_segments=int(os.getenv('POST_INDEX_MAX_SEGMENTS', '8')),
+    max_posts=int(os.getenv('POST_INDEX_MAX_POSTS', '5000'))
+) if retrieval_top_k > 0 else None
+
+# Идемпотентность: каждый комментарий обрабатывается один раз, даже при повторной доставке обновления
+update_dedup = UpdateDeduplicator(
+    window_size=int(os.getenv('DEDUP_WINDOW_SIZE', '100000')),
+    window_ttl_s=float(os.getenv('DEDUP_WINDOW_TTL_S', '172800')),
+    filter_capacity=int(os.getenv('DEDUP_FILTER_CAPACITY', '500000')),
+    error_rate=float(os.getenv('DEDUP_ERROR_RATE', '0.0001')),
+    snapshot_path=process_path(os.getenv('DEDUP_SNAPSHOT_PATH')) or None
+)
+# Правка уже обработанного комментария: ignore - не реагировать, reanswer - заново ответить, отредактировав ответ
+edited_comments_policy = os.getenv('EDITED_COMMENTS_POLICY', 'ignore')
+
+# Исходящие сообщения с учётом лимитов Telegram: общий и по чатам, меню раньше ответов в группах
+outbound_dispatcher = OutboundDispatcher(
+    global_rate=float(os.getenv('OUTBOUND_GLOBAL_RATE', '30')),
+    private_rate=float(os.getenv('OUTBOUND_PRIVATE_RATE', '1')),
+    private_burst=int(os.getenv('OUTBOUND_PRIVATE_BURST', '3')),
+    group_rate=float(os.getenv('OUTBOUND_GROUP_RATE_PER_MINUTE', '20')),
+    group_burst=int(os.getenv('OUTBOUND_GROUP_BURST', '3'))
+) if os.getenv('OUTBOUND_RATE_LIMIT', '1') == '1' else None
+
+# Метрики горячего пути: этапы обработки комментария, кнопки по типу, ошибки по типу
+CHANNEL_STAGE_SECONDS = registry.histogram(
+    'channel_message_stage_seconds', 'Время этапов обработки сообщения в канале', ('stage',)
+)
+BUTTON_SECONDS = registry.histogram('button_handler_seconds', 'Время обработки нажатия кнопки', ('callback',))
+_CALLBACK_ID_RE = re.compile(r'_-?\d+$')
+registry.gauge('llm_scheduler_queue_depth', 'Запросов в очереди планировщика LLM', llm_scheduler.queue_depth)
+registry.gauge('context_buffer_chats', 'Чатов в буфере контекста', lambda: len(context_buffer))
+registry.gauge('triage_skipped_total', 'Комментариев, отсеянных до запроса к LLM', lambda: comment_triage.stats['skipped'])
+if outbound_dispatcher is not None:
+    registry.gauge('telegram_outbound_queue_depth', 'Исходящих запросов, ждущих лимитов Telegram',
+                   outbound_dispatcher.queue_depth)
+registry.gauge('duplicate_updates_total', 'Повторно доставленных сообщений, пропущенных без обработки',
+               lambda: update_dedup.stats['duplicates'])
+if response_cache is not None:
+    registry.gauge('response_cache_bytes', 'Объём кэша ответов в памяти', response_cache.memory_bytes)
+startup_timer.mark('components')
+
 def get_main_menu_keyboard():
     """Создание клавиатуры главного меню"""
     keyboard = [
@@ -107,6 +301,41 @@ def get_main_menu_text(user_id: int, first_name: str = None) -> str:
     welcome_text += "\nВыбери своё действие 👇"
     return welcome_text
 
+def get_stats_text(user_id: int) -> str:
+    """Экран статистики владельца: суммы по окнам и итоговые счётчики каналов из хранилища"""
+    user_channels = db.get_user_channels(user_id)
+    if not user_channels:
+        return "📊 Статистика\n\nУ тебя ещё нет каналов в управлении"
+
+    text = "📊 Статистика\n"
+    windows = stats_aggregator.windows_for(user_channels)
+    for name, title in (('hour', 'За час'), ('day', 'За сутки'), ('month', 'За 30 дней')):
+        window = windows[name]
+        text += (
+            f"\n{title}:\n"
+            f"• комментариев: {window['messages']}, ответов: {window['replies']}, пропущено: {window['skips']}\n"
+            f"• токенов: {window['tokens']}"
+        )
+        if window['llm_calls']:
+            text += f", среднее время ответа: {window['latency_ms'] / window['llm_calls'] / 1000:.1f} с"
+        text += "\n"
+
+    text += "\nВсего по каналам:\n"
+    for channel in user_channels:
+        # Сохранённые итоги плюс ещё не записанные приращения
+        channel_stats = dict(channel.get('stats') or {})
+        for key, value in stats_aggregator.pending_for(channel['id']).items():
+            if key != 'last_activity':
+                channel_stats[key] = (channel_stats.get(key) or 0) + value
+        text += (
+            f"• @{channel['username']}: комментариев {channel_stats.get('total_messages') or 0}, "
+            f"ответов {channel_stats.get('total_replies') or 0}\n"
+        )
+    if WORKER_ID is not None:
+        # Каналы владельца могут обслуживать другие воркеры: их данные приходят с записью в хранилище
+        text += f"\nДанные других процессов обновляются раз в {stats_aggregator.flush_interval_s:g} с\n"
+    return text
+
 # Обработчик команды /start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -124,11 +353,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(welcome_text, reply_markup=get_main_menu_keyboard())
         logger.info("Команда /start успешно обработана")
     except Exception as e:
+        count_error('start', e)
         logger.error(f"Ошибка при обработке команды /start: {e}")
         raise
 
 # Обработчик нажатий на кнопки
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    started = time.perf_counter()
     try:
         logger.info("Получено нажатие кнопки")
         query = update.callback_query
@@ -251,7 +482,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 db.clear_user_state(query.from_user.id)
         elif query.data.startswith('channel_'):
             channel_id = query.data.split('_')[1]
-            channel = db.users['channels'].get(channel_id)
+            channel = db.get_channel(channel_id)
             if channel:
                 await query.message.edit_text(
                     f"Настройки канала {channel['title']}\n\n"
@@ -263,7 +494,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             user_state = db.get_user_state(query.from_user.id)
             if user_state and 'channel_id' in user_state['data']:
                 channel_id = user_state['data']['channel_id']
-                channel = db.users['channels'].get(str(channel_id))
+                channel = db.get_channel(channel_id)
                 if channel:
                     settings = channel['settings']['assistant_settings']
                     text = (
@@ -276,7 +507,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     )
                     await query.message.edit_text(text, reply_markup=get_assistant_settings_keyboard())
                     db.set_user_state(query.from_user.id, 'setting_assistant', {'channel_id': channel_id})
-        elif query.data in ['settings', 'stats']:
+        elif query.data == 'stats':
+            await query.message.edit_text(get_stats_text(query.from_user.id), reply_markup=get_back_keyboard())
+        elif query.data == 'settings':
             await query.message.edit_text(
                 "🚧 Эта функция пока недоступна. Мы работаем над её добавлением.",
                 reply_markup=get_back_keyboard()
@@ -353,8 +586,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     db.clear_user_state(query.from_user.id)
         logger.info(f"Кнопка {query.data} успешно обработана")
     except Exception as e:
+        count_error('button', e)
         logger.error(f"Ошибка при обработке нажатия кнопки: {e}")
         raise
+    finally:
+        # channel_<id> и подобные считаем одним типом кнопки
+        callback = _CALLBACK_ID_RE.sub('', update.callback_query.data or '') if update.callback_query else ''
+        BUTTON_SECONDS.observe(time.perf_counter() - started, callback)
 
 # Обработчик пересланных сообщений (для добавления каналов)
 async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -408,6 +646,7 @@ async def handle_forwarded_message(update: Update, context: ContextTypes.DEFAULT
             )
         logger.info("Пересланное сообщение успешно обработано")
     except Exception as e:
+        count_error('forwarded_message', e)
         logger.error(f"Ошибка при обработке пересланного сообщения: {e}")
         raise
 
@@ -450,97 +689,353 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
         logger.info("Текстовое сообщение успешно обработано")
     except Exception as e:
+        count_error('text_message', e)
         logger.error(f"Ошибка при обработке текстового сообщения: {e}")
         raise
 
-async def get_channel_context(chat_id: int, context: ContextTypes.DEFAULT_TYPE, limit: int = 10) -> list:
-    """Получение последних сообщений из канала для контекста"""
-    try:
-        messages = []
-        async for message in context.bot.get_chat_history(chat_id, limit=limit):
-            if message.text:
-                messages.append({
-                    "role": "system" if message.from_user.id == context.bot.id else "user",
-                    "content": message.text
-                })
-        return messages[::-1]  # Возвращаем в хронологическом порядке
-    except Exception as e:
-        logger.error(f"Ошибка при получении контекста канала: {e}")
+def get_channel_context(chat_id: int, limit: int = 10) -> list:
+    """Получение последних сообщений из канала для контекста (из буфера в памяти, без запросов к API)"""
+    return context_buffer.get(chat_id, limit)
+
+def get_relevant_posts(chat_id: int, text: str) -> list:
+    """Посты канала, наиболее релевантные комментарию (из локального индекса)"""
+    if post_index is None:
         return []
+    return post_index.search(chat_id, text, retrieval_top_k)
+
+async def send_reply(message, text: str, edit_reply_id: int = None):
+    """Ответ на комментарий с запоминанием его id; для правки комментария редактируется прежний ответ"""
+    if edit_reply_id is None:
+        reply = await message.reply_text(text)
+        update_dedup.set_reply(message.chat.id, message.message_id, reply.message_id)
+        return
+    try:
+        await message.get_bot().edit_message_text(text, chat_id=message.chat.id, message_id=edit_reply_id)
+    except BadRequest as e:
+        # "Message is not modified" - новый ответ совпал с прежним
+        if 'not modified' not in str(e).lower():
+            raise
 
 # Обработчик сообщений в каналах
 async def handle_channel_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    clock = StageClock(CHANNEL_STAGE_SECONDS)
+    claimed = False
     try:
-        message = update.message
+        # Посты канала приходят как channel_post, комментарии в группе - как message
+        message = update.effective_message
         chat = message.chat
         
         # Проверяем, является ли чат каналом
         if chat.type not in ['channel', 'group']:
             return
             
-        # Проверяем, есть ли канал в базе
-        channel_id = str(chat.id)
-        if channel_id not in db.users['channels']:
+        # Изменения каналов из других процессов (воркеры с общей базой) сбрасывают локальные кэши
+        db.poll_external_changes()
+
+        # Проверяем, есть ли канал в базе (профиль канала собирается один раз и кэшируется)
+        profile = channel_profiles.get(chat.id)
+        clock.mark('profile')
+        if profile is None:
             return
-            
-        channel = db.users['channels'][channel_id]
+
+        # Повторная доставка (перезапуск, повтор polling) не обрабатывается второй раз; правка комментария
+        # по политике либо игнорируется, либо заново отвечается редактированием уже отправленного ответа
+        edit_reply_id = None
+        if update.edited_message is not None or update.edited_channel_post is not None:
+            edit_reply_id = update_dedup.reply_for(chat.id, message.message_id)
+            if edited_comments_policy != 'reanswer' or edit_reply_id is None:
+                return
+        elif update_dedup.claim(chat.id, message.message_id):
+            claimed = True
+        else:
+            logger.info(f"Сообщение {message.message_id} в чате {chat.id} уже обработано, повтор пропущен")
+            return
+        clock.mark('dedup')
+
+        # Контекст - сообщения до текущего; само сообщение запоминаем для следующих ответов
+        channel_context = get_channel_context(chat.id)
+        context_buffer.record(chat.id, message.text or message.caption)
+        clock.mark('context')
+
+        # На посты канала не отвечаем, они нужны только как контекст и для поиска по каналу
+        # (в группу обсуждения посты приходят автоматической пересылкой)
+        if update.channel_post is not None or message.is_automatic_forward:
+            if post_index is not None:
+                post_index.add(chat.id, message.message_id, message.text or message.caption)
+        if update.channel_post is not None:
+            return
+        stats_aggregator.record(chat.id, messages=1)
         
         # Проверяем, включены ли автоответы
-        if not channel['settings']['auto_reply_enabled']:
+        if not profile.auto_reply_enabled:
             return
             
-        # Проверяем ограничения
-        restrictions = channel['settings']['restrictions']
-        current_time = datetime.now()
-        
         # Проверяем время работы
-        start_time = datetime.strptime(restrictions['active_hours']['start'], '%H:%M').time()
-        end_time = datetime.strptime(restrictions['active_hours']['end'], '%H:%M').time()
-        if not (start_time <= current_time.time() <= end_time):
+        if not profile.is_active(datetime.now().time()):
+            return
+
+        # Комментарии, на которые отвечать не нужно, отсеиваем без запроса к OpenAI
+        skip_reason = comment_triage.check(message, profile)
+        clock.mark('triage')
+        if skip_reason is not None:
+            stats_aggregator.record(chat.id, skips=1)
             return
             
         # Получаем ключ OpenAI владельца канала
-        owner_id = int(channel['owner_id'])
-        openai_key = db.get_user_openai_key(owner_id)
+        openai_key = db.get_user_openai_key(profile.owner_id)
+        clock.mark('owner_key')
         if not openai_key:
             return
             
-        # Получаем контекст из последних сообщений канала
-        channel_context = await get_channel_context(chat.id, context)
-        
-        # Генерируем ответ с учетом контекста
-        client = OpenAIClient(openai_key)
-        response = client.generate_response(
-            message.text,
-            channel['settings'],
-            context=channel_context
-        )
+        # Типовые комментарии отвечаем из кэша без запроса к OpenAI
+        if response_cache is not None:
+            cached_response = response_cache.get(chat.id, message.text, profile.settings, channel_context)
+            clock.mark('cache')
+            if cached_response is not None:
+                await send_reply(message, cached_response, edit_reply_id)
+                clock.mark('send')
+                clock.finish()
+                stats_aggregator.record(chat.id, replies=1)
+                context_buffer.record(chat.id, cached_response, 'assistant')
+                return
+
+        # Потоковый ответ: первое сообщение появляется сразу и дописывается редактированием
+        # (ответ на правку комментария заменяет прежний ответ целиком)
+        if profile.stream_replies and edit_reply_id is None:
+            relevant_posts = get_relevant_posts(chat.id, message.text)
+            clock.mark('retrieval')
+
+            async def run_stream():
+                started = time.monotonic()
+                try:
+                    return await stream_reply(
+                        message,
+                        openai_clients.get(openai_key).stream_response(
+                            message.text,
+                            profile.settings,
+                            context=channel_context,
+                            profile=profile,
+                            knowledge=relevant_posts
+                        ),
+                        edit_interval=profile.stream_edit_interval,
+                        abort_if=profile.contains_forbidden,
+                        on_reply=lambda reply_id: update_dedup.set_reply(chat.id, message.message_id, reply_id),
+                        # Промежуточные правки не ждут очереди лимитов: при нехватке токенов пропускаются
+                        edit_rate_limit_args={'drop_if_limited': True} if outbound_dispatcher is not None else None
+                    )
+                finally:
+                    elapsed = time.monotonic() - started
+                    CHANNEL_STAGE_SECONDS.observe(elapsed, 'llm_stream')
+                    stats_aggregator.record(chat.id, llm_calls=1, latency_ms=elapsed * 1000)
+
+            try:
+                response = await llm_scheduler.submit(
+                    openai_key,
+                    chat.id,
+                    run_stream,
+                    estimated_tokens=estimate_request_tokens(message.text, channel_context, profile.max_tokens,
+                                                             relevant_posts)
+                )
+            except SchedulerQueueFull as e:
+                logger.warning(f"Запрос к OpenAI отброшен: {e}")
+                update_dedup.release(chat.id, message.message_id)
+                return
+            except Exception as e:
+                count_error('channel_message_stream', e)
+                logger.error(f"Ошибка при потоковой генерации ответа: {e}")
+                await message.reply_text(ERROR_REPLY)
+                return
+            # Время от постановки в очередь до последнего редактирования ответа
+            clock.mark('generate')
+            clock.finish()
+
+            # None - генерация остановлена из-за запрещённых слов
+            if response is not None:
+                # Поток не сообщает расход токенов - берём локальную оценку запроса и ответа
+                stats_aggregator.record(
+                    chat.id, replies=1,
+                    tokens=estimate_request_tokens(message.text, channel_context, 0) + count_tokens(response)
+                )
+                if response_cache is not None:
+                    response_cache.put(chat.id, message.text, profile.settings, response, channel_context)
+                context_buffer.record(chat.id, response, 'assistant')
+            return
+
+        # Генерируем ответ с учетом контекста через планировщик с лимитами ключа владельца
+        async def run_batch(comments):
+            # Для пакета ищем посты сразу по всем его комментариям
+            relevant_posts = get_relevant_posts(chat.id, '\n'.join(comments))
+
+            async def call():
+                started = time.monotonic()
+                try:
+                    return await openai_clients.get(openai_key).generate_batch_responses(
+                        comments,
+                        profile.settings,
+                        context=channel_context,
+                        profile=profile,
+                        on_usage=lambda tokens: stats_aggregator.record(chat.id, tokens=tokens),
+                        knowledge=relevant_posts
+                    )
+                finally:
+                    elapsed = time.monotonic() - started
+                    CHANNEL_STAGE_SECONDS.observe(elapsed, 'llm_call')
+                    stats_aggregator.record(chat.id, llm_calls=1, latency_ms=elapsed * 1000)
+
+            return await llm_scheduler.submit(
+                openai_key,
+                chat.id,
+                call,
+                estimated_tokens=estimate_request_tokens('\n'.join(comments), channel_context,
+                                                         profile.max_tokens * len(comments), relevant_posts)
+            )
+
+        try:
+            if comment_batcher is not None:
+                # Комментарии, пришедшие почти одновременно, уходят в LLM одним запросом
+                response = await comment_batcher.submit(chat.id, message.text, run_batch)
+            else:
+                response = (await run_batch([message.text]))[0]
+        except SchedulerQueueFull as e:
+            logger.warning(f"Запрос к OpenAI отброшен: {e}")
+            update_dedup.release(chat.id, message.message_id)
+            return
+        # Ожидание пакета и очереди планировщика плюс сам запрос (llm_call)
+        clock.mark('generate')
+
+        # Ответ с запрещёнными словами канала не отправляем
+        if profile.contains_forbidden(response):
+            logger.warning(f"Ответ для канала {chat.id} содержит запрещённые слова и не отправлен")
+            return
+
+        if response_cache is not None and response != ERROR_REPLY:
+            response_cache.put(chat.id, message.text, profile.settings, response, channel_context)
         
         # Отправляем ответ
-        await message.reply_text(response)
+        await send_reply(message, response, edit_reply_id)
+        clock.mark('send')
+        clock.finish()
+        stats_aggregator.record(chat.id, replies=1)
+        context_buffer.record(chat.id, response, 'assistant')
         
     except Exception as e:
-        logger.error(f"Ошибка при обработке сообщения в канале: {e}")
+        count_error('channel_message', e)
+        logger.error(f"Ошибка при обработке сообщения в канале: {e}", exc_info=True)
+        if claimed:
+            # Ответа нет - повторная доставка комментария будет обработана заново
+            update_dedup.release(chat.id, message.message_id)
+    except BaseException:
+        # Отмена задачи посреди обработки
+        if claimed:
+            update_dedup.release(chat.id, message.message_id)
+        raise
+    finally:
+        # Отметка становится окончательной только после обработки (снятая выше - уже не в работе)
+        if claimed:
+            update_dedup.complete(chat.id, message.message_id)
+
+async def post_init(application: Application):
+    """Бот инициализирован и сейчас начнёт получать обновления - отчёт о времени запуска"""
+    startup_timer.mark('initialize')
+    # Загруженная база и всё созданное при запуске живут до остановки: переносим их в постоянное
+    # поколение, чтобы полные сборки мусора не обходили их снова
+    gc.freeze()
+    logger.info(f"Время запуска: {startup_timer.report()} (JSON: {jsoncodec.backend()})")
+
+async def post_shutdown(application: Application):
+    """Остановка планировщика и закрытие пулов соединений OpenAI при остановке бота"""
+    logger.info(f"Планировщик LLM: {llm_scheduler.stats()}")
+    logger.info(f"Фильтр комментариев: {comment_triage.report()}")
+    logger.info(f"Уровни моделей: {model_router.report()}")
+    await llm_scheduler.close()
+    await openai_clients.close()
+    if response_cache is not None:
+        logger.info(f"Кэш ответов: {response_cache.stats}")
+        response_cache.close()
+    context_buffer.save_snapshot()
+    logger.info(f"Повторные доставки: {update_dedup.stats}")
+    if outbound_dispatcher is not None:
+        logger.info(f"Исходящие сообщения: {outbound_dispatcher.stats}")
+    update_dedup.close()
+    if post_index is not None:
+        post_index.close()
+    registry.close()
+
+def register_handlers(application: Application):
+    """Обработчики бота (используются и в main, и в benchmark.py)"""
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    # Мастер настройки идёт в личном чате; пересланные посты и текст в группах - это комментарии
+    application.add_handler(MessageHandler(filters.FORWARDED & filters.ChatType.PRIVATE, handle_forwarded_message))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_text_message))
+    application.add_handler(MessageHandler(filters.ChatType.CHANNEL | filters.ChatType.GROUP, handle_channel_message, block=False))
 
 def main():
     try:
         logger.info("Запуск бота...")
-        # Создаем приложение и передаем токен бота
-        application = Application.builder().token('8083571952:AAFZDg2UfFAlhQzOd-cDapTQv7X90BDD_bg').build()
-
-        # Добавляем обработчики
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CallbackQueryHandler(button_handler))
-        application.add_handler(MessageHandler(filters.FORWARDED, handle_forwarded_message))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
-        application.add_handler(MessageHandler(filters.ChatType.CHANNEL | filters.ChatType.GROUP, handle_channel_message))
+        # Создаем приложение и передаем токен бота; обновления разных пользователей
+        # обрабатываются параллельно, обновления одного пользователя и чата - по порядку
+        concurrent_updates = int(os.getenv('BOT_CONCURRENT_UPDATES', '32'))
+        bot_mode = os.getenv('BOT_MODE', 'polling')
+        if bot_mode == 'worker' and database_backend != 'sqlite':
+            # JSON-хранилищем владеет один процесс, воркерам нужна общая база
+            raise ValueError("Для режима worker нужен DATABASE_BACKEND=sqlite")
+        builder = (
+            Application.builder()
+            .token(os.getenv('TELEGRAM_BOT_TOKEN', '8083571952:AAFZDg2UfFAlhQzOd-cDapTQv7X90BDD_bg'))
+            .concurrent_updates(OrderedUpdateProcessor(concurrent_updates) if concurrent_updates > 1 else False)
+            .post_init(post_init)
+            .post_shutdown(post_shutdown)
+        )
+        if outbound_dispatcher is not None:
+            builder = builder.rate_limiter(outbound_dispatcher)
+        if bot_mode == 'worker':
+            # Обновления приходят от ingress.py, свой polling/webhook воркеру не нужен
+            builder = builder.updater(None)
+        application = builder.build()
+        startup_timer.mark('application')
+
+        # Эндпоинт Prometheus (METRICS_PORT=0 - выключен); воркерам ingress.py назначает каждому свой порт
+        metrics_port = int(os.getenv('METRICS_PORT', '0'))
+        if metrics_port > 0:
+            registry.serve(metrics_port, os.getenv('METRICS_HOST', '127.0.0.1'))
+
+        register_handlers(application)
+        startup_timer.mark('handlers')
         
-        # Запускаем бота
-        logger.info("Бот успешно запущен и готов к работе")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        # Запускаем бота: вебхук со встроенным HTTP-сервером, long polling или воркер за ingress
+        logger.info(f"Бот успешно запущен и готов к работе (режим: {bot_mode})")
+        if bot_mode == 'worker':
+            asyncio.run(run_worker(
+                application,
+                os.getenv('WORKER_SOCKET', '/tmp/agentzero-ingress.sock'),
+                WORKER_ID,
+                stats_interval=float(os.getenv('SHARD_STATS_INTERVAL_S', '60'))
+            ))
+        elif bot_mode == 'webhook':
+            webhook_path = os.getenv('WEBHOOK_PATH', 'telegram')
+            webhook_secret_token = os.getenv('WEBHOOK_SECRET_TOKEN')
+            if not webhook_secret_token:
+                raise ValueError("Для режима webhook нужен WEBHOOK_SECRET_TOKEN")
+            # Запросы без заголовка X-Telegram-Bot-Api-Secret-Token с этим значением отклоняются
+            application.run_webhook(
+                listen=os.getenv('WEBHOOK_LISTEN', '127.0.0.1'),
+                port=int(os.getenv('WEBHOOK_PORT', '8443')),
+                url_path=webhook_path,
+                webhook_url=f"{os.environ['WEBHOOK_URL'].rstrip('/')}/{webhook_path}",
+                secret_token=webhook_secret_token,
+                max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')),
+                allowed_updates=Update.ALL_TYPES
+            )
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}")
         raise
+    finally:
+        # Сбрасываем на диск накопленную статистику и отложенные изменения базы
+        stats_aggregator.close()
+        db.close()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,22 @@
+import os
+import tempfile
+from typing import Union
+
+
+def write_atomic(path: str, payload: Union[str, bytes]):
+    """
+    Запись во временный файл и атомарная замена, чтобы при падении не остался обрезанный файл.
+    bytes записываются как есть, str - в UTF-8
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '-', suffix='.tmp', dir=directory)
+    try:
+        with (os.fdopen(fd, 'wb') if isinstance(payload, bytes) else os.fdopen(fd, 'w', encoding='utf-8')) as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,246 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from collections import deque
+from typing import Deque, Dict, List, Tuple
+
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+from sharding import ConsistentHashRing, MAX_FRAME_BYTES, read_frame, shard_key, write_frame
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO,
+    stream=sys.stdout
+)
+
+logger = logging.getLogger(__name__)
+
+
+class _WorkerConnection:
+    __slots__ = ('worker_id', 'writer', 'routed', 'stats')
+
+    def __init__(self, worker_id: str, writer: asyncio.StreamWriter):
+        self.worker_id = worker_id
+        self.writer = writer
+        self.routed = 0
+        self.stats: Dict[str, float] = {}
+
+
+class ShardRouter:
+    """
+    Маршрутизатор ingress-процесса: воркеры подключаются к Unix-сокету и встают в кольцо
+    консистентного хэширования, обновления уходят воркеру, владеющему чатом.
+
+    Воркер уходит из кольца, когда просит об этом (leave) или теряет соединение.
+    Пока воркеров нет, обновления копятся в ограниченном буфере (max_pending)
+    """
+
+    def __init__(self, socket_path: str, replicas: int = 160, max_pending: int = 10000):
+        self.socket_path = socket_path
+        self.ring = ConsistentHashRing(replicas=replicas)
+        self._workers: Dict[str, _WorkerConnection] = {}
+        # (ключ шарда, обновление)
+        self._pending: Deque[Tuple[str, dict]] = deque(maxlen=max_pending)
+        self._server = None
+        self.dropped = 0
+
+    async def start(self):
+        """Запуск Unix-сокета для воркеров"""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._handle_worker, self.socket_path, limit=MAX_FRAME_BYTES)
+        logger.info(f"Ingress ждёт воркеров на {self.socket_path}")
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = await read_frame(reader)
+        if not hello or hello.get('type') != 'hello':
+            writer.close()
+            return
+        worker = _WorkerConnection(str(hello['worker']), writer)
+        if worker.worker_id in self._workers:
+            logger.error(f"Воркер {worker.worker_id} уже подключён, повторное подключение отклонено")
+            writer.close()
+            return
+        self._workers[worker.worker_id] = worker
+        self.ring.add(worker.worker_id)
+        logger.info(f"Воркер {worker.worker_id} добавлен, воркеров: {len(self.ring)}")
+        await self._drain_pending()
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message is None:
+                    break
+                if message['type'] == 'stats':
+                    worker.stats = message
+                elif message['type'] == 'leave':
+                    # Сначала убираем из кольца, потом подтверждаем: после bye обновлений воркеру не будет
+                    self._remove(worker)
+                    await write_frame(writer, {'type': 'bye'})
+                    break
+        except (ConnectionError, ValueError) as e:
+            logger.error(f"Ошибка соединения с воркером {worker.worker_id}: {e}")
+        finally:
+            self._remove(worker)
+            writer.close()
+
+    def _remove(self, worker: _WorkerConnection):
+        if self._workers.get(worker.worker_id) is worker:
+            del self._workers[worker.worker_id]
+            self.ring.remove(worker.worker_id)
+            logger.info(f"Воркер {worker.worker_id} удалён, отправлено ему: {worker.routed}, воркеров: {len(self.ring)}")
+
+    async def route(self, update: Update):
+        """Отправка обновления воркеру-владельцу его чата"""
+        await self._send(shard_key(update), update.to_dict())
+
+    async def _send(self, key: str, payload: dict):
+        while True:
+            worker_id = self.ring.get(key)
+            if worker_id is None:
+                if len(self._pending) == self._pending.maxlen:
+                    self.dropped += 1
+                self._pending.append((key, payload))
+                return
+            worker = self._workers[worker_id]
+            try:
+                await write_frame(worker.writer, {'type': 'update', 'update': payload})
+                worker.routed += 1
+                return
+            except ConnectionError as e:
+                # Воркер упал: убираем его и отдаём обновление следующему владельцу ключа
+                logger.error(f"Воркер {worker_id} недоступен: {e}")
+                self._remove(worker)
+
+    async def _drain_pending(self):
+        """Отправка накопленных без воркеров обновлений"""
+        while self._pending and len(self.ring):
+            key, payload = self._pending.popleft()
+            await self._send(key, payload)
+
+    def stats(self) -> List[Dict[str, float]]:
+        """Пропускная способность по воркерам: отправлено ingress и обработано по отчёту воркера"""
+        return [
+            {
+                'worker': worker.worker_id,
+                'routed': worker.routed,
+                'processed': worker.stats.get('processed', 0),
+                'rate': worker.stats.get('rate', 0.0),
+                'queue': worker.stats.get('queue', 0)
+            }
+            for worker in self._workers.values()
+        ]
+
+    async def close(self):
+        """Остановка приёма воркеров"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for worker in list(self._workers.values()):
+            worker.writer.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+async def spawn_workers(count: int, socket_path: str) -> List[asyncio.subprocess.Process]:
+    """
+    Запуск воркеров echo_bot.py локальными процессами. При METRICS_PORT воркер index получает
+    порт METRICS_PORT + index - иначе все воркеры заняли бы один порт
+    """
+    processes = []
+    metrics_port = int(os.getenv('METRICS_PORT', '0'))
+    for index in range(count):
+        env = dict(os.environ, BOT_MODE='worker', WORKER_ID=f"worker-{index}", WORKER_SOCKET=socket_path)
+        if metrics_port > 0:
+            env['METRICS_PORT'] = str(metrics_port + index)
+        processes.append(await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'echo_bot.py'),
+            env=env
+        ))
+    return processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingress: приём обновлений и распределение по воркерам')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SHARD_WORKERS', '0')),
+                        help='сколько воркеров запустить локально (0 - воркеры запускаются отдельно)')
+    parser.add_argument('--socket', default=os.getenv('WORKER_SOCKET', '/tmp/agentzero-ingress.sock'),
+                        help='Unix-сокет для подключения воркеров')
+    args = parser.parse_args()
+
+    if os.getenv('DATABASE_BACKEND', 'json') != 'sqlite':
+        # JSON-хранилищем владеет один процесс, воркерам нужна общая база
+        raise SystemExit("Для шардирования по воркерам нужен DATABASE_BACKEND=sqlite")
+
+    router = ShardRouter(
+        args.socket,
+        replicas=int(os.getenv('SHARD_RING_REPLICAS', '160')),
+        max_pending=int(os.getenv('SHARD_MAX_PENDING', '10000'))
+    )
+    stats_interval = float(os.getenv('SHARD_STATS_INTERVAL_S', '60'))
+    processes: List[asyncio.subprocess.Process] = []
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(stats_interval)
+            for row in router.stats():
+                logger.info(f"Воркер {row['worker']}: отправлено {row['routed']}, обработано {row['processed']}, "
+                            f"{row['rate']}/с, в очереди {row['queue']}")
+            if router.dropped:
+                logger.warning(f"Отброшено обновлений без воркеров: {router.dropped}")
+
+    async def post_init(application: Application):
+        await router.start()
+        processes.extend(await spawn_workers(args.workers, args.socket))
+        application.create_task(report_stats())
+
+    async def post_shutdown(application: Application):
+        # Воркеры получают SIGTERM, сами выходят из кольца и дообрабатывают полученное
+        for process in processes:
+            if process.returncode is None:
+                process.terminate()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in processes)), timeout=30)
+        except asyncio.TimeoutError:
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+        await router.close()
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await router.route(update)
+
+    application = (
+        Application.builder()
+        .token(os.environ['TELEGRAM_BOT_TOKEN'])
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, forward))
+
+    bot_mode = os.getenv('BOT_MODE', 'polling')
+    logger.info(f"Ingress запущен (режим: {bot_mode}, локальных воркеров: {args.workers})")
+    if bot_mode == 'webhook':
+        webhook_path = os.getenv('WEBHOOK_PATH', 'telegram')
+        webhook_secret_token = os.getenv('WEBHOOK_SECRET_TOKEN')
+        if not webhook_secret_token:
+            raise ValueError("Для режима webhook нужен WEBHOOK_SECRET_TOKEN")
+        application.run_webhook(
+            listen=os.getenv('WEBHOOK_LISTEN', '127.0.0.1'),
+            port=int(os.getenv('WEBHOOK_PORT', '8443')),
+            url_path=webhook_path,
+            webhook_url=f"{os.environ['WEBHOOK_URL'].rstrip('/')}/{webhook_path}",
+            secret_token=webhook_secret_token,
+            max_connections=int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40')),
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+if __name__ == '__main__':
+    main()
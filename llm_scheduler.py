@@ -0,0 +1,258 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from prompt_builder import count_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_request_tokens(message: str, context: Optional[list] = None, max_tokens: int = 150,
+                            knowledge: Optional[List[str]] = None) -> int:
+    """Оценка токенов запроса (подсчёт мемоизирован) плюс резерв на ответ"""
+    tokens = count_tokens(message) + sum(count_tokens(item.get('content', '')) for item in context or ())
+    tokens += sum(count_tokens(post) for post in knowledge or ())
+    return tokens + max_tokens
+
+
+class SchedulerQueueFull(Exception):
+    """Запрос отброшен, потому что очередь переполнена"""
+
+
+class TokenBucket:
+    """Корзина токенов: rate_per_minute единиц в минуту, не больше capacity сразу"""
+
+    def __init__(self, rate_per_minute: float, capacity: float = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Сколько секунд ждать, пока в корзине наберётся amount (0 - можно сейчас)"""
+        self._refill()
+        # Запрос больше ёмкости корзины пропускаем, когда она полная, иначе он не пройдёт никогда
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        """Списание amount из корзины"""
+        self.tokens -= min(amount, self.capacity)
+
+
+class _Job:
+    __slots__ = ('owner_key', 'channel_id', 'factory', 'tokens', 'future', 'enqueued_at')
+
+    def __init__(self, owner_key: str, channel_id: str, factory: Callable[[], Awaitable[Any]],
+                 tokens: int, future: asyncio.Future):
+        self.owner_key = owner_key
+        self.channel_id = channel_id
+        self.factory = factory
+        self.tokens = tokens
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+class LLMScheduler:
+    """
+    Планировщик запросов к LLM между handle_channel_message и OpenAIClient.
+
+    - для каждого ключа владельца - корзины токенов на запросы/мин и токены/мин;
+    - общий лимит одновременных запросов;
+    - очереди по каналам с ограниченной длиной, каналы обслуживаются по кругу,
+      поэтому один шумный канал не задерживает остальные;
+    - при переполнении: overflow_policy='drop_new' отбрасывает новый запрос,
+      'drop_oldest' - самый старый запрос того же канала (или самой длинной очереди).
+    """
+
+    def __init__(self, max_concurrency: int = 16, requests_per_minute: float = 60,
+                 tokens_per_minute: float = 40000, max_queue: int = 1000,
+                 max_queue_per_channel: int = 50, overflow_policy: str = 'drop_new'):
+        if overflow_policy not in ('drop_new', 'drop_oldest'):
+            raise ValueError(f"Неизвестная политика переполнения: {overflow_policy}")
+        # Без места в очереди drop_oldest нечего вытеснять, а drop_new отбрасывал бы всё
+        if max_queue < 1 or max_queue_per_channel < 1:
+            raise ValueError("max_queue и max_queue_per_channel должны быть не меньше 1")
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.max_queue_per_channel = max_queue_per_channel
+        self.overflow_policy = overflow_policy
+        self._queues: Dict[str, Deque[_Job]] = {}
+        # Каналы с ожидающими запросами в порядке обхода по кругу
+        self._ring: Deque[str] = deque()
+        self._buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self._queued = 0
+        self._in_flight = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'dropped': 0}
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    async def submit(self, owner_key: str, channel_id, factory: Callable[[], Awaitable[Any]],
+                     estimated_tokens: int = 0) -> Any:
+        """
+        Постановка запроса в очередь. factory вызывается, когда лимиты позволяют,
+        и возвращает корутину запроса. Бросает SchedulerQueueFull, если запрос отброшен
+        """
+        self._ensure_started()
+        channel_id = str(channel_id)
+        job = _Job(owner_key, channel_id, factory, estimated_tokens, asyncio.get_running_loop().create_future())
+        queue = self._queues.get(channel_id)
+        if queue is not None and len(queue) >= self.max_queue_per_channel:
+            self._overflow(job, queue)
+        elif self._queued >= self.max_queue:
+            self._overflow(job, max(self._queues.values(), key=len))
+        if job.future.done():
+            self._counters['dropped'] += 1
+            return job.future.result()
+        queue = self._queues.get(channel_id)
+        if queue is None:
+            queue = self._queues[channel_id] = deque()
+            self._ring.append(channel_id)
+        queue.append(job)
+        self._queued += 1
+        self._counters['submitted'] += 1
+        self._wakeup.set()
+        return await job.future
+
+    def _overflow(self, job: _Job, queue: Deque[_Job]):
+        """Применение политики переполнения"""
+        if self.overflow_policy == 'drop_new':
+            job.future.set_exception(SchedulerQueueFull(f"очередь канала {job.channel_id} переполнена"))
+            return
+        oldest = queue.popleft()
+        self._queued -= 1
+        self._counters['dropped'] += 1
+        if not queue:
+            del self._queues[oldest.channel_id]
+            self._ring.remove(oldest.channel_id)
+        if not oldest.future.done():
+            oldest.future.set_exception(SchedulerQueueFull(f"запрос вытеснен из очереди канала {oldest.channel_id}"))
+
+    def _ensure_started(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch_loop())
+
+    def _owner_buckets(self, owner_key: str) -> Tuple[TokenBucket, TokenBucket]:
+        buckets = self._buckets.get(owner_key)
+        if buckets is None:
+            buckets = self._buckets[owner_key] = (
+                TokenBucket(self.requests_per_minute),
+                TokenBucket(self.tokens_per_minute)
+            )
+        return buckets
+
+    def _next_job(self) -> Tuple[Optional[_Job], Optional[float]]:
+        """Выбор следующего запроса по кругу среди каналов, чьи владельцы не упёрлись в лимиты"""
+        min_delay = None
+        for _ in range(len(self._ring)):
+            channel_id = self._ring[0]
+            self._ring.rotate(-1)
+            queue = self._queues[channel_id]
+            job = queue[0]
+            requests_bucket, tokens_bucket = self._owner_buckets(job.owner_key)
+            delay = max(requests_bucket.wait_time(1), tokens_bucket.wait_time(job.tokens))
+            if delay > 0:
+                min_delay = delay if min_delay is None else min(min_delay, delay)
+                continue
+            requests_bucket.consume(1)
+            tokens_bucket.consume(job.tokens)
+            queue.popleft()
+            self._queued -= 1
+            if not queue:
+                del self._queues[channel_id]
+                self._ring.remove(channel_id)
+            return job, None
+        return None, min_delay
+
+    async def _dispatch_loop(self):
+        while True:
+            await self._slots.acquire()
+            while True:
+                self._wakeup.clear()
+                job, delay = self._next_job()
+                if job is not None:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            if job.future.done():
+                # Отправитель уже не ждёт ответа
+                self._slots.release()
+                continue
+            asyncio.get_running_loop().create_task(self._run(job))
+
+    async def _run(self, job: _Job):
+        wait = time.monotonic() - job.enqueued_at
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        self._in_flight += 1
+        try:
+            result = await job.factory()
+        except asyncio.CancelledError:
+            # Задачу отменили (остановка цикла): отправитель не должен ждать вечно
+            self._counters['failed'] += 1
+            if not job.future.done():
+                job.future.cancel()
+            raise
+        except BaseException as e:
+            self._counters['failed'] += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            self._counters['completed'] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+
+    def queue_depth(self, channel_id=None) -> int:
+        """Глубина очереди канала или общая"""
+        if channel_id is None:
+            return self._queued
+        queue = self._queues.get(str(channel_id))
+        return len(queue) if queue else 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Снимок состояния планировщика для мониторинга"""
+        started = self._counters['completed'] + self._counters['failed'] + self._in_flight
+        return {
+            **self._counters,
+            'queued': self._queued,
+            'in_flight': self._in_flight,
+            'channels_waiting': len(self._ring),
+            'avg_wait_s': self._wait_total / started if started else 0.0,
+            'max_wait_s': self._wait_max
+        }
+
+    async def close(self):
+        """Остановка диспетчера; ожидающие запросы отменяются"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for queue in self._queues.values():
+            for job in queue:
+                if not job.future.done():
+                    job.future.cancel()
+        self._queues.clear()
+        self._ring.clear()
+        self._queued = 0
@@ -0,0 +1,190 @@
+import logging
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Уровни моделей: быстрый/дешёвый для простых комментариев и полная модель канала для сложных
+TIERS = ('fast', 'full')
+
+# Ориентировочная цена модели, долларов за 1000 токенов (вход и выход вместе) - для сравнения уровней
+PRICE_PER_1K_TOKENS = {
+    'gpt-4o-mini': 0.0004,
+    'gpt-3.5-turbo': 0.001,
+    'gpt-4o': 0.0075,
+    'gpt-4-turbo': 0.02,
+    'gpt-4': 0.045,
+}
+DEFAULT_PRICE_PER_1K_TOKENS = 0.01
+
+# Настройки по умолчанию; канал переопределяет их в assistant_settings['routing']
+DEFAULT_ROUTING_SETTINGS = {
+    # Маршрутизация меняет модель канала, поэтому по умолчанию включается только самим каналом
+    'enabled': False,
+    'fast_model': 'gpt-4o-mini',
+    # Модель сложных комментариев; None - модель канала
+    'full_model': None,
+    # Сумма признаков сложности, начиная с которой комментарий уходит полной модели
+    'threshold': 3,
+    # max_tokens быстрого уровня: база, прибавка за слово комментария и за вопрос
+    'min_tokens': 40,
+    'tokens_per_word': 4,
+    'tokens_per_question': 40,
+    # 'fast' или 'full' - всегда один уровень
+    'force_tier': None,
+}
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+_QUESTION_WORDS_RE = re.compile(
+    r'\b(?:как|почему|зачем|что|когда|где|куда|откуда|сколько|какой|какая|какие|каким|чем|кто|ли|можно|'
+    r'how|why|what|when|where|which|who|can|could|should)\b',
+    re.IGNORECASE
+)
+# Признаки технического вопроса: код, числа с единицами, команды и пути
+_TECHNICAL_RE = re.compile(r'`|\b\d+(?:[.,]\d+)?\s*(?:%|мб|гб|мс|ms|gb|mb|px)\b|\b\w+\(\)|/\w+/|\w+\.\w{2,4}\b',
+                           re.IGNORECASE)
+_CYRILLIC_RE = re.compile(r'[а-яё]', re.IGNORECASE)
+_LATIN_RE = re.compile(r'[a-z]', re.IGNORECASE)
+
+ROUTED_SECONDS = registry.histogram('llm_request_seconds', 'Время запроса к OpenAI по уровню модели', ('tier',))
+ROUTED_TOKENS = registry.counter('llm_tokens_total', 'Токены OpenAI по уровню модели', ('tier',))
+ROUTED_COST = registry.counter('llm_cost_usd_total', 'Оценка стоимости запросов OpenAI по уровню модели, $', ('tier',))
+
+
+class RouteDecision:
+    """Выбранный уровень, модель и max_tokens на один комментарий"""
+
+    __slots__ = ('tier', 'model', 'max_tokens', 'score')
+
+    def __init__(self, tier: str, model: str, max_tokens: int, score: int):
+        self.tier = tier
+        self.model = model
+        self.max_tokens = max_tokens
+        self.score = score
+
+    def __repr__(self):
+        return f"RouteDecision({self.tier}, {self.model}, max_tokens={self.max_tokens}, score={self.score})"
+
+
+def complexity_score(text: str, topic_matcher=None) -> int:
+    """
+    Локальная оценка сложности комментария без запросов к API: длина, вопросы,
+    вопросительные слова, технические признаки, совпадение с темами канала, язык
+    """
+    words = len(_WORD_RE.findall(text))
+    score = 0
+    if words > 8:
+        score += 1
+    if words > 25:
+        score += 2
+    questions = text.count('?')
+    if questions:
+        score += 1
+    if questions > 1:
+        score += 1
+    if _QUESTION_WORDS_RE.search(text):
+        score += 1
+    if _TECHNICAL_RE.search(text):
+        score += 1
+    if topic_matcher is not None and topic_matcher.search(text) is not None:
+        score += 1
+    # Не русский и не английский текст быстрые модели понимают хуже - сразу до порога по умолчанию
+    letters = sum(1 for char in text if char.isalpha())
+    if letters >= 10:
+        known = len(_CYRILLIC_RE.findall(text)) + len(_LATIN_RE.findall(text))
+        if known / letters < 0.7:
+            score += 3
+    return score
+
+
+class ModelRouter:
+    """
+    Маршрутизация комментариев по уровням моделей: простые ("спасибо!", короткие реплики) идут
+    быстрой дешёвой модели с max_tokens по размеру комментария, сложные - модели канала с её max_tokens.
+    Ведёт по уровням учёт запросов, ошибок, задержки, токенов и оценки стоимости.
+    enabled - значение по умолчанию для каналов; канал включает или выключает маршрутизацию
+    через routing['enabled'] в своих настройках
+    """
+
+    def __init__(self, enabled: bool = False, **defaults):
+        self.defaults = dict(DEFAULT_ROUTING_SETTINGS, enabled=enabled, **defaults)
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, float]] = {
+            tier: {'requests': 0, 'errors': 0, 'seconds': 0.0, 'tokens': 0, 'cost_usd': 0.0} for tier in TIERS
+        }
+
+    def _settings(self, channel_settings: Dict[str, Any], profile=None) -> Dict[str, Any]:
+        if profile is not None:
+            overrides = profile.routing
+        else:
+            overrides = channel_settings.get('assistant_settings', {}).get('routing') or {}
+        return dict(self.defaults, **overrides) if overrides else self.defaults
+
+    def route(self, comments: List[str], channel_settings: Dict[str, Any], profile,
+              model: str, max_tokens: int) -> Optional[RouteDecision]:
+        """
+        Уровень для запроса с одним или несколькими комментариями (пакет уходит полной модели,
+        если сложен хотя бы один комментарий). max_tokens - на один комментарий и не больше заданного каналом.
+        None - маршрутизация выключена, запрос идёт как настроен канал
+        """
+        settings = self._settings(channel_settings, profile)
+        if not settings['enabled']:
+            return None
+        topic_matcher = profile.topic_matcher if profile is not None else None
+        scores = [complexity_score(comment, topic_matcher) for comment in comments]
+        score = max(scores) if scores else 0
+
+        tier = settings['force_tier'] or ('full' if score >= settings['threshold'] else 'fast')
+        if tier == 'full':
+            return RouteDecision('full', settings['full_model'] or model, max_tokens, score)
+        sized = max(
+            settings['min_tokens']
+            + settings['tokens_per_word'] * len(_WORD_RE.findall(comment))
+            + settings['tokens_per_question'] * comment.count('?')
+            for comment in comments
+        ) if comments else settings['min_tokens']
+        return RouteDecision('fast', settings['fast_model'], min(sized, max_tokens), score)
+
+    def record(self, decision: Optional[RouteDecision], seconds: float, tokens: Optional[int], error: bool = False):
+        """Учёт завершённого запроса по уровню"""
+        if decision is None:
+            return
+        cost = (tokens or 0) / 1000 * price_per_1k_tokens(decision.model)
+        with self._lock:
+            stats = self.stats[decision.tier]
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            if error:
+                stats['errors'] += 1
+            if tokens:
+                stats['tokens'] += tokens
+                stats['cost_usd'] += cost
+        ROUTED_SECONDS.observe(seconds, decision.tier)
+        if tokens:
+            ROUTED_TOKENS.inc(decision.tier, amount=tokens)
+            ROUTED_COST.inc(decision.tier, amount=cost)
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """Сводка по уровням: запросы, ошибки, средняя задержка, токены и стоимость"""
+        with self._lock:
+            return {
+                tier: {
+                    'requests': stats['requests'],
+                    'errors': stats['errors'],
+                    'avg_latency_s': round(stats['seconds'] / stats['requests'], 3) if stats['requests'] else 0.0,
+                    'tokens': stats['tokens'],
+                    'cost_usd': round(stats['cost_usd'], 6)
+                }
+                for tier, stats in self.stats.items()
+            }
+
+
+def price_per_1k_tokens(model: str) -> float:
+    """Цена модели по самому длинному совпадающему префиксу имени"""
+    for name in sorted(PRICE_PER_1K_TOKENS, key=len, reverse=True):
+        if model.startswith(name):
+            return PRICE_PER_1K_TOKENS[name]
+    return DEFAULT_PRICE_PER_1K_TOKENS
@@ -1,69 +1,295 @@
-import openai
-from typing import Dict, Any, Optional
+import asyncio
+import json
+import time
+from channel_profile import build_system_prompt
+from prompt_builder import DEFAULT_INPUT_TOKEN_BUDGET, build_messages, count_tokens
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, Any, List, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Ответ, который получает пользователь при ошибке генерации (не кэшируется)
+ERROR_REPLY = "Извините, произошла ошибка при генерации ответа. Пожалуйста, попробуйте позже."
+
+class _ReleasingStream:
+    """Поток фрагментов ответа, который держит слот клиента с момента создания до aclose() или конца потока"""
+
+    def __init__(self, chunks: AsyncIterator[str], release: Callable[[], Awaitable[None]]):
+        self._chunks = chunks
+        self._release = release
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            # Конец потока или ошибка: генератор уже завершён, слот больше не нужен
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if self._release is None:
+            return
+        release, self._release = self._release, None
+        try:
+            await self._chunks.aclose()
+        finally:
+            await release()
+
+
 class OpenAIClient:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, timeout: float = 30.0, connect_timeout: float = 5.0,
+                 max_retries: int = 1, max_connections: int = 20, keepalive_expiry: float = 60.0,
+                 router=None):
+        """
+        Асинхронный клиент с собственным пулом HTTP-соединений (keep-alive) и таймаутами.
+        Ключ хранится в самом клиенте, а не в глобальном openai.api_key, поэтому клиенты
+        разных владельцев каналов не мешают друг другу.
+        router - ModelRouter: выбор уровня модели и max_tokens по сложности комментария
+        """
+        # openai и httpx тяжёлые при импорте и нужны только с первым запросом - не задерживаем ими запуск бота
+        import httpx
+        from openai import AsyncOpenAI
         self.api_key = api_key
-        openai.api_key = api_key
+        self.router = router
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            timeout=httpx.Timeout(timeout, connect=connect_timeout),
+            max_retries=max_retries,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                    keepalive_expiry=keepalive_expiry
+                )
+            )
+        )
+        self._in_flight = 0
+        self._close_when_idle = False
+        self._closed = False
+
+    @staticmethod
+    def _request_params(channel_settings: Dict[str, Any], profile=None):
+        """Системный промпт и параметры модели: из скомпилированного профиля канала или из настроек"""
+        if profile is not None:
+            return (profile.system_prompt, profile.model, profile.temperature, profile.max_tokens,
+                    profile.input_token_budget)
+        assistant_settings = channel_settings.get('assistant_settings', {})
+        return (
+            build_system_prompt(assistant_settings),
+            assistant_settings.get('model', 'gpt-3.5-turbo'),
+            assistant_settings.get('temperature', 0.7),
+            assistant_settings.get('max_tokens', 150),
+            assistant_settings.get('input_token_budget', DEFAULT_INPUT_TOKEN_BUDGET)
+        )
 
-    def generate_response(self, 
-                         message: str, 
+    def _route(self, comments: List[str], channel_settings: Dict[str, Any], profile, model: str, max_tokens: int):
+        """Модель, max_tokens на комментарий и решение маршрутизатора (None - без маршрутизации)"""
+        if self.router is None:
+            return model, max_tokens, None
+        decision = self.router.route(comments, channel_settings, profile, model, max_tokens)
+        if decision is None:
+            return model, max_tokens, None
+        return decision.model, decision.max_tokens, decision
+
+    async def generate_response(self,
+                         message: str,
                          channel_settings: Dict[str, Any],
-                         context: Optional[list] = None) -> str:
+                         context: Optional[list] = None,
+                         profile=None,
+                         on_usage: Optional[Callable[[int], None]] = None,
+                         knowledge: Optional[List[str]] = None) -> str:
         """
-        Генерация ответа на сообщение с учетом настроек канала и контекста
+        Генерация ответа на сообщение с учетом настроек канала и контекста.
+        profile - ChannelProfile канала, чтобы не собирать промпт и параметры заново,
+        on_usage(total_tokens) - учёт потраченных токенов,
+        knowledge - найденные посты канала по теме сообщения
         """
+        self._in_flight += 1
+        decision = None
+        started = time.perf_counter()
         try:
-            assistant_settings = channel_settings.get('assistant_settings', {})
-            
-            # Формируем системный промпт
-            system_prompt = assistant_settings.get('system_prompt', 
-                'Ты - дружелюбный ассистент, который отвечает на сообщения в Telegram канале. '
-                'Отвечай кратко и по существу. Используй контекст предыдущих сообщений для более релевантных ответов.')
-            
-            # Добавляем ограничения по темам и словам
-            allowed_topics = assistant_settings.get('allowed_topics', [])
-            forbidden_words = assistant_settings.get('forbidden_words', [])
-            
-            if allowed_topics:
-                system_prompt += f"\nОтвечай только на темы: {', '.join(allowed_topics)}"
-            if forbidden_words:
-                system_prompt += f"\nНе используй слова: {', '.join(forbidden_words)}"
-            
-            # Формируем сообщения для контекста
-            messages = [{"role": "system", "content": system_prompt}]
-            
-            # Добавляем предыдущие сообщения из контекста
-            if context:
-                messages.extend(context)
-            
-            # Добавляем текущее сообщение
-            messages.append({"role": "user", "content": message})
-            
-            # Генерируем ответ
-            response = openai.ChatCompletion.create(
-                model=assistant_settings.get('model', 'gpt-3.5-turbo'),
+            system_prompt, model, temperature, max_tokens, input_token_budget = self._request_params(channel_settings, profile)
+            model, max_tokens, decision = self._route([message], channel_settings, profile, model, max_tokens)
+
+            # Формируем сообщения: промпт, посты канала, контекст и текущее сообщение в пределах бюджета токенов
+            messages = build_messages(system_prompt, message, context, model, max_tokens, input_token_budget, knowledge)
+
+            # Генерируем ответ, не блокируя цикл событий
+            response = await self.client.chat.completions.create(
+                model=model,
                 messages=messages,
-                temperature=assistant_settings.get('temperature', 0.7),
-                max_tokens=assistant_settings.get('max_tokens', 150)
+                temperature=temperature,
+                max_tokens=max_tokens
             )
-            
+            self._report_usage(response, on_usage)
+            self._record_route(decision, started, response)
+
             return response.choices[0].message.content.strip()
-            
+
         except Exception as e:
             logger.error(f"Ошибка при генерации ответа: {e}")
-            return "Извините, произошла ошибка при генерации ответа. Пожалуйста, попробуйте позже."
+            self._record_route(decision, started, error=True)
+            return ERROR_REPLY
+        finally:
+            await self._release()
+
+    def stream_response(self,
+                        message: str,
+                        channel_settings: Dict[str, Any],
+                        context: Optional[list] = None,
+                        profile=None,
+                        knowledge: Optional[List[str]] = None) -> AsyncIterator[str]:
+        """
+        Потоковая генерация ответа: фрагменты текста отдаются по мере поступления.
+        Ошибки не подменяются ERROR_REPLY, а пробрасываются вызывающему коду;
+        при досрочном закрытии (aclose) поток к OpenAI закрывается.
+        Слот клиента занимается сразу при вызове, а не с первой итерации: вытесненный из реестра
+        клиент не закроется, пока созданный поток не дочитан или не закрыт
+        """
+        self._in_flight += 1
+        return _ReleasingStream(self._stream(message, channel_settings, context, profile, knowledge), self._release)
+
+    async def _stream(self, message: str, channel_settings: Dict[str, Any], context: Optional[list],
+                      profile, knowledge: Optional[List[str]]) -> AsyncIterator[str]:
+        decision = None
+        started = time.perf_counter()
+        prompt_tokens = completion_tokens = 0
+        failed = True
+        try:
+            system_prompt, model, temperature, max_tokens, input_token_budget = self._request_params(channel_settings, profile)
+            model, max_tokens, decision = self._route([message], channel_settings, profile, model, max_tokens)
+            messages = build_messages(system_prompt, message, context, model, max_tokens, input_token_budget, knowledge)
+            # Потоковый ответ приходит без usage - токены считаем локально
+            if decision is not None:
+                prompt_tokens = sum(count_tokens(item['content']) for item in messages)
+
+            stream = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if decision is not None:
+                            completion_tokens += count_tokens(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+                failed = False
+            finally:
+                await stream.close()
+        finally:
+            if decision is not None and self.router is not None:
+                self.router.record(decision, time.perf_counter() - started,
+                                   prompt_tokens + completion_tokens, error=failed)
 
-    def validate_api_key(self) -> bool:
+    async def generate_batch_responses(self,
+                                       comments: List[str],
+                                       channel_settings: Dict[str, Any],
+                                       context: Optional[list] = None,
+                                       profile=None,
+                                       on_usage: Optional[Callable[[int], None]] = None,
+                                       knowledge: Optional[List[str]] = None) -> List[str]:
+        """
+        Ответы на несколько комментариев одного чата одним запросом: системный промпт и контекст
+        передаются один раз. Если ответ модели не удалось разобрать, отвечаем на каждый комментарий отдельно
+        """
+        if len(comments) == 1:
+            return [await self.generate_response(comments[0], channel_settings, context, profile, on_usage, knowledge)]
+
+        # Слот держится и на время ответов по отдельности: клиент не закроется посреди них
+        self._in_flight += 1
+        try:
+            return await self._generate_batch(comments, channel_settings, context, profile, on_usage, knowledge)
+        finally:
+            await self._release()
+
+    async def _generate_batch(self, comments: List[str], channel_settings: Dict[str, Any], context: Optional[list],
+                              profile, on_usage: Optional[Callable[[int], None]],
+                              knowledge: Optional[List[str]]) -> List[str]:
+        decision = None
+        started = time.perf_counter()
+        try:
+            system_prompt, model, temperature, max_tokens, input_token_budget = self._request_params(channel_settings, profile)
+            # Пакет уходит полной модели, если сложен хотя бы один комментарий
+            model, max_tokens, decision = self._route(comments, channel_settings, profile, model, max_tokens)
+            numbered = '\n'.join(f"{i}. {comment}" for i, comment in enumerate(comments, 1))
+            messages = build_messages(
+                system_prompt,
+                f"Ответь отдельно на каждый из {len(comments)} комментариев ниже. "
+                f"Верни только JSON-массив из {len(comments)} строк - ответы в том же порядке, без нумерации.\n\n"
+                f"{numbered}",
+                context, model, max_tokens * len(comments), input_token_budget, knowledge
+            )
+
+            response = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens * len(comments)
+            )
+            self._report_usage(response, on_usage)
+            self._record_route(decision, started, response)
+            replies = self._parse_batch_replies(response.choices[0].message.content, len(comments))
+        except Exception as e:
+            logger.error(f"Ошибка при пакетной генерации ответов: {e}")
+            self._record_route(decision, started, error=True)
+            replies = None
+
+        if replies is not None:
+            return replies
+        logger.warning("Не удалось разобрать пакетный ответ, отвечаем на комментарии по отдельности")
+        return list(await asyncio.gather(*(
+            self.generate_response(comment, channel_settings, context, profile, on_usage, knowledge) for comment in comments
+        )))
+
+    @staticmethod
+    def _report_usage(response, on_usage: Optional[Callable[[int], None]]):
+        """Передача числа потраченных токенов из ответа API"""
+        usage = getattr(response, 'usage', None)
+        if on_usage is not None and usage is not None:
+            on_usage(usage.total_tokens)
+
+    def _record_route(self, decision, started: float, response=None, error: bool = False):
+        """Учёт задержки и токенов запроса по уровню модели"""
+        if decision is None or self.router is None:
+            return
+        usage = getattr(response, 'usage', None)
+        self.router.record(decision, time.perf_counter() - started,
+                           usage.total_tokens if usage is not None else None, error=error)
+
+    @staticmethod
+    def _parse_batch_replies(content: str, expected: int) -> Optional[List[str]]:
+        """Разбор JSON-массива ответов; None, если формат не совпал"""
+        content = content.strip()
+        # Модели иногда оборачивают JSON в блок кода
+        if content.startswith('```'):
+            content = content.strip('`')
+            if content.startswith('json'):
+                content = content[len('json'):]
+        try:
+            replies = json.loads(content)
+        except ValueError:
+            return None
+        if not isinstance(replies, list) or len(replies) != expected:
+            return None
+        if not all(isinstance(reply, str) and reply.strip() for reply in replies):
+            return None
+        return [reply.strip() for reply in replies]
+
+    async def validate_api_key(self) -> bool:
         """
         Проверка валидности API ключа
         """
+        self._in_flight += 1
         try:
             # Пробуем сделать тестовый запрос
-            openai.ChatCompletion.create(
+            await self.client.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[{"role": "user", "content": "test"}],
                 max_tokens=5
@@ -71,4 +297,60 @@ class OpenAIClient:
             return True
         except Exception as e:
             logger.error(f"Ошибка валидации API ключа: {e}")
-            return False 
\ No newline at end of file
+            return False
+        finally:
+            await self._release()
+
+    async def _release(self):
+        """Завершение запроса; клиент, вытесненный из реестра, закрывается после последнего запроса"""
+        self._in_flight -= 1
+        if self._close_when_idle and self._in_flight == 0:
+            await self.close()
+
+    async def close(self):
+        """Закрытие пула соединений клиента"""
+        if not self._closed:
+            self._closed = True
+            await self.client.close()
+
+
+class OpenAIClientRegistry:
+    """
+    Ограниченный LRU-реестр клиентов по ключу API: клиент владельца создаётся один раз
+    и переиспользует keep-alive соединения для всех его каналов.
+    """
+
+    def __init__(self, max_clients: int = 256, **client_options):
+        self.max_clients = max_clients
+        self.client_options = client_options
+        self._clients: 'OrderedDict[str, OpenAIClient]' = OrderedDict()
+
+    def get(self, api_key: str) -> OpenAIClient:
+        """Получение (или создание) клиента для ключа"""
+        client = self._clients.get(api_key)
+        if client is not None:
+            self._clients.move_to_end(api_key)
+            return client
+        client = OpenAIClient(api_key, **self.client_options)
+        self._clients[api_key] = client
+        while len(self._clients) > self.max_clients:
+            _, evicted = self._clients.popitem(last=False)
+            self._evict(evicted)
+        return client
+
+    def _evict(self, client: OpenAIClient):
+        """Закрытие вытесненного клиента: сразу, если он простаивает, иначе после его запросов"""
+        if client._in_flight:
+            client._close_when_idle = True
+        else:
+            asyncio.get_running_loop().create_task(client.close())
+
+    def __len__(self):
+        return len(self._clients)
+
+    async def close(self):
+        """Закрытие всех клиентов (при остановке бота)"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.close()
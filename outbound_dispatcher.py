@@ -0,0 +1,290 @@
+import asyncio
+import logging
+import math
+from collections import deque
+from typing import Any, Callable, Coroutine, Deque, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Полосы в порядке приоритета: меню и мастер в личных чатах идут раньше массовых ответов в группах
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+LANES = (INTERACTIVE, BULK)
+
+OUTBOUND_REQUESTS = registry.counter(
+    'telegram_outbound_total',
+    'Исходящие запросы к Bot API: delivered, retried (RetryAfter), throttled (drop_if_limited), dropped', ('lane', 'result')
+)
+OUTBOUND_WAIT_SECONDS = registry.histogram(
+    'telegram_outbound_wait_seconds', 'Ожидание лимитов Telegram перед доставкой, включая повторы', ('lane',)
+)
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """retry_after бывает числом секунд или timedelta в зависимости от версии библиотеки"""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+class Throttled(RetryAfter):
+    """
+    Запрос с drop_if_limited не отправлен: лимит сейчас исчерпан, повторить можно через retry_after секунд
+    (целое число с округлением вверх, как у RetryAfter от Telegram)
+    """
+
+    def __init__(self, wait: float):
+        super().__init__(max(1, math.ceil(wait)))
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity; blocked_until - пауза по retry_after"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 - уже есть)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        """Ведро полное и не на паузе - его можно забыть без потери лимита"""
+        return self.blocked_until <= now and self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class OutboundDispatcher(BaseRateLimiter):
+    """
+    Исходящие запросы к Bot API с учётом лимитов Telegram (подключается через Application.builder().rate_limiter).
+    Запросы с chat_id ждут токен в общем ведре (global_rate в секунду) и в ведре чата: личные чаты -
+    private_rate в секунду, группы и каналы - group_rate в минуту. Ожидающие запросы раздаются по полосам
+    в порядке приоритета, внутри чата - по порядку поступления. RetryAfter не теряет сообщение: чат
+    ставится на паузу на retry_after секунд, а запрос возвращается в начало своей полосы.
+    Запросы без chat_id (getUpdates, answerCallbackQuery и т.п.) лимитами не ограничиваются.
+
+    Полоса выбирается по чату: личный чат - INTERACTIVE, остальные - BULK; rate_limit_args={'lane': ...}
+    в методах бота задаёт её явно. Необязательные запросы (промежуточные правки потокового ответа) передают
+    rate_limit_args={'drop_if_limited': True}: они не ждут в очереди и не повторяются, а при исчерпанном
+    лимите или RetryAfter сразу получают Throttled / RetryAfter
+    """
+
+    def __init__(self, global_rate: float = 30, private_rate: float = 1, private_burst: int = 3,
+                 group_rate: float = 20, group_burst: int = 3, max_tracked_chats: int = 10000):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.private_burst = private_burst
+        self.group_rate = group_rate / 60
+        self.group_burst = group_burst
+        self.max_tracked_chats = max_tracked_chats
+        self._global: Optional[TokenBucket] = None
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        # полоса -> очередь ожидающих: [chat_id, future]
+        self._waiters: Dict[str, Deque[List]] = {lane: deque() for lane in LANES}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump_task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {'delivered': 0, 'retried': 0, 'throttled': 0, 'dropped': 0}
+
+    async def initialize(self) -> None:
+        self._ensure_started()
+
+    async def shutdown(self) -> None:
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            try:
+                await self._pump_task
+            except asyncio.CancelledError:
+                pass
+            self._pump_task = None
+        for waiters in self._waiters.values():
+            while waiters:
+                waiters.popleft()[1].cancel()
+
+    def queue_depth(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def _ensure_started(self):
+        if self._pump_task is None or self._pump_task.done():
+            loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._global = self._global or TokenBucket(self.global_rate, self.global_rate, loop.time())
+            self._pump_task = loop.create_task(self._pump())
+
+    async def process_request(self,
+                              callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]]]]],
+                              args: Any,
+                              kwargs: Dict[str, Any],
+                              endpoint: str,
+                              data: Dict[str, Any],
+                              rate_limit_args: Optional[Dict[str, Any]]) -> Union[bool, Dict[str, Any], List[Dict[str, Any]]]:
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        # В data chat_id может прийти строкой; @username канала так и остаётся строкой
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        rate_limit_args = rate_limit_args or {}
+        lane = rate_limit_args.get('lane') or (INTERACTIVE if self._is_private(chat_id) else BULK)
+        if rate_limit_args.get('drop_if_limited'):
+            return await self._send_if_allowed(callback, args, kwargs, endpoint, chat_id, lane)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        retried = False
+        while True:
+            await self._acquire(lane, chat_id, front=retried)
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                # Временный лимит: сообщение не выбрасываем, а ждём, сколько просит Telegram
+                delay = retry_after_seconds(e)
+                self._chat_bucket(chat_id, loop.time()).blocked_until = loop.time() + delay
+                self.stats['retried'] += 1
+                OUTBOUND_REQUESTS.inc(lane, 'retried')
+                logger.warning(f"{endpoint} в чат {chat_id}: лимит Telegram, повтор через {delay:.1f} с")
+                retried = True
+                continue
+            except Exception:
+                self.stats['dropped'] += 1
+                OUTBOUND_REQUESTS.inc(lane, 'dropped')
+                raise
+            self.stats['delivered'] += 1
+            OUTBOUND_REQUESTS.inc(lane, 'delivered')
+            OUTBOUND_WAIT_SECONDS.observe(loop.time() - started, lane)
+            return result
+
+    async def _send_if_allowed(self, callback, args, kwargs, endpoint: str, chat_id: Union[int, str], lane: str):
+        """Отправка без ожидания: токены есть прямо сейчас и чат никого не ждёт - иначе Throttled"""
+        self._ensure_started()
+        now = asyncio.get_running_loop().time()
+        bucket = self._chat_bucket(chat_id, now)
+        wait = max(self._global.wait_time(now), bucket.wait_time(now))
+        if wait == 0 and self._has_waiters(chat_id):
+            # Очередные сообщения чата идут первыми; место в очереди необязательному запросу не нужно
+            wait = 1 / bucket.rate
+        if wait > 0:
+            self.stats['throttled'] += 1
+            OUTBOUND_REQUESTS.inc(lane, 'throttled')
+            raise Throttled(wait)
+        bucket.take()
+        self._global.take()
+        try:
+            result = await callback(*args, **kwargs)
+        except RetryAfter as e:
+            # Пауза чата действует и на остальные его запросы; этот не повторяем
+            delay = retry_after_seconds(e)
+            bucket.blocked_until = asyncio.get_running_loop().time() + delay
+            self.stats['throttled'] += 1
+            OUTBOUND_REQUESTS.inc(lane, 'throttled')
+            logger.warning(f"{endpoint} в чат {chat_id}: лимит Telegram, запрос пропущен, пауза {delay:.1f} с")
+            raise
+        except Exception:
+            self.stats['dropped'] += 1
+            OUTBOUND_REQUESTS.inc(lane, 'dropped')
+            raise
+        self.stats['delivered'] += 1
+        OUTBOUND_REQUESTS.inc(lane, 'delivered')
+        return result
+
+    def _has_waiters(self, chat_id: Union[int, str]) -> bool:
+        return any(waiter[0] == chat_id and not waiter[1].done()
+                   for waiters in self._waiters.values() for waiter in waiters)
+
+    @staticmethod
+    def _is_private(chat_id: Union[int, str]) -> bool:
+        """Личные чаты - положительные id; группы, каналы и @username - остальные"""
+        return isinstance(chat_id, int) and chat_id > 0
+
+    def _chat_bucket(self, chat_id: Union[int, str], now: float) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_tracked_chats:
+                # Полные ведра простаивающих чатов ничего не ограничивают
+                for idle_chat in [chat for chat, chat_bucket in self._chats.items() if chat_bucket.idle(now)]:
+                    del self._chats[idle_chat]
+            if self._is_private(chat_id):
+                bucket = TokenBucket(self.private_rate, self.private_burst, now)
+            else:
+                bucket = TokenBucket(self.group_rate, self.group_burst, now)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, lane: str, chat_id: Union[int, str], front: bool = False):
+        """Ожидание токенов общего ведра и ведра чата; повтор после RetryAfter встаёт в начало полосы"""
+        self._ensure_started()
+        waiter = [chat_id, asyncio.get_running_loop().create_future()]
+        if front:
+            self._waiters[lane].appendleft(waiter)
+        else:
+            self._waiters[lane].append(waiter)
+        self._wakeup.set()
+        await waiter[1]
+
+    async def _pump(self):
+        """Раздача токенов ожидающим; спит до ближайшего освобождения лимита или нового запроса"""
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            delay = self._grant(loop.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def _grant(self, now: float) -> Optional[float]:
+        """
+        Выдача токенов по полосам в порядке приоритета. Чат, чей первый запрос ждёт, пропускается
+        целиком - порядок сообщений внутри чата сохраняется. Возвращает время до следующей попытки
+        (None - ждать нечего)
+        """
+        next_delay = None
+        for lane in LANES:
+            waiters = self._waiters[lane]
+            if not waiters:
+                continue
+            remaining = deque()
+            waiting_chats = set()
+            while waiters:
+                waiter = waiters.popleft()
+                chat_id, future = waiter
+                if future.done():
+                    # Запрос отменён, пока ждал
+                    continue
+                global_wait = self._global.wait_time(now)
+                if global_wait > 0:
+                    remaining.append(waiter)
+                    remaining.extend(waiters)
+                    waiters.clear()
+                    next_delay = global_wait if next_delay is None else min(next_delay, global_wait)
+                    break
+                if chat_id in waiting_chats:
+                    remaining.append(waiter)
+                    continue
+                bucket = self._chat_bucket(chat_id, now)
+                wait = bucket.wait_time(now)
+                if wait > 0:
+                    waiting_chats.add(chat_id)
+                    remaining.append(waiter)
+                    next_delay = wait if next_delay is None else min(next_delay, wait)
+                    continue
+                bucket.take()
+                self._global.take()
+                future.set_result(None)
+            self._waiters[lane] = remaining
+        return next_delay
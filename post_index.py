@@ -0,0 +1,511 @@
+import heapq
+import logging
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+from array import array
+from collections import Counter, OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import jsoncodec
+
+try:
+    import numpy
+except ImportError:  # NumPy не обязателен, без него оценки считаются в цикле
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Параметры BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Слияние сегментов, когда устаревших постов сверх max_posts набирается на эту долю max_posts:
+# иначе после заполнения индекса каждая запись сегмента переписывала бы все max_posts постов
+COMPACT_DEAD_RATIO = 0.25
+
+# Журнал постов сегмента в памяти: восстанавливается при открытии, очищается записью сегмента
+LIVE_LOG_NAME = 'live.log'
+
+# Грубый стемминг: русские слова различаются в основном окончаниями, поэтому сравниваем начала слов
+STEM_LENGTH = 6
+
+STOP_WORDS = frozenset((
+    'и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот '
+    'от меня еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас опять уж вам ведь '
+    'там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам без чего раз тоже '
+    'себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы '
+    'нее сейчас были куда зачем всех можно при об хоть после над больше тот через эти нас про всего них '
+    'какая много три эту моя свою этой перед лучше чуть том такой им более всегда между это '
+    'the a an and or of to in is it for on at by be this that with'
+).split())
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+SEGMENT_MAGIC = b'CPIX'
+SEGMENT_VERSION = 1
+# magic, версия, порядок байт (1 - little, 2 - big), число постов, число термов, начала 9 секций и конец файла
+_HEADER = struct.Struct('<4sHHII10Q')
+_BYTE_ORDER = 1 if sys.byteorder == 'little' else 2
+
+
+def tokenize(text: str) -> List[str]:
+    """Термы текста: слова в нижнем регистре без стоп-слов, обрезанные до STEM_LENGTH символов"""
+    return [
+        word[:STEM_LENGTH] for word in _WORD_RE.findall(text.casefold())
+        if len(word) > 1 and word not in STOP_WORDS
+    ]
+
+
+class LiveSegment:
+    """Пополняемый сегмент в памяти: сюда попадают новые посты, пока их не наберётся на сегмент на диске"""
+
+    def __init__(self):
+        # терм -> (номера постов, частоты); номера постов возрастают
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.lengths = array('I')
+        self.message_ids = array('q')
+        self.texts: List[str] = []
+        self.total_length = 0
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.texts)
+
+    def add(self, message_id: int, text: str):
+        doc = len(self.texts)
+        terms = tokenize(text)
+        for term, tf in Counter(terms).items():
+            entry = self.postings.get(term)
+            if entry is None:
+                entry = self.postings[term] = (array('I'), array('I'))
+            entry[0].append(doc)
+            entry[1].append(tf)
+        self.lengths.append(len(terms))
+        self.message_ids.append(message_id)
+        self.texts.append(text)
+        self.total_length += len(terms)
+
+    def get_postings(self, term: str):
+        return self.postings.get(term)
+
+    def text(self, doc: int) -> str:
+        return self.texts[doc]
+
+    def docs(self) -> Iterator[Tuple[int, str]]:
+        return zip(self.message_ids, self.texts)
+
+    def write(self, path: str):
+        """
+        Запись неизменяемого сегмента. Секции выровнены по 8 байт и хранятся в порядке байт машины:
+        термы (смещения и UTF-8, отсортированы по байтам), смещения постингов, номера постов и частоты,
+        длины постов, id сообщений, смещения и UTF-8 текстов
+        """
+        terms = sorted(self.postings, key=lambda term: term.encode('utf-8'))
+        encoded_terms = [term.encode('utf-8') for term in terms]
+        term_offsets = array('I', [0])
+        posting_offsets = array('I', [0])
+        posting_docs = array('I')
+        posting_tfs = array('I')
+        for term, encoded in zip(terms, encoded_terms):
+            term_offsets.append(term_offsets[-1] + len(encoded))
+            docs, tfs = self.postings[term]
+            posting_docs.extend(docs)
+            posting_tfs.extend(tfs)
+            posting_offsets.append(len(posting_docs))
+        encoded_texts = [text.encode('utf-8') for text in self.texts]
+        text_offsets = array('I', [0])
+        for encoded in encoded_texts:
+            text_offsets.append(text_offsets[-1] + len(encoded))
+
+        sections = [
+            term_offsets.tobytes(), b''.join(encoded_terms), posting_offsets.tobytes(), posting_docs.tobytes(),
+            posting_tfs.tobytes(), self.lengths.tobytes(), self.message_ids.tobytes(), text_offsets.tobytes(),
+            b''.join(encoded_texts)
+        ]
+        offsets = []
+        position = _HEADER.size
+        for section in sections:
+            offsets.append(position)
+            position += len(section) + (-len(section) % 8)
+        offsets.append(position)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '-', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, _BYTE_ORDER, self.doc_count, len(terms), *offsets))
+                for section in sections:
+                    f.write(section)
+                    f.write(b'\0' * (-len(section) % 8))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+class DiskSegment:
+    """
+    Неизменяемый сегмент на диске, открытый через mmap: загрузка - чтение заголовка,
+    в память попадают только страницы термов и постингов, которые нужны запросам
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, byte_order, self.doc_count, self.term_count, *offsets = _HEADER.unpack_from(self._mmap, 0)
+            if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                raise ValueError(f"неизвестный формат сегмента {path}")
+            if byte_order != _BYTE_ORDER:
+                raise ValueError(f"сегмент {path} записан с другим порядком байт")
+            if offsets[-1] > len(self._mmap):
+                raise ValueError(f"сегмент {path} обрезан")
+        except Exception:
+            self._mmap.close()
+            raise
+        self._view = memoryview(self._mmap)
+        self._views = []
+        self.term_offsets = self._section(offsets[0], 'I', self.term_count + 1)
+        self.term_blob = self._view[offsets[1]:offsets[1] + self.term_offsets[-1]]
+        self.posting_offsets = self._section(offsets[2], 'I', self.term_count + 1)
+        posting_count = self.posting_offsets[-1]
+        self.posting_docs = self._section(offsets[3], 'I', posting_count)
+        self.posting_tfs = self._section(offsets[4], 'I', posting_count)
+        self.lengths = self._section(offsets[5], 'I', self.doc_count)
+        self.message_ids = self._section(offsets[6], 'q', self.doc_count)
+        self.text_offsets = self._section(offsets[7], 'I', self.doc_count + 1)
+        self.text_blob = self._view[offsets[8]:offsets[8] + self.text_offsets[-1]]
+        self._views.extend((self.term_blob, self.text_blob))
+        self.total_length = sum(self.lengths)
+        # Массивы NumPy для векторного подсчёта - представления того же mmap, без копирования
+        self.np_docs = self.np_tfs = self.np_lengths = None
+        if numpy is not None:
+            self.np_docs = numpy.frombuffer(self._mmap, dtype=numpy.uint32, count=posting_count, offset=offsets[3])
+            self.np_tfs = numpy.frombuffer(self._mmap, dtype=numpy.uint32, count=posting_count, offset=offsets[4])
+            self.np_lengths = numpy.frombuffer(self._mmap, dtype=numpy.uint32, count=self.doc_count, offset=offsets[5])
+
+    def _section(self, offset: int, typecode: str, count: int) -> memoryview:
+        size = array(typecode).itemsize
+        view = self._view[offset:offset + count * size].cast(typecode)
+        self._views.append(view)
+        return view
+
+    def _find_term(self, term: str) -> int:
+        """Номер терма бинарным поиском по отсортированному словарю; -1, если терма нет"""
+        key = term.encode('utf-8')
+        low, high = 0, self.term_count
+        while low < high:
+            middle = (low + high) // 2
+            current = self.term_blob[self.term_offsets[middle]:self.term_offsets[middle + 1]].tobytes()
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                return middle
+        return -1
+
+    def get_postings(self, term: str):
+        index = self._find_term(term)
+        if index < 0:
+            return None
+        start, end = self.posting_offsets[index], self.posting_offsets[index + 1]
+        return self.posting_docs[start:end], self.posting_tfs[start:end]
+
+    def posting_range(self, term: str) -> Optional[Tuple[int, int]]:
+        index = self._find_term(term)
+        if index < 0:
+            return None
+        return self.posting_offsets[index], self.posting_offsets[index + 1]
+
+    def text(self, doc: int) -> str:
+        return self.text_blob[self.text_offsets[doc]:self.text_offsets[doc + 1]].tobytes().decode('utf-8')
+
+    def docs(self) -> Iterator[Tuple[int, str]]:
+        for doc in range(self.doc_count):
+            yield self.message_ids[doc], self.text(doc)
+
+    def close(self):
+        # mmap закрывается только после освобождения всех представлений
+        self.np_docs = self.np_tfs = self.np_lengths = None
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._view.release()
+        self._mmap.close()
+
+
+class ChannelPostIndex:
+    """
+    Инвертированный индекс постов одного канала с оценкой BM25: новые посты копятся в сегменте
+    в памяти и дописываются в журнал live.log, набравшийся сегмент (segment_size постов) записывается
+    на диск и открывается через mmap. Поиск видит только самые свежие max_posts постов; сегменты
+    сливаются в один, когда их больше max_segments или устаревших постов набирается на
+    COMPACT_DEAD_RATIO от max_posts - так размер индекса канала ограничен
+    """
+
+    def __init__(self, directory: str, segment_size: int = 256, max_segments: int = 8, max_posts: int = 5000):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.max_posts = max_posts
+        self.segments: List[DiskSegment] = []
+        self.live = LiveSegment()
+        self._next_segment = 1
+        self._live_log = None
+        # Каталог создаётся с первым постом: поиск по каналу без постов не оставляет пустых каталогов
+        if os.path.isdir(directory):
+            self._load_segments()
+            self._replay_live_log()
+
+    @property
+    def _live_log_path(self) -> str:
+        return os.path.join(self.directory, LIVE_LOG_NAME)
+
+    def _load_segments(self):
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.seg'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                self.segments.append(DiskSegment(path))
+            except (OSError, ValueError, struct.error) as e:
+                logger.error(f"Сегмент индекса {path} пропущен: {e}")
+                continue
+            self._next_segment = max(self._next_segment, int(name.split('.')[0]) + 1)
+
+    def _replay_live_log(self):
+        """Восстановление постов, которые не успели попасть в сегмент на диске до остановки процесса"""
+        path = self._live_log_path
+        if not os.path.exists(path):
+            return
+        # Посты канала нумеруются по возрастанию: если процесс остановился между записью сегмента
+        # и очисткой журнала, посты из журнала уже есть в последнем сегменте
+        last_stored = -1
+        if self.segments and self.segments[-1].doc_count:
+            last_stored = self.segments[-1].message_ids[-1]
+        good_offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    message_id, text = jsoncodec.loads(line)
+                except ValueError:
+                    # Недописанная строка после аварийного завершения - всё после неё отбрасываем
+                    logger.warning(f"Повреждённая запись в журнале {path}, хвост отброшен")
+                    break
+                good_offset += len(line)
+                if message_id > last_stored:
+                    self.live.add(message_id, text)
+        if good_offset < os.path.getsize(path):
+            with open(path, 'r+b') as f:
+                f.truncate(good_offset)
+
+    @property
+    def doc_count(self) -> int:
+        return self.live.doc_count + sum(segment.doc_count for segment in self.segments)
+
+    @property
+    def dead_count(self) -> int:
+        """Самые старые посты сверх max_posts: поиск их не видит, место освобождает слияние"""
+        return max(0, self.doc_count - self.max_posts)
+
+    def add(self, message_id: int, text: str):
+        """Добавление поста: запись в журнал, затем в сегмент в памяти; набравшийся сегмент уходит на диск"""
+        if self._live_log is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._live_log = open(self._live_log_path, 'a', encoding='utf-8')
+        self._live_log.write(jsoncodec.dumps([message_id, text]).decode('utf-8') + '\n')
+        self._live_log.flush()
+        self.live.add(message_id, text)
+        if self.live.doc_count >= self.segment_size:
+            self.flush()
+
+    def flush(self):
+        """Запись сегмента из памяти на диск, очистка журнала и слияние сегментов при превышении лимитов"""
+        if not self.live.doc_count:
+            return
+        path = self._segment_path()
+        self.live.write(path)
+        self.live = LiveSegment()
+        self.segments.append(DiskSegment(path))
+        if self._live_log is not None:
+            self._live_log.truncate(0)
+        elif os.path.exists(self._live_log_path):
+            # Посты восстановлены из журнала, но после открытия новых не было
+            os.truncate(self._live_log_path, 0)
+        if len(self.segments) > self.max_segments or self.dead_count > self.max_posts * COMPACT_DEAD_RATIO:
+            self._compact()
+
+    def _segment_path(self) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{self._next_segment:08d}.seg')
+        self._next_segment += 1
+        return path
+
+    def _compact(self):
+        """Слияние всех сегментов на диске в один, самые старые посты сверх max_posts отбрасываются"""
+        docs = [doc for segment in self.segments for doc in segment.docs()]
+        merged = LiveSegment()
+        for message_id, text in docs[-self.max_posts:]:
+            merged.add(message_id, text)
+        path = self._segment_path()
+        merged.write(path)
+        old_segments, self.segments = self.segments, [DiskSegment(path)]
+        for segment in old_segments:
+            segment.close()
+            os.remove(segment.path)
+
+    def search(self, query: str, k: int = 3) -> List[str]:
+        """Тексты k постов, наиболее релевантных запросу по BM25 (по убыванию оценки)"""
+        terms = set(tokenize(query))
+        doc_count = self.doc_count
+        if not terms or not doc_count or k <= 0:
+            return []
+        segments = self.segments + [self.live]
+        avgdl = max(sum(segment.total_length for segment in segments) / doc_count, 1.0)
+
+        # Документная частота терма - сумма по сегментам
+        matches: Dict[str, list] = {}
+        for term in terms:
+            for segment in segments:
+                if isinstance(segment, DiskSegment) and numpy is not None:
+                    found = segment.posting_range(term)
+                    size = found[1] - found[0] if found else 0
+                else:
+                    found = segment.get_postings(term)
+                    size = len(found[0]) if found else 0
+                if size:
+                    matches.setdefault(term, []).append((segment, found, size))
+        if not matches:
+            return []
+        idf = {
+            term: math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for term, df in ((term, sum(size for _, _, size in found)) for term, found in matches.items())
+        }
+
+        # (оценка, номер сегмента, номер поста); устаревшие посты - начало самых старых сегментов
+        candidates: List[Tuple[float, int, int]] = []
+        dead = self.dead_count
+        for segment_index, segment in enumerate(segments):
+            skip = min(dead, segment.doc_count)
+            dead -= skip
+            if skip == segment.doc_count:
+                continue
+            segment_matches = [
+                (idf[term], found) for term, items in matches.items() for seg, found, _ in items if seg is segment
+            ]
+            if not segment_matches:
+                continue
+            if isinstance(segment, DiskSegment) and numpy is not None:
+                candidates.extend(self._score_vectorized(segment, segment_index, segment_matches, avgdl, k, skip))
+            else:
+                candidates.extend(self._score(segment, segment_index, segment_matches, avgdl, k, skip))
+        best = heapq.nlargest(k, candidates)
+        return [segments[segment_index].text(doc) for _, segment_index, doc in best]
+
+    @staticmethod
+    def _score(segment, segment_index: int, segment_matches, avgdl: float, k: int, skip: int = 0):
+        scores: Dict[int, float] = {}
+        lengths = segment.lengths
+        for term_idf, (docs, tfs) in segment_matches:
+            for doc, tf in zip(docs, tfs):
+                if doc < skip:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc] / avgdl)
+                scores[doc] = scores.get(doc, 0.0) + term_idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return heapq.nlargest(k, ((score, segment_index, doc) for doc, score in scores.items()))
+
+    @staticmethod
+    def _score_vectorized(segment: DiskSegment, segment_index: int, segment_matches, avgdl: float, k: int,
+                          skip: int = 0):
+        scores = numpy.zeros(segment.doc_count, dtype=numpy.float64)
+        for term_idf, (start, end) in segment_matches:
+            # В пределах терма посты не повторяются, поэтому сложение по индексам корректно
+            docs = segment.np_docs[start:end]
+            tfs = segment.np_tfs[start:end].astype(numpy.float64)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * segment.np_lengths[docs] / avgdl)
+            scores[docs] += term_idf * tfs * (BM25_K1 + 1) / (tfs + norm)
+        scores[:skip] = 0.0
+        # Все посты с оценкой не ниже k-й, чтобы равные оценки разрешались так же, как без NumPy
+        threshold = 0.0
+        if segment.doc_count > k:
+            threshold = numpy.partition(scores, segment.doc_count - k)[segment.doc_count - k]
+        top = numpy.nonzero(scores >= threshold if threshold > 0 else scores > 0)[0]
+        return heapq.nlargest(k, ((float(scores[doc]), segment_index, int(doc)) for doc in top))
+
+    def close(self):
+        """Запись сегмента из памяти, закрытие журнала и mmap"""
+        self.flush()
+        if self._live_log is not None:
+            self._live_log.close()
+            self._live_log = None
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+
+class PostIndex:
+    """
+    Индексы постов по каналам: в памяти открыто не больше max_channels индексов (LRU),
+    вытесненный индекс сбрасывает свой сегмент на диск и закрывается, при следующем обращении
+    он снова открывается с диска через mmap
+    """
+
+    def __init__(self, directory: str, max_channels: int = 1000, max_post_chars: int = 2000, **channel_options):
+        self.directory = directory
+        self.max_channels = max_channels
+        self.max_post_chars = max_post_chars
+        self.channel_options = channel_options
+        self._channels: 'OrderedDict[str, ChannelPostIndex]' = OrderedDict()
+        self.stats = {'posts': 0, 'searches': 0, 'hits': 0}
+
+    def _get(self, chat_id) -> ChannelPostIndex:
+        chat_id = str(chat_id)
+        index = self._channels.get(chat_id)
+        if index is not None:
+            self._channels.move_to_end(chat_id)
+            return index
+        index = self._channels[chat_id] = ChannelPostIndex(os.path.join(self.directory, chat_id), **self.channel_options)
+        while len(self._channels) > self.max_channels:
+            _, evicted = self._channels.popitem(last=False)
+            evicted.close()
+        return index
+
+    def add(self, chat_id, message_id: int, text: str):
+        """Индексация поста канала"""
+        if not text:
+            return
+        try:
+            self._get(chat_id).add(message_id, text[:self.max_post_chars])
+            self.stats['posts'] += 1
+        except OSError as e:
+            logger.error(f"Не удалось проиндексировать пост канала {chat_id}: {e}")
+
+    def search(self, chat_id, query: str, k: int = 3) -> List[str]:
+        """Посты канала, наиболее релевантные запросу; пустой список, если подходящих нет"""
+        if not query:
+            return []
+        self.stats['searches'] += 1
+        try:
+            posts = self._get(chat_id).search(query, k)
+        except OSError as e:
+            logger.error(f"Ошибка поиска по индексу канала {chat_id}: {e}")
+            return []
+        if posts:
+            self.stats['hits'] += 1
+        return posts
+
+    def close(self):
+        """Запись сегментов из памяти и закрытие всех индексов"""
+        for index in self._channels.values():
+            index.close()
+        self._channels.clear()
@@ -0,0 +1,144 @@
+import logging
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Бюджет входных токенов канала по умолчанию (assistant_settings['input_token_budget'])
+DEFAULT_INPUT_TOKEN_BUDGET = 3000
+# Служебные токены на каждое сообщение чата (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Размер окна контекста моделей; для неизвестных - консервативное значение
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 16385,
+    'gpt-4': 8192,
+    'gpt-4-turbo': 128000,
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# Заголовок системного сообщения с найденными постами канала
+KNOWLEDGE_HEADER = "Посты канала по теме комментария (опирайся на них в ответе):"
+
+_WORD_RE = re.compile(r'\w+|[^\w\s]', re.UNICODE)
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Кодировка tiktoken (импорт и загрузка при первом использовании); None - используем оценку"""
+    try:
+        import tiktoken
+    except ImportError:  # токенизатор не обязателен, без него используется оценка
+        return None
+    try:
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить токенизатор, используется оценка: {e}")
+        return None
+
+
+@lru_cache(maxsize=65536)
+def count_tokens(text: str) -> int:
+    """Число токенов в тексте: по tiktoken, если он установлен, иначе оценка по словам и символам"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Кириллица и длинные слова дробятся на несколько токенов: берём максимум из двух оценок
+    return max(len(_WORD_RE.findall(text)), (len(text) + 2) // 3)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезка текста до max_tokens токенов"""
+    if max_tokens <= 0:
+        return ''
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = _get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text)[:max_tokens - 1]) + '…'
+    cut = len(text) * max_tokens // count_tokens(text)
+    while cut > 0 and count_tokens(text[:cut]) >= max_tokens:
+        cut = cut * 9 // 10
+    return text[:cut] + '…'
+
+
+def context_window(model: str) -> int:
+    """Размер окна контекста модели"""
+    for name in sorted(MODEL_CONTEXT_WINDOWS, key=len, reverse=True):
+        if model.startswith(name):
+            return MODEL_CONTEXT_WINDOWS[name]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def _relevance(item_text: str, message_words: set) -> float:
+    """Доля слов сообщения, встречающихся в элементе контекста"""
+    if not message_words:
+        return 0.0
+    item_words = {word.casefold() for word in _WORD_RE.findall(item_text)}
+    return len(message_words & item_words) / len(message_words)
+
+
+def build_messages(system_prompt: str, message: str, context: Optional[list] = None,
+                   model: str = 'gpt-3.5-turbo', max_tokens: int = 150,
+                   input_token_budget: int = DEFAULT_INPUT_TOKEN_BUDGET,
+                   knowledge: Optional[List[str]] = None) -> List[Dict[str, str]]:
+    """
+    Сборка сообщений для модели в пределах бюджета входных токенов.
+
+    Бюджет - min(input_token_budget, окно модели - max_tokens). Системный промпт и сообщение
+    попадают всегда (слишком длинные обрезаются). Найденные посты канала (knowledge, по убыванию
+    релевантности) занимают не больше половины оставшегося места отдельным системным сообщением.
+    Остальное заполняется контекстом: сначала самые релевантные сообщению и самые свежие элементы,
+    крупные элементы обрезаются. Порядок выбранного контекста сохраняется хронологическим.
+    """
+    budget = min(input_token_budget, context_window(model) - max_tokens)
+
+    # Системный промпт и сообщение не должны съесть весь бюджет
+    system_prompt = truncate_to_tokens(system_prompt, budget // 2 - MESSAGE_OVERHEAD_TOKENS)
+    remaining = budget - count_tokens(system_prompt) - MESSAGE_OVERHEAD_TOKENS
+    message = truncate_to_tokens(message, remaining // 2 - MESSAGE_OVERHEAD_TOKENS)
+    remaining -= count_tokens(message) + MESSAGE_OVERHEAD_TOKENS
+
+    knowledge_message = None
+    if knowledge and remaining > MESSAGE_OVERHEAD_TOKENS:
+        knowledge_budget = remaining // 2 - MESSAGE_OVERHEAD_TOKENS - count_tokens(KNOWLEDGE_HEADER)
+        # Один пост не может занять больше половины места под посты
+        post_cap = max(knowledge_budget // 2, 1)
+        posts = []
+        for post in knowledge:
+            post = truncate_to_tokens(post, post_cap)
+            cost = count_tokens(post) + 1
+            if not post or cost > knowledge_budget:
+                continue
+            posts.append(post)
+            knowledge_budget -= cost
+        if posts:
+            knowledge_message = {"role": "system", "content": KNOWLEDGE_HEADER + "\n\n" + "\n\n".join(posts)}
+            remaining -= count_tokens(knowledge_message['content']) + MESSAGE_OVERHEAD_TOKENS
+
+    selected: Dict[int, Dict[str, str]] = {}
+    if context and remaining > MESSAGE_OVERHEAD_TOKENS:
+        message_words = {word.casefold() for word in _WORD_RE.findall(message) if len(word) > 2}
+        # Один элемент контекста не может занять больше половины оставшегося места
+        item_cap = max(remaining // 2, MESSAGE_OVERHEAD_TOKENS + 1)
+        ranked = sorted(
+            range(len(context)),
+            key=lambda i: (_relevance(context[i]['content'], message_words), i),
+            reverse=True
+        )
+        for i in ranked:
+            item = context[i]
+            content = truncate_to_tokens(item['content'], item_cap - MESSAGE_OVERHEAD_TOKENS)
+            cost = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+            if cost > remaining:
+                continue
+            selected[i] = {"role": item['role'], "content": content}
+            remaining -= cost
+
+    messages = [{"role": "system", "content": system_prompt}]
+    if knowledge_message is not None:
+        messages.append(knowledge_message)
+    messages.extend(selected[i] for i in sorted(selected))
+    messages.append({"role": "user", "content": message})
+    return messages
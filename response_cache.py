@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Настройки ассистента, от которых зависит ответ
+FINGERPRINT_FIELDS = ('model', 'temperature', 'max_tokens', 'system_prompt', 'response_style',
+                      'allowed_topics', 'forbidden_words')
+
+_PUNCTUATION_RE = re.compile(r'[^\w\s?]')
+_SPACES_RE = re.compile(r'\s+')
+
+
+def normalize_message(text: str) -> str:
+    """Нормализация текста комментария: регистр, ё, пунктуация (кроме ?) и пробелы"""
+    normalized = _SPACES_RE.sub(' ', _PUNCTUATION_RE.sub('', text.casefold().replace('ё', 'е'))).strip()
+    # Комментарии только из знаков ("+", "!!!") различаем по исходному тексту
+    return normalized or text.strip()
+
+
+def settings_fingerprint(assistant_settings: Dict[str, Any]) -> str:
+    """Стабильный хэш настроек ассистента, влияющих на ответ"""
+    relevant = {field: assistant_settings.get(field) for field in FINGERPRINT_FIELDS}
+    payload = json.dumps(relevant, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def context_fingerprint(context: Optional[list]) -> str:
+    """Хэш контекста (последних сообщений), если он участвует в ключе"""
+    payload = json.dumps(context or [], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    Кэш ответов перед generate_response.
+
+    Ключ - канал + нормализованный текст + хэш настроек ассистента (+ хэш контекста,
+    если include_context). LRU с ограничением по памяти (max_bytes), срок жизни -
+    assistant_settings['cache_ttl_seconds'] канала или ttl_seconds по умолчанию (0 - не кэшировать).
+    При изменении настроек канала его записи удаляются через invalidate_channel.
+    Если задан disk_path, записи дублируются в SQLite и переживают перезапуск.
+    """
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024, ttl_seconds: float = 3600,
+                 include_context: bool = False, disk_path: str = None):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.include_context = include_context
+        # key -> (channel_id, expires_at, reply, size)
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._channel_keys: Dict[str, set] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'invalidations': 0}
+        self._disk = None
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, channel_id TEXT NOT NULL, expires_at REAL NOT NULL, reply TEXT NOT NULL)"
+            )
+            self._disk.execute("CREATE INDEX IF NOT EXISTS idx_responses_channel_id ON responses (channel_id)")
+            with self._disk:
+                self._disk.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+
+    def make_key(self, channel_id, message: str, channel_settings: Dict[str, Any],
+                 context: Optional[list] = None) -> str:
+        """Ключ кэша для комментария"""
+        parts = [
+            str(channel_id),
+            settings_fingerprint(channel_settings.get('assistant_settings', {})),
+            normalize_message(message)
+        ]
+        if self.include_context:
+            parts.append(context_fingerprint(context))
+        return hashlib.sha1('\x00'.join(parts).encode('utf-8')).hexdigest()
+
+    def channel_ttl(self, channel_settings: Dict[str, Any]) -> float:
+        """Срок жизни записей канала"""
+        return channel_settings.get('assistant_settings', {}).get('cache_ttl_seconds', self.ttl_seconds)
+
+    def get(self, channel_id, message: str, channel_settings: Dict[str, Any],
+            context: Optional[list] = None) -> Optional[str]:
+        """Поиск готового ответа"""
+        if self.channel_ttl(channel_settings) <= 0:
+            return None
+        key = self.make_key(channel_id, message, channel_settings, context)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[2]
+                self._remove(key)
+            if self._disk is not None:
+                row = self._disk.execute(
+                    "SELECT expires_at, reply FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[0] > now:
+                    self._store(key, str(channel_id), row[0], row[1])
+                    self.stats['disk_hits'] += 1
+                    return row[1]
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, channel_id, message: str, channel_settings: Dict[str, Any], reply: str,
+            context: Optional[list] = None):
+        """Сохранение ответа"""
+        ttl = self.channel_ttl(channel_settings)
+        if ttl <= 0:
+            return
+        key = self.make_key(channel_id, message, channel_settings, context)
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._store(key, str(channel_id), expires_at, reply)
+            self.stats['stores'] += 1
+            if self._disk is not None:
+                with self._disk:
+                    self._disk.execute(
+                        "INSERT OR REPLACE INTO responses (key, channel_id, expires_at, reply) VALUES (?, ?, ?, ?)",
+                        (key, str(channel_id), expires_at, reply)
+                    )
+
+    def _store(self, key: str, channel_id: str, expires_at: float, reply: str):
+        if key in self._entries:
+            self._remove(key)
+        size = len(key) + len(reply.encode('utf-8'))
+        self._entries[key] = (channel_id, expires_at, reply, size)
+        self._channel_keys.setdefault(channel_id, set()).add(key)
+        self._bytes += size
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.stats['evictions'] += 1
+
+    def _remove(self, key: str):
+        channel_id, _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        keys = self._channel_keys.get(channel_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._channel_keys[channel_id]
+
+    def invalidate_channel(self, channel_id):
+        """Удаление всех ответов канала (вызывается при изменении его настроек)"""
+        channel_id = str(channel_id)
+        with self._lock:
+            for key in list(self._channel_keys.get(channel_id, ())):
+                self._remove(key)
+            if self._disk is not None:
+                with self._disk:
+                    self._disk.execute("DELETE FROM responses WHERE channel_id = ?", (channel_id,))
+            self.stats['invalidations'] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def memory_bytes(self) -> int:
+        """Оценка объёма кэша в памяти"""
+        return self._bytes
+
+    def close(self):
+        """Закрытие дискового уровня"""
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
@@ -0,0 +1,169 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import signal
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Предельный размер одного сообщения между ingress и воркером
+MAX_FRAME_BYTES = 4 * 1024 * 1024
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class ConsistentHashRing:
+    """
+    Кольцо консистентного хэширования: у каждого узла replicas виртуальных точек,
+    поэтому при добавлении или удалении воркера переезжает только ~1/N ключей
+    """
+
+    def __init__(self, nodes=(), replicas: int = 160):
+        self.replicas = replicas
+        self._points: List[int] = []
+        self._owners: List[str] = []
+        self._nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node: str):
+        """Добавление узла"""
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for replica in range(self.replicas):
+            point = _hash(f"{node}#{replica}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node: str):
+        """Удаление узла"""
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        kept = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+        self._points = [point for point, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def get(self, key: str) -> Optional[str]:
+        """Узел, владеющий ключом; None, если узлов нет"""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[index]
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+def shard_key(update) -> str:
+    """
+    Ключ шардирования обновления: чат, иначе пользователь. Личный чат совпадает с id пользователя,
+    поэтому шаги мастера настройки и комментарии одного чата всегда попадают в один воркер
+    """
+    if update.effective_chat is not None:
+        return f"chat:{update.effective_chat.id}"
+    if update.effective_user is not None:
+        return f"chat:{update.effective_user.id}"
+    return f"update:{update.update_id}"
+
+
+async def write_frame(writer: asyncio.StreamWriter, message: Dict[str, Any]):
+    """Отправка сообщения протокола (одна строка JSON)"""
+    writer.write(json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n')
+    await writer.drain()
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Dict[str, Any]]:
+    """Чтение сообщения протокола; None - соединение закрыто"""
+    line = await reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+async def run_worker(application, socket_path: str, worker_id: str, stats_interval: float = 10.0,
+                     connect_timeout: float = 30.0):
+    """
+    Воркер: подключается к ingress по Unix-сокету, получает обновления своих шардов
+    и обрабатывает их приложением без собственного polling/webhook.
+
+    По SIGTERM/SIGINT воркер сообщает ingress, что уходит, дожидается подтверждения
+    (после него новых обновлений не будет), дообрабатывает полученное и останавливается
+    """
+    from telegram import Update
+
+    loop = asyncio.get_running_loop()
+    leaving = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, leaving.set)
+
+    deadline = time.monotonic() + connect_timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_unix_connection(socket_path, limit=MAX_FRAME_BYTES)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.5)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    await write_frame(writer, {'type': 'hello', 'worker': worker_id})
+    logger.info(f"Воркер {worker_id} подключён к {socket_path}")
+
+    received = 0
+    started_at = time.monotonic()
+
+    async def report_stats():
+        while True:
+            await asyncio.sleep(stats_interval)
+            elapsed = time.monotonic() - started_at
+            queued = application.update_queue.qsize()
+            await write_frame(writer, {
+                'type': 'stats',
+                'processed': received - queued,
+                'rate': round((received - queued) / elapsed, 2) if elapsed else 0.0,
+                'queue': queued
+            })
+
+    async def request_leave():
+        await leaving.wait()
+        await write_frame(writer, {'type': 'leave'})
+
+    stats_task = loop.create_task(report_stats())
+    leave_task = loop.create_task(request_leave())
+    try:
+        while True:
+            message = await read_frame(reader)
+            if message is None:
+                logger.warning(f"Ingress закрыл соединение с воркером {worker_id}")
+                break
+            if message['type'] == 'update':
+                await application.update_queue.put(Update.de_json(message['update'], application.bot))
+                received += 1
+            elif message['type'] == 'bye':
+                break
+    finally:
+        stats_task.cancel()
+        leave_task.cancel()
+        writer.close()
+        # stop() дообрабатывает уже поставленные в очередь обновления
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logger.info(f"Воркер {worker_id} остановлен, получено обновлений: {received}")
@@ -0,0 +1,351 @@
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from database import BaseUserDatabase, merge_channel_stats
+from state_store import StateStore
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    created_at TEXT,
+    last_activity TEXT,
+    openai_key TEXT
+);
+CREATE TABLE IF NOT EXISTS command_counters (
+    user_id INTEGER NOT NULL,
+    command TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, command)
+);
+CREATE TABLE IF NOT EXISTS channels (
+    channel_id INTEGER PRIMARY KEY,
+    title TEXT,
+    username TEXT,
+    owner_id INTEGER NOT NULL,
+    settings TEXT NOT NULL,
+    stats TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_channels_owner_id ON channels (owner_id);
+CREATE TABLE IF NOT EXISTS channel_changes (
+    channel_id INTEGER PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_channel_changes_seq ON channel_changes (seq);
+"""
+
+# Запросы держим константами: sqlite3 кэширует подготовленные выражения по тексту запроса
+INSERT_USER = (
+    "INSERT OR IGNORE INTO users (user_id, username, first_name, last_name, created_at, last_activity, openai_key) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SELECT_USER = "SELECT username, first_name, last_name, created_at, last_activity, openai_key FROM users WHERE user_id = ?"
+SELECT_ALL_USERS = "SELECT user_id, username, first_name, last_name, created_at, last_activity, openai_key FROM users"
+UPDATE_USER_ACTIVITY = "UPDATE users SET last_activity = ? WHERE user_id = ?"
+INCREMENT_COMMAND = (
+    "INSERT INTO command_counters (user_id, command, count) VALUES (?, ?, 1) "
+    "ON CONFLICT (user_id, command) DO UPDATE SET count = count + 1"
+)
+SELECT_COMMANDS = "SELECT command, count FROM command_counters WHERE user_id = ?"
+SELECT_ALL_COMMANDS = "SELECT user_id, command, count FROM command_counters"
+SET_OPENAI_KEY = "UPDATE users SET openai_key = ? WHERE user_id = ?"
+SELECT_OPENAI_KEY = "SELECT openai_key FROM users WHERE user_id = ?"
+INSERT_CHANNEL = (
+    "INSERT OR IGNORE INTO channels (channel_id, title, username, owner_id, settings, stats) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+SELECT_CHANNEL = "SELECT channel_id, title, username, owner_id, settings, stats FROM channels WHERE channel_id = ?"
+SELECT_OWNER_CHANNELS = "SELECT channel_id, title, username, owner_id, settings, stats FROM channels WHERE owner_id = ?"
+UPDATE_CHANNEL_SETTINGS = "UPDATE channels SET settings = ? WHERE channel_id = ?"
+DELETE_CHANNEL = "DELETE FROM channels WHERE channel_id = ?"
+UPDATE_CHANNEL_OWNER = "UPDATE channels SET owner_id = ? WHERE channel_id = ?"
+SELECT_CHANNEL_STATS = "SELECT stats FROM channels WHERE channel_id = ?"
+UPDATE_CHANNEL_STATS = "UPDATE channels SET stats = ? WHERE channel_id = ?"
+# Последнее изменение каждого канала: по нему другие процессы сбрасывают свои кэши
+RECORD_CHANNEL_CHANGE = (
+    "INSERT INTO channel_changes (channel_id, seq) "
+    "VALUES (?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM channel_changes)) "
+    "ON CONFLICT (channel_id) DO UPDATE SET seq = excluded.seq"
+)
+SELECT_CHANNEL_CHANGES = "SELECT channel_id, seq FROM channel_changes WHERE seq > ?"
+
+
+class SQLiteUserDatabase(BaseUserDatabase):
+    """
+    Хранилище в SQLite (WAL): точечные запросы по индексам без чтения всей базы.
+    Файл базы можно открыть из нескольких процессов; изменения каналов, сделанные
+    другими процессами, доставляются слушателям через poll_external_changes
+    """
+
+    def __init__(self, path: str = 'database.sqlite3', cached_statements: int = 128,
+                 state_store: StateStore = None):
+        super().__init__(state_store)
+        self.path = path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, cached_statements=cached_statements)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        self._change_seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM channel_changes").fetchone()[0]
+
+    def _channel_from_row(self, row) -> Dict[str, Any]:
+        """Преобразование строки таблицы channels в словарь в формате JSON-хранилища"""
+        channel_id, title, username, owner_id, settings, stats = row
+        return {
+            'id': channel_id,
+            'title': title,
+            'username': username,
+            'owner_id': owner_id,
+            'settings': json.loads(settings),
+            'stats': json.loads(stats)
+        }
+
+    def add_user(self, user_id, username=None, first_name=None, last_name=None):
+        """Добавление нового пользователя"""
+        now = datetime.now().isoformat()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(INSERT_USER, (int(user_id), username, first_name, last_name, now, now, None))
+        return cursor.rowcount > 0
+
+    def update_user_activity(self, user_id, command=None):
+        """Обновление активности пользователя"""
+        user_id = int(user_id)
+        with self._lock, self._conn:
+            cursor = self._conn.execute(UPDATE_USER_ACTIVITY, (datetime.now().isoformat(), user_id))
+            if cursor.rowcount and command:
+                self._conn.execute(INCREMENT_COMMAND, (user_id, command))
+
+    def add_channel(self, channel_id: int, channel_title: str, user_id: int, channel_username: str = None, system_prompt: str = None):
+        """Добавление нового канала"""
+        try:
+            channel_settings = {
+                'auto_reply_enabled': True,
+                'assistant_settings': {
+                    'model': 'gpt-3.5-turbo',
+                    'temperature': 0.7,
+                    'max_tokens': 150,
+                    'system_prompt': system_prompt or "Отвечай кратко и по существу",
+                    'response_style': 'friendly'
+                }
+            }
+            stats = {
+                'total_messages': 0,
+                'total_replies': 0,
+                'last_activity': None
+            }
+            with self._lock, self._conn:
+                cursor = self._conn.execute(INSERT_CHANNEL, (
+                    int(channel_id), channel_title, channel_username, int(user_id),
+                    json.dumps(channel_settings, ensure_ascii=False), json.dumps(stats)
+                ))
+                if cursor.rowcount:
+                    self._conn.execute(RECORD_CHANNEL_CHANGE, (int(channel_id),))
+            if not cursor.rowcount:
+                return False
+            self._notify_channel_changed(channel_id)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при добавлении канала: {e}")
+            return False
+
+    def update_channel_settings(self, channel_id: int, settings: Dict[str, Any]):
+        """Обновление настроек канала"""
+        try:
+            channel_id = int(channel_id)
+            with self._lock, self._conn:
+                row = self._conn.execute("SELECT settings FROM channels WHERE channel_id = ?", (channel_id,)).fetchone()
+                if row is None:
+                    return False
+                channel_settings = json.loads(row[0])
+                if 'assistant_settings' in settings:
+                    channel_settings['assistant_settings'].update(settings['assistant_settings'])
+                else:
+                    channel_settings.update(settings)
+                self._conn.execute(UPDATE_CHANNEL_SETTINGS, (json.dumps(channel_settings, ensure_ascii=False), channel_id))
+                self._conn.execute(RECORD_CHANNEL_CHANGE, (channel_id,))
+            self._notify_channel_changed(channel_id)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении настроек канала: {e}")
+            return False
+
+    def get_channel(self, channel_id) -> Optional[Dict[str, Any]]:
+        """Получение канала по id"""
+        with self._lock:
+            row = self._conn.execute(SELECT_CHANNEL, (int(channel_id),)).fetchone()
+        return self._channel_from_row(row) if row else None
+
+    def remove_channel(self, channel_id: int) -> bool:
+        """Удаление канала"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(DELETE_CHANNEL, (int(channel_id),))
+            if cursor.rowcount:
+                self._conn.execute(RECORD_CHANNEL_CHANGE, (int(channel_id),))
+        if not cursor.rowcount:
+            return False
+        self._notify_channel_changed(channel_id)
+        return True
+
+    def transfer_channel(self, channel_id: int, new_owner_id: int) -> bool:
+        """Передача канала другому владельцу"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(UPDATE_CHANNEL_OWNER, (int(new_owner_id), int(channel_id)))
+            if cursor.rowcount:
+                self._conn.execute(RECORD_CHANNEL_CHANGE, (int(channel_id),))
+        if not cursor.rowcount:
+            return False
+        self._notify_channel_changed(channel_id)
+        return True
+
+    def get_user_channels(self, user_id: int) -> List[Dict[str, Any]]:
+        """Получение списка каналов пользователя"""
+        with self._lock:
+            rows = self._conn.execute(SELECT_OWNER_CHANNELS, (int(user_id),)).fetchall()
+        return [self._channel_from_row(row) for row in rows]
+
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получение статистики пользователя"""
+        user_id = int(user_id)
+        with self._lock:
+            row = self._conn.execute(SELECT_USER, (user_id,)).fetchone()
+            if row is None:
+                return {}
+            commands = self._conn.execute(SELECT_COMMANDS, (user_id,)).fetchall()
+        username, first_name, last_name, created_at, last_activity, openai_key = row
+        return {
+            'username': username,
+            'first_name': first_name,
+            'last_name': last_name,
+            'created_at': created_at,
+            'last_activity': last_activity,
+            'commands_used': dict(commands),
+            'openai_key': openai_key
+        }
+
+    def get_all_users(self) -> Dict[str, Any]:
+        """Получение всех пользователей"""
+        users = {}
+        with self._lock:
+            for user_id, username, first_name, last_name, created_at, last_activity, openai_key in self._conn.execute(SELECT_ALL_USERS):
+                users[str(user_id)] = {
+                    'username': username,
+                    'first_name': first_name,
+                    'last_name': last_name,
+                    'created_at': created_at,
+                    'last_activity': last_activity,
+                    'commands_used': {},
+                    'openai_key': openai_key
+                }
+            for user_id, command, count in self._conn.execute(SELECT_ALL_COMMANDS):
+                if str(user_id) in users:
+                    users[str(user_id)]['commands_used'][command] = count
+        return users
+
+    def set_user_openai_key(self, user_id: int, key: str):
+        """Установка ключа OpenAI для пользователя"""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(SET_OPENAI_KEY, (key, int(user_id)))
+        return cursor.rowcount > 0
+
+    def get_user_openai_key(self, user_id: int) -> Optional[str]:
+        """Получение ключа OpenAI пользователя"""
+        with self._lock:
+            row = self._conn.execute(SELECT_OPENAI_KEY, (int(user_id),)).fetchone()
+        return row[0] if row else None
+
+    def add_channel_stats(self, deltas: Dict[str, Dict[str, Any]]):
+        """Прибавление накопленных счётчиков к статистике каналов одной транзакцией"""
+        with self._lock, self._conn:
+            for channel_id, delta in deltas.items():
+                row = self._conn.execute(SELECT_CHANNEL_STATS, (int(channel_id),)).fetchone()
+                if row is None:
+                    continue
+                stats = json.loads(row[0])
+                merge_channel_stats(stats, delta)
+                self._conn.execute(UPDATE_CHANNEL_STATS, (json.dumps(stats, ensure_ascii=False), int(channel_id)))
+
+    def poll_external_changes(self) -> int:
+        """
+        Оповещение слушателей о каналах, изменённых другими процессами.
+        PRAGMA data_version меняется только после чужих транзакций, поэтому без них проверка почти бесплатна
+        """
+        with self._lock:
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return 0
+            self._data_version = data_version
+            rows = self._conn.execute(SELECT_CHANNEL_CHANGES, (self._change_seq,)).fetchall()
+            if rows:
+                self._change_seq = max(seq for _, seq in rows)
+        for channel_id, _ in rows:
+            self._notify_channel_changed(channel_id)
+        return len(rows)
+
+    def flush(self) -> bool:
+        """Каждое изменение уже зафиксировано транзакцией - сбрасываем только WAL в основной файл"""
+        with self._lock:
+            self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return True
+
+    def close(self):
+        """Закрытие соединения с базой"""
+        with self._lock:
+            self._conn.close()
+        self.state_store.close()
+
+
+def migrate_json_to_sqlite(json_path: str = 'database.json', sqlite_path: str = 'database.sqlite3') -> Dict[str, int]:
+    """Однократный перенос данных из database.json в SQLite. Возвращает количество перенесённых записей"""
+    with open(json_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    data.pop('_journal_seq', None)
+    # Состояния диалогов короткоживущие и в SQLite не переносятся
+
+    db = SQLiteUserDatabase(sqlite_path)
+    counts = {'users': 0, 'channels': 0}
+    try:
+        with db._lock, db._conn:
+            for user_id, user in data.get('users', {}).items():
+                db._conn.execute(
+                    "INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, created_at, last_activity, openai_key) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (int(user_id), user.get('username'), user.get('first_name'), user.get('last_name'),
+                     user.get('created_at'), user.get('last_activity'), user.get('openai_key'))
+                )
+                for command, count in user.get('commands_used', {}).items():
+                    db._conn.execute(
+                        "INSERT OR REPLACE INTO command_counters (user_id, command, count) VALUES (?, ?, ?)",
+                        (int(user_id), command, count)
+                    )
+                counts['users'] += 1
+            for channel_id, channel in data.get('channels', {}).items():
+                db._conn.execute(
+                    "INSERT OR REPLACE INTO channels (channel_id, title, username, owner_id, settings, stats) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (int(channel_id), channel.get('title'), channel.get('username'), int(channel['owner_id']),
+                     json.dumps(channel.get('settings', {}), ensure_ascii=False),
+                     json.dumps(channel.get('stats', {}), ensure_ascii=False))
+                )
+                counts['channels'] += 1
+    finally:
+        db.close()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Перенос database.json в SQLite')
+    parser.add_argument('--json', default='database.json', help='путь к database.json')
+    parser.add_argument('--sqlite', default='database.sqlite3', help='путь к создаваемой базе SQLite')
+    args = parser.parse_args()
+    counts = migrate_json_to_sqlite(args.json, args.sqlite)
+    print(f"Перенесено: пользователей {counts['users']}, каналов {counts['channels']}")
@@ -0,0 +1,130 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import jsoncodec
+from fileutils import write_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore:
+    """
+    Хранилище короткоживущих состояний диалогов (шаги мастера добавления канала и т.п.).
+    Живёт в памяти: у каждой записи есть срок жизни, число записей ограничено (LRU),
+    просроченные записи удаляются лениво при чтении. Опционально раз в snapshot_interval_s
+    секунд сохраняет снимок на диск, чтобы пользователи не теряли шаг после перезапуска.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600, capacity: int = 100000,
+                 snapshot_path: str = None, snapshot_interval_s: float = 60):
+        self.ttl_seconds = ttl_seconds
+        self.capacity = capacity
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval_s = snapshot_interval_s
+        # key -> (expires_at, value), порядок - от давно использованных к недавним
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stop_event = threading.Event()
+        self._snapshotter = None
+        if self.snapshot_path:
+            self._load_snapshot()
+            self._snapshotter = threading.Thread(target=self._snapshot_loop, name='state-snapshot', daemon=True)
+            self._snapshotter.start()
+            atexit.register(self.close)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Получение значения; просроченная запись удаляется"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self._dirty = True
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Dict[str, Any], ttl_seconds: float = None):
+        """Сохранение значения; при переполнении вытесняется давно не использованная запись"""
+        expires_at = time.time() + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def delete(self, key: str) -> bool:
+        """Удаление значения"""
+        with self._lock:
+            if self._entries.pop(key, None) is None:
+                return False
+            self._dirty = True
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def purge_expired(self) -> int:
+        """Удаление всех просроченных записей. Возвращает количество удалённых"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+            for key in expired:
+                del self._entries[key]
+            if expired:
+                self._dirty = True
+        return len(expired)
+
+    def _load_snapshot(self):
+        """Загрузка снимка с пропуском просроченных записей"""
+        if not os.path.exists(self.snapshot_path):
+            return
+        try:
+            entries = jsoncodec.load_file(self.snapshot_path)
+        except ValueError as e:
+            logger.error(f"Не удалось прочитать снимок состояний {self.snapshot_path}: {e}")
+            return
+        now = time.time()
+        for key, (expires_at, value) in entries.items():
+            if expires_at > now:
+                self._entries[key] = (expires_at, value)
+
+    def snapshot(self) -> bool:
+        """Сохранение снимка на диск, если были изменения. Возвращает True, если снимок записан"""
+        if not self.snapshot_path:
+            return False
+        self.purge_expired()
+        with self._lock:
+            if not self._dirty:
+                return False
+            payload = jsoncodec.dumps(
+                {key: [expires_at, value] for key, (expires_at, value) in self._entries.items()}
+            )
+            self._dirty = False
+        write_atomic(self.snapshot_path, payload)
+        return True
+
+    def _snapshot_loop(self):
+        """Фоновое редкое сохранение снимка"""
+        while not self._stop_event.wait(self.snapshot_interval_s):
+            try:
+                self.snapshot()
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении снимка состояний: {e}")
+
+    def close(self):
+        """Остановка фонового потока и финальный снимок"""
+        if self._snapshotter is not None:
+            self._stop_event.set()
+            self._snapshotter.join()
+            self._snapshotter = None
+            self.snapshot()
@@ -0,0 +1,157 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Счётчики в каждом бакете; задержка хранится суммой, среднее - latency_ms / llm_calls
+METRICS = ('messages', 'replies', 'skips', 'tokens', 'llm_calls', 'latency_ms')
+
+# Окна статистики: (имя, ширина бакета в секундах, число бакетов)
+WINDOWS = (
+    ('hour', 60, 60),
+    ('day', 3600, 24),
+    ('month', 86400, 30),
+)
+
+# Счётчик -> поле блока stats канала в хранилище
+STORED_FIELDS = {
+    'messages': 'total_messages',
+    'replies': 'total_replies',
+    'skips': 'total_skipped',
+    'tokens': 'total_tokens',
+}
+
+
+def merge_windows(stored: Optional[Dict[str, Dict[str, list]]],
+                  delta: Optional[Dict[str, Dict[str, list]]]) -> Dict[str, Dict[str, list]]:
+    """
+    Бакеты окон после прибавления приращений: {окно: {номер интервала: [значения METRICS]}}.
+    В окне остаются бакеты последних size интервалов (считая от самого свежего), так что размер
+    ограничен. Результат - новый словарь: читатель прежнего не увидит его изменения на ходу
+    """
+    merged = {}
+    for name, _, size in WINDOWS:
+        buckets = dict((stored or {}).get(name) or {})
+        for slot, values in ((delta or {}).get(name) or {}).items():
+            slot = str(slot)
+            current = buckets.get(slot) or [0] * len(METRICS)
+            buckets[slot] = [a + b for a, b in zip(current, values)]
+        if buckets:
+            newest = max(int(slot) for slot in buckets)
+            merged[name] = {slot: values for slot, values in buckets.items() if int(slot) > newest - size}
+    return merged
+
+
+def window_totals(windows_list: List[Optional[Dict[str, Dict[str, list]]]], now: float) -> Dict[str, Dict[str, float]]:
+    """Суммы по окнам (час, сутки, 30 дней) из бакетов нескольких каналов на момент now"""
+    totals = {}
+    for name, width, size in WINDOWS:
+        current = int(now // width)
+        total = [0] * len(METRICS)
+        for windows in windows_list:
+            for slot, values in ((windows or {}).get(name) or {}).items():
+                if current - size < int(slot) <= current:
+                    for i, value in enumerate(values[:len(METRICS)]):
+                        total[i] += value
+        totals[name] = dict(zip(METRICS, total))
+    return totals
+
+
+class StatsAggregator:
+    """
+    Статистика каналов: события копятся в памяти как приращения итоговых счётчиков и бакетов окон
+    (минуты за час, часы за сутки, дни за месяц) и раз в flush_interval_s уходят в хранилище
+    одной операцией add_channel_stats, а не сохранением базы на каждый комментарий.
+
+    Окна хранятся вместе со статистикой канала, поэтому переживают перезапуск, а при шардировании
+    экран владельца видит каналы, которые считают другие воркеры (с задержкой до flush_interval_s)
+    """
+
+    def __init__(self, db, flush_interval_s: float = 30.0):
+        self.db = db
+        self.flush_interval_s = flush_interval_s
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # channel_id -> приращения для хранилища
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._stop = threading.Event()
+        self._flusher = None
+        if self.flush_interval_s > 0:
+            self._flusher = threading.Thread(target=self._flusher_loop, name='stats-flusher', daemon=True)
+            self._flusher.start()
+
+    def record(self, channel_id, now: float = None, **values):
+        """Учёт события: record(chat.id, messages=1) или replies=1, tokens=..., latency_ms=..."""
+        now = time.time() if now is None else now
+        vector = [values.get(metric, 0) for metric in METRICS]
+        channel_id = str(channel_id)
+        with self._lock:
+            delta = self._pending.get(channel_id)
+            if delta is None:
+                delta = self._pending[channel_id] = {}
+            for metric, field in STORED_FIELDS.items():
+                value = values.get(metric)
+                if value:
+                    delta[field] = delta.get(field, 0) + value
+            delta['last_activity'] = datetime.fromtimestamp(now).isoformat()
+
+            windows = delta.setdefault('windows', {})
+            for name, width, _ in WINDOWS:
+                bucket = windows.setdefault(name, {}).setdefault(str(int(now // width)), [0] * len(METRICS))
+                for i, value in enumerate(vector):
+                    if value:
+                        bucket[i] += value
+
+    def windows_for(self, channels: List[Dict[str, Any]], now: float = None) -> Dict[str, Dict[str, float]]:
+        """Суммы по окнам для каналов из хранилища (экран владельца): сохранённые бакеты плюс ещё не записанные"""
+        now = time.time() if now is None else now
+        stored = [(channel.get('stats') or {}).get('windows') for channel in channels]
+        with self._lock:
+            pending = [self._pending.get(str(channel['id']), {}).get('windows') for channel in channels]
+            return window_totals(stored + pending, now)
+
+    def pending_for(self, channel_id) -> Dict[str, Any]:
+        """Приращения итоговых счётчиков канала, ещё не записанные в хранилище"""
+        with self._lock:
+            return {key: value for key, value in self._pending.get(str(channel_id), {}).items() if key != 'windows'}
+
+    def flush(self) -> int:
+        """Запись накопленных приращений в хранилище; возвращает число каналов"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            try:
+                self.db.add_channel_stats(pending)
+            except Exception:
+                # Возвращаем приращения, чтобы не потерять их до следующей попытки
+                with self._lock:
+                    for channel_id, delta in pending.items():
+                        current = self._pending.setdefault(channel_id, {})
+                        for key, value in delta.items():
+                            if key == 'last_activity':
+                                current.setdefault(key, value)
+                            elif key == 'windows':
+                                current[key] = merge_windows(current.get(key), value)
+                            else:
+                                current[key] = current.get(key, 0) + value
+                raise
+            return len(pending)
+
+    def _flusher_loop(self):
+        while not self._stop.wait(self.flush_interval_s):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении статистики: {e}")
+
+    def close(self):
+        """Остановка фоновой записи и сохранение накопленных приращений"""
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
@@ -0,0 +1,365 @@
+import argparse
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO,
+    stream=sys.stdout
+)
+
+logger = logging.getLogger(__name__)
+
+BUILTIN_BACKENDS = ('json', 'journal', 'sqlite')
+
+# Пакет приращений статистики в add_channel_stats, как у StatsAggregator за один интервал
+STATS_BATCH = 100
+
+
+# ---- Наборы данных ----
+
+def _user_records(users: int, rng: random.Random) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Пользователи в формате database.json: у части есть ключ OpenAI и история команд"""
+    now = datetime.now()
+    for user_id in range(1, users + 1):
+        created = now - timedelta(days=rng.randrange(365))
+        yield str(user_id), {
+            'username': f'user{user_id}',
+            'first_name': f'User{user_id}',
+            'last_name': None,
+            'created_at': created.isoformat(),
+            'last_activity': (created + timedelta(days=rng.randrange(30))).isoformat(),
+            'commands_used': {'start': rng.randrange(1, 20)},
+            'openai_key': f'sk-{user_id:032d}' if rng.random() < 0.3 else None
+        }
+
+
+def _owner(users: int, rng: random.Random) -> int:
+    """Владелец канала со смещённым распределением: у немногих владельцев много каналов"""
+    return 1 + int((users - 1) * rng.random() ** 3)
+
+
+def _channel_records(users: int, channels: int, rng: random.Random) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Каналы в формате database.json с настройками, как их создаёт add_channel"""
+    for index in range(channels):
+        channel_id = -1000000000000 - index
+        yield str(channel_id), {
+            'id': channel_id,
+            'title': f'Канал {index}',
+            'username': f'channel_{index}',
+            'owner_id': _owner(users, rng),
+            'settings': {
+                'auto_reply_enabled': True,
+                'assistant_settings': {
+                    'model': 'gpt-3.5-turbo',
+                    'temperature': 0.7,
+                    'max_tokens': 150,
+                    'system_prompt': 'Отвечай кратко и по существу',
+                    'response_style': 'friendly'
+                }
+            },
+            'stats': {
+                'total_messages': rng.randrange(10000),
+                'total_replies': rng.randrange(5000),
+                'last_activity': None
+            }
+        }
+
+
+def _write_section(f, name: str, records: Iterator[Tuple[str, Dict[str, Any]]], last: bool):
+    """Потоковая запись раздела в том же виде, что json.dumps(..., indent=4) в save_data"""
+    f.write(f'    "{name}": {{')
+    first = True
+    for key, value in records:
+        body = json.dumps(value, ensure_ascii=False, indent=4).replace('\n', '\n        ')
+        f.write(('\n' if first else ',\n') + f'        "{key}": {body}')
+        first = False
+    f.write('\n    }' if not first else '}')
+    f.write('\n' if last else ',\n')
+
+
+def generate_dataset(path: str, users: int, channels: int, seed: int):
+    """database.json заданного размера; записи пишутся потоком, не собираясь в памяти целиком"""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{\n')
+        _write_section(f, 'users', _user_records(users, rng), last=False)
+        _write_section(f, 'channels', _channel_records(users, channels, rng), last=True)
+        f.write('}')
+
+
+def _load_backend_factory(backend: str) -> Callable[[str], Any]:
+    """Фабрика хранилища: имя из create_database или module:callable, принимающий путь к базе"""
+    if backend in BUILTIN_BACKENDS:
+        from database import create_database
+        return lambda path: create_database(backend, path=path)
+    module_name, _, attr = backend.partition(':')
+    if not attr:
+        raise ValueError(f"Хранилище задаётся именем ({', '.join(BUILTIN_BACKENDS)}) или как module:callable")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def _database_file(backend: str) -> str:
+    return 'database.sqlite3' if backend == 'sqlite' else 'database.json'
+
+
+def prepare_backend(backend: str, dataset_path: str, target_dir: str):
+    """
+    Перенос набора данных в формат хранилища: JSON и журнал читают database.json как есть,
+    SQLite заполняется migrate_json_to_sqlite, остальные - через публичные методы
+    """
+    target = os.path.join(target_dir, _database_file(backend))
+    if backend in ('json', 'journal'):
+        shutil.copyfile(dataset_path, target)
+    elif backend == 'sqlite':
+        from sqlite_database import migrate_json_to_sqlite
+        migrate_json_to_sqlite(dataset_path, target)
+    else:
+        with open(dataset_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        db = _load_backend_factory(backend)(target)
+        try:
+            for user_id, user in data['users'].items():
+                db.add_user(int(user_id), user['username'], user['first_name'], user['last_name'])
+                if user['openai_key']:
+                    db.set_user_openai_key(int(user_id), user['openai_key'])
+            for channel in data['channels'].values():
+                db.add_channel(channel['id'], channel['title'], channel['owner_id'], channel['username'])
+        finally:
+            db.close()
+
+
+# ---- Замеры ----
+
+def _peak_rss_mb() -> float:
+    """Пиковый RSS процесса, МБ (ru_maxrss - килобайты в Linux, байты в macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+def measure(call: Callable[[int], Any], budget_s: float, max_calls: int) -> Dict[str, float]:
+    """Повторяет call(i), пока не исчерпан бюджет времени или число вызовов; хотя бы один вызов"""
+    timings = []
+    deadline = time.perf_counter() + budget_s
+    for index in range(max_calls):
+        started = time.perf_counter()
+        call(index)
+        finished = time.perf_counter()
+        timings.append(finished - started)
+        if finished >= deadline:
+            break
+    return {
+        'calls': len(timings),
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 4),
+        'p50_ms': round(_percentile(timings, 50) * 1000, 4),
+        'p99_ms': round(_percentile(timings, 99) * 1000, 4)
+    }
+
+
+def build_operations(db, users: int, channels: int, rng: random.Random) -> List[Tuple[str, Callable[[int], Any]]]:
+    """
+    Микробенчмарки публичных методов хранилища в порядке выполнения: сначала чтение,
+    потом изменения (transfer/remove работают с каналами, добавленными в add_channel)
+    """
+    channel_ids = [-1000000000000 - index for index in range(channels)]
+    added_channels: List[int] = []
+    new_user_base = users + 1
+
+    def random_user() -> int:
+        return rng.randint(1, users)
+
+    def random_owner() -> int:
+        return _owner(users, rng)
+
+    def add_channel(index: int):
+        channel_id = -2000000000000 - index
+        db.add_channel(channel_id, f'Новый канал {index}', random_owner(), f'new_channel_{index}')
+        added_channels.append(channel_id)
+
+    def transfer_channel(index: int):
+        db.transfer_channel(added_channels[index % len(added_channels)], random_user())
+
+    def remove_channel(index: int):
+        if added_channels:
+            db.remove_channel(added_channels.pop())
+
+    def add_channel_stats(index: int):
+        db.add_channel_stats({
+            channel_id: {'total_messages': 3, 'total_replies': 2, 'last_activity': datetime.now().isoformat()}
+            for channel_id in rng.sample(channel_ids, min(STATS_BATCH, len(channel_ids)))
+        })
+
+    def state_churn(index: int):
+        # Шаг мастера настройки: запись состояния, чтение, сброс
+        user_id = random_user()
+        db.set_user_state(user_id, 'waiting_for_channel_username', {'channel_username': f'channel_{index}'})
+        db.get_user_state(user_id)
+        db.clear_user_state(user_id)
+
+    operations = [
+        ('get_channel', lambda index: db.get_channel(rng.choice(channel_ids))),
+        ('get_user_channels', lambda index: db.get_user_channels(random_owner())),
+        ('get_user_openai_key', lambda index: db.get_user_openai_key(random_user())),
+        ('get_user_stats', lambda index: db.get_user_stats(random_user())),
+        ('get_all_users', lambda index: db.get_all_users()),
+        ('state_churn', state_churn),
+        ('add_user', lambda index: db.add_user(new_user_base + index, f'new{index}', 'New', None)),
+        ('update_user_activity', lambda index: db.update_user_activity(random_user(), command='start')),
+        ('set_user_openai_key', lambda index: db.set_user_openai_key(random_user(), f'sk-new-{index}')),
+        ('add_channel', add_channel),
+        ('update_channel_settings', lambda index: db.update_channel_settings(
+            rng.choice(channel_ids), {'auto_reply_enabled': index % 2 == 0})),
+        ('transfer_channel', transfer_channel),
+        ('add_channel_stats', add_channel_stats),
+        ('remove_channel', remove_channel),
+    ]
+    # Полное сохранение есть только у файловых хранилищ
+    if callable(getattr(db, 'save_data', None)):
+        operations.append(('save_data', lambda index: db.save_data()))
+    return operations
+
+
+def run_case(backend: str, prepared_dir: str, size: int, channels: int, options: Dict[str, Any], conn):
+    """Один прогон (хранилище, размер) в отдельном процессе, чтобы пиковый RSS относился только к нему"""
+    logging.getLogger().setLevel(logging.WARNING)
+    case_dir = tempfile.mkdtemp(prefix=f'storage-bench-{backend.replace(":", "-")}-', dir=options['workdir'])
+    try:
+        name = _database_file(backend)
+        shutil.copyfile(os.path.join(prepared_dir, name), os.path.join(case_dir, name))
+        path = os.path.join(case_dir, name)
+        factory = _load_backend_factory(backend)
+
+        rss_before = _peak_rss_mb()
+        started = time.perf_counter()
+        db = factory(path)
+        result: Dict[str, Any] = {
+            'load_s': round(time.perf_counter() - started, 4),
+            'load_rss_mb': round(_peak_rss_mb() - rss_before, 1),
+            'file_mb': round(os.path.getsize(path) / (1024 * 1024), 2),
+            'operations': {}
+        }
+        rng = random.Random(options['seed'])
+        try:
+            for op_name, call in build_operations(db, size, channels, rng):
+                result['operations'][op_name] = measure(call, options['op_time'], options['max_calls'])
+        finally:
+            started = time.perf_counter()
+            db.close()
+            result['close_s'] = round(time.perf_counter() - started, 4)
+        result['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+        conn.send(result)
+    except Exception as e:
+        conn.send({'error': f'{type(e).__name__}: {e}'})
+    finally:
+        shutil.rmtree(case_dir, ignore_errors=True)
+
+
+def format_table(backend: str, results: Dict[int, Dict[str, Any]]) -> str:
+    """Таблица масштабирования: строки - метрики и методы (p50, мс), столбцы - размеры базы"""
+    sizes = sorted(results)
+    width = 14
+    lines = [f"Хранилище: {backend}", f"{'':<26}" + ''.join(f"{size:>{width},}" for size in sizes)]
+
+    def row(title: str, value: Callable[[Dict[str, Any]], Any]):
+        cells = []
+        for size in sizes:
+            result = results[size]
+            cells.append('ошибка' if 'error' in result else value(result))
+        lines.append(f"{title:<26}" + ''.join(f"{str(cell):>{width}}" for cell in cells))
+
+    row('load_data, с', lambda r: r['load_s'])
+    row('RSS загрузки, МБ', lambda r: r['load_rss_mb'])
+    row('пиковый RSS, МБ', lambda r: r['peak_rss_mb'])
+    row('файл, МБ', lambda r: r['file_mb'])
+    operations = []
+    for result in results.values():
+        for op_name in result.get('operations', {}):
+            if op_name not in operations:
+                operations.append(op_name)
+    for op_name in operations:
+        row(f"{op_name}, мс", lambda r, op_name=op_name: r['operations'].get(op_name, {}).get('p50_ms', '-'))
+    for size in sizes:
+        if 'error' in results[size]:
+            lines.append(f"{size:,}: {results[size]['error']}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Масштабирование хранилища: загрузка, память и методы на разных размерах базы')
+    parser.add_argument('--backends', default='json,journal,sqlite',
+                        help='хранилища через запятую: json, journal, sqlite или module:callable(path)')
+    parser.add_argument('--sizes', default='10000,100000',
+                        help='число пользователей через запятую (например 10000,100000,1000000)')
+    parser.add_argument('--channel-ratio', type=float, default=1.0, help='каналов на пользователя')
+    parser.add_argument('--op-time', type=float, default=1.0, help='бюджет времени на один метод, с')
+    parser.add_argument('--max-calls', type=int, default=2000, help='максимум вызовов одного метода')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='каталог для наборов данных (по умолчанию временный)')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    backends = [backend.strip() for backend in args.backends.split(',') if backend.strip()]
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='storage-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    options = {'op_time': args.op_time, 'max_calls': args.max_calls, 'seed': args.seed, 'workdir': workdir}
+    context = multiprocessing.get_context('spawn')
+
+    results: Dict[str, Dict[int, Dict[str, Any]]] = {backend: {} for backend in backends}
+    try:
+        for size in sizes:
+            channels = max(1, int(size * args.channel_ratio))
+            size_dir = os.path.join(workdir, str(size))
+            os.makedirs(size_dir, exist_ok=True)
+            dataset_path = os.path.join(size_dir, 'dataset.json')
+            started = time.perf_counter()
+            generate_dataset(dataset_path, size, channels, args.seed)
+            logger.info(f"Набор данных: {size} пользователей, {channels} каналов "
+                        f"({time.perf_counter() - started:.1f} с)")
+            for backend in backends:
+                prepared_dir = os.path.join(size_dir, backend.replace(':', '-'))
+                os.makedirs(prepared_dir, exist_ok=True)
+                prepare_backend(backend, dataset_path, prepared_dir)
+                parent_conn, child_conn = context.Pipe()
+                process = context.Process(target=run_case,
+                                          args=(backend, prepared_dir, size, channels, options, child_conn))
+                process.start()
+                result: Optional[Dict[str, Any]] = None
+                while process.is_alive() or parent_conn.poll():
+                    if parent_conn.poll(1):
+                        result = parent_conn.recv()
+                        break
+                process.join()
+                results[backend][size] = result or {'error': f'процесс завершился с кодом {process.exitcode}'}
+                logger.info(f"{backend}, {size}: готово")
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for backend in backends:
+        print()
+        print(format_table(backend, results[backend]))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({backend: {str(size): result for size, result in by_size.items()}
+                       for backend, by_size in results.items()}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from telegram.error import BadRequest, RetryAfter
+
+from outbound_dispatcher import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+# Признак того, что ответ ещё печатается
+TYPING_SUFFIX = ' …'
+
+
+async def stream_reply(message, chunks: AsyncIterator[str], edit_interval: float = 1.5,
+                       first_chunk_chars: int = 20,
+                       abort_if: Optional[Callable[[str, int], bool]] = None,
+                       on_reply: Optional[Callable[[int], None]] = None,
+                       edit_rate_limit_args: Optional[Dict[str, Any]] = None) -> Optional[str]:
+    """
+    Ответ на сообщение по мере генерации: как только набралось first_chunk_chars символов,
+    отправляется первый ответ, дальше он редактируется не чаще раза в edit_interval секунд
+    (лимиты Telegram на редактирование), последним редактированием ставится итоговый текст.
+
+    Возвращает итоговый текст или None, если abort_if(текст, начало_новой_части) остановил генерацию
+    (проверяется только дописанное, а не весь текст на каждом фрагменте);
+    on_reply(message_id) получает id дописанного ответа. edit_rate_limit_args передаются
+    ограничителю запросов с промежуточными правками (например {'drop_if_limited': True}),
+    чтобы они пропускались при исчерпанном лимите, а не ждали в очереди.
+    Если поток оборвался или задачу отменили, недописанный ответ удаляется, ошибка пробрасывается
+    """
+    loop = asyncio.get_running_loop()
+    text = ''
+    shown = ''
+    reply = None
+    next_edit_at = 0.0
+    try:
+        async for delta in chunks:
+            checked = len(text)
+            text += delta
+            if abort_if is not None and abort_if(text, checked):
+                logger.warning(f"Генерация ответа в чате {message.chat_id} остановлена фильтром")
+                await _delete(reply)
+                return None
+            visible = text.strip()
+            if loop.time() < next_edit_at or len(visible) < first_chunk_chars:
+                continue
+            visible = visible[:MAX_MESSAGE_LENGTH - len(TYPING_SUFFIX)] + TYPING_SUFFIX
+            try:
+                if reply is None:
+                    reply = await message.reply_text(visible)
+                else:
+                    await reply.edit_text(visible, rate_limit_args=edit_rate_limit_args)
+                shown = visible
+                next_edit_at = loop.time() + edit_interval
+            except RetryAfter as e:
+                # Промежуточное редактирование не обязательно: лимит исчерпан (Throttled от ограничителя
+                # или RetryAfter от Telegram) - пропускаем его, следующее не раньше окна лимита
+                next_edit_at = loop.time() + retry_after_seconds(e)
+
+        text = text.strip()[:MAX_MESSAGE_LENGTH]
+        if not text:
+            raise ValueError("модель вернула пустой ответ")
+        if reply is None:
+            reply = await message.reply_text(text)
+        elif text != shown:
+            await _final_edit(reply, text, next_edit_at - loop.time())
+        if on_reply is not None:
+            on_reply(reply.message_id)
+        return text
+    except BaseException:
+        # В том числе asyncio.CancelledError: недописанный ответ в чате не оставляем
+        await _delete(reply)
+        raise
+    finally:
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+async def _final_edit(reply, text: str, wait: float):
+    """
+    Итоговое редактирование: его пропустить нельзя, поэтому ждём окно лимита. С ограничителем запросов
+    RetryAfter повторяет он сам; здесь повтор нужен, когда ограничитель выключен
+    """
+    if wait > 0:
+        await asyncio.sleep(wait)
+    try:
+        await reply.edit_text(text)
+    except RetryAfter as e:
+        await asyncio.sleep(retry_after_seconds(e))
+        await reply.edit_text(text)
+    except BadRequest as e:
+        # "Message is not modified" - текст уже совпадает
+        if 'not modified' not in str(e).lower():
+            raise
+
+
+async def _delete(reply):
+    """Удаление недописанного ответа; ошибки удаления только логируются"""
+    if reply is None:
+        return
+    try:
+        await reply.delete()
+    except Exception as e:
+        logger.error(f"Не удалось удалить недописанный ответ: {e}")
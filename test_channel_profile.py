@@ -0,0 +1,70 @@
+import unittest
+
+from channel_profile import WordMatcher, compile_word_matcher
+
+
+def stream_check(matcher, chunks):
+    """Проверка дописываемого текста так, как это делает потоковый ответ: только новая часть"""
+    text = ''
+    for chunk in chunks:
+        checked = len(text)
+        text += chunk
+        found = matcher.search(text, checked)
+        if found is not None:
+            return found
+    return None
+
+
+class WordMatcherTest(unittest.TestCase):
+    """Поиск запрещённых слов целиком, в том числе в тексте, который дописывается по частям"""
+
+    def setUp(self):
+        self.matcher = compile_word_matcher(['казино', 'ставки на спорт', '  ', 'Бот'])
+
+    def test_whole_words_only(self):
+        self.assertEqual(self.matcher.search('Новое КАЗИНО открылось'), 'казино')
+        self.assertEqual(self.matcher.search('бот.'), 'бот')
+        # Слово внутри более длинного слова - не совпадение
+        self.assertIsNone(self.matcher.search('казиномания и роботы'))
+        self.assertIsNone(self.matcher.search('суперказино'))
+        self.assertIsNone(self.matcher.search('ботаника'))
+        self.assertIsNone(compile_word_matcher(['', '  ']))
+
+    def test_phrases(self):
+        self.assertEqual(self.matcher.search('Делайте ставки на спорт!'), 'ставки на спорт')
+        self.assertIsNone(self.matcher.search('ставки на спортсменов'))
+        self.assertIsNone(self.matcher.search('ставки на'))
+
+    def test_word_split_across_chunks(self):
+        self.assertEqual(stream_check(self.matcher, ['Заходите в ка', 'зи', 'но сегодня']), 'казино')
+        self.assertEqual(stream_check(self.matcher, ['ставки на', ' спо', 'рт']), 'ставки на спорт')
+        self.assertIsNone(stream_check(self.matcher, ['Это ро', 'бот', 'ы и суперка', 'зино']))
+
+    def test_match_at_overlap_start(self):
+        matcher = WordMatcher(['казино'])
+        # Слово начинается ровно на since - max_length: оно целиком в перекрытии и находится
+        self.assertEqual(matcher.search('xx казино', since=3 + matcher.max_length), 'казино')
+        # Символ перед окном - буква: это конец более длинного слова, а не отдельное слово
+        self.assertIsNone(matcher.search('xxказино', since=2 + matcher.max_length))
+        # Новая часть дописывает слово, начатое в уже проверенной
+        self.assertEqual(matcher.search('xx казино', since=8), 'казино')
+        # Слова, закончившиеся до перекрытия, уже проверены раньше
+        self.assertIsNone(matcher.search('казино и ещё немного', since=20))
+
+    def test_since_matches_full_scan(self):
+        chunks = ['Нет, ', 'суперказ', 'ино', ' — не ', 'бота', 'ника', ', а каз', 'ино', '; бот']
+        text = ''
+        first_incremental = first_full = None
+        for step, chunk in enumerate(chunks):
+            checked = len(text)
+            text += chunk
+            if first_incremental is None and self.matcher.search(text, checked) is not None:
+                first_incremental = step
+            if first_full is None and self.matcher.search(text) is not None:
+                first_full = step
+        # Проверка по частям останавливает генерацию на том же фрагменте, что и проверка всего текста
+        self.assertEqual(first_incremental, first_full)
+        self.assertEqual(first_full, 7)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from types import SimpleNamespace
+
+from channel_profile import ChannelProfile
+from comment_triage import TRIAGE_RULES, CommentTriage
+
+CHAT = -100
+
+
+def make_profile(**assistant_settings):
+    return ChannelProfile({'id': CHAT, 'owner_id': 1, 'settings': {'assistant_settings': assistant_settings}})
+
+
+def make_message(text='Когда следующий эфир?', user_id=7, is_bot=False, chat_id=CHAT,
+                 is_automatic_forward=False, sender_chat=None):
+    sender = SimpleNamespace(id=user_id, is_bot=is_bot) if user_id is not None else None
+    return SimpleNamespace(text=text, chat_id=chat_id, from_user=sender, sender_chat=sender_chat,
+                           is_automatic_forward=is_automatic_forward)
+
+
+class CommentTriageRulesTest(unittest.TestCase):
+    """Решение каждого правила и счётчики пропусков"""
+
+    def setUp(self):
+        self.triage = CommentTriage()
+        self.profile = make_profile(forbidden_words=['казино'])
+
+    def check(self, message, now=0.0, profile=None):
+        return self.triage.check(message, profile or self.profile, now=now)
+
+    def test_each_rule(self):
+        cases = [
+            ('bot_message', make_message(is_bot=True)),
+            ('automatic_forward', make_message(is_automatic_forward=True)),
+            ('no_text', make_message(text=None)),
+            ('too_short', make_message(text=' a ')),
+            ('too_long', make_message(text='слово ' * 400)),
+            ('no_words', make_message(text='+1')),
+            ('symbols', make_message(text='ок!!!!!!')),
+            ('link_only', make_message(text='https://example.com/page @channel')),
+            ('forbidden_words', make_message(text='Лучшее КАЗИНО тут')),
+        ]
+        for index, (rule, message) in enumerate(cases):
+            with self.subTest(rule=rule):
+                # Разные моменты и тексты, чтобы не сработали повтор и пауза автора
+                self.assertEqual(self.check(message, now=index * 1000.0), rule)
+        self.assertIsNone(self.check(make_message(text='Ссылка https://example.com - это про что?'), now=10 ** 5))
+        report = self.triage.report()
+        self.assertEqual((report['checked'], report['skipped'], report['passed']), (len(cases) + 1, len(cases), 1))
+        self.assertEqual(report['by_rule'], {rule: 1 for rule, _ in cases})
+
+    def test_disabled_rules_are_not_applied(self):
+        triage = CommentTriage(enabled_rules=['no_text'])
+        self.assertIsNone(triage.check(make_message(text='+1'), self.profile, now=0.0))
+        self.assertEqual(triage.check(make_message(text=''), self.profile, now=0.0), 'no_text')
+        with self.assertRaises(ValueError):
+            CommentTriage(enabled_rules=['no_text', 'unknown'])
+        self.assertEqual(set(self.triage.skipped_by_rule), set(TRIAGE_RULES))
+
+    def test_duplicate_within_window(self):
+        self.assertIsNone(self.check(make_message(text='Спасибо за пост!', user_id=1), now=0.0))
+        # Тот же текст после нормализации от другого автора
+        self.assertEqual(self.check(make_message(text='спасибо за пост', user_id=2), now=100.0), 'duplicate')
+        # В другом чате - не повтор
+        self.assertIsNone(self.check(make_message(text='спасибо за пост', chat_id=-200), now=100.0))
+        # Окно считается от последнего появления
+        self.assertEqual(self.check(make_message(text='спасибо за пост'), now=350.0), 'duplicate')
+        self.assertIsNone(self.check(make_message(text='спасибо за пост'), now=700.0))
+        self.assertEqual(self.triage.skipped_by_rule['duplicate'], 2)
+
+    def test_cooldown_per_author(self):
+        triage = CommentTriage(cooldown_s=60)
+        self.assertIsNone(triage.check(make_message(text='первый вопрос'), self.profile, now=0.0))
+        self.assertEqual(triage.check(make_message(text='второй вопрос'), self.profile, now=30.0), 'cooldown')
+        # Другой автор не ждёт
+        self.assertIsNone(triage.check(make_message(text='третий вопрос', user_id=8), self.profile, now=30.0))
+        # Пауза считается от последнего пропущенного к LLM, а не от отсеянного
+        self.assertIsNone(triage.check(make_message(text='четвёртый вопрос'), self.profile, now=61.0))
+        # Анонимный администратор - автор по sender_chat
+        anonymous = dict(user_id=None, sender_chat=SimpleNamespace(id=CHAT))
+        self.assertIsNone(triage.check(make_message(text='от имени чата', **anonymous), self.profile, now=0.0))
+        self.assertEqual(triage.check(make_message(text='ещё от чата', **anonymous), self.profile, now=1.0),
+                         'cooldown')
+        self.assertEqual(triage.skipped_by_rule['cooldown'], 2)
+
+    def test_tracked_keys_are_evicted_oldest_first(self):
+        triage = CommentTriage(max_tracked=2, cooldown_s=60)
+        for index, text in enumerate(('один', 'два', 'три')):
+            triage.check(make_message(text=f'вопрос {text}', user_id=index), self.profile, now=float(index))
+        self.assertEqual(len(triage._recent_texts), 2)
+        self.assertEqual([author for _, author in triage._last_passed], [1, 2])
+        # Вытесненный текст и автор больше не считаются повтором и не ждут паузы
+        self.assertIsNone(triage.check(make_message(text='вопрос один', user_id=0), self.profile, now=3.0))
+        # Повторное появление освежает ключ: вытесняется самый давний, а не самый первый добавленный
+        self.assertEqual(triage.check(make_message(text='вопрос три', user_id=5), self.profile, now=4.0), 'duplicate')
+        triage.check(make_message(text='вопрос четыре', user_id=6), self.profile, now=5.0)
+        self.assertEqual(triage.check(make_message(text='вопрос три', user_id=7), self.profile, now=6.0), 'duplicate')
+
+    def test_channel_overrides_thresholds(self):
+        strict = make_profile(triage={'min_chars': 10, 'duplicate_window_s': 0, 'cooldown_s': 60})
+        self.assertEqual(self.check(make_message(text='коротко'), profile=strict), 'too_short')
+        self.assertIsNone(self.check(make_message(text='коротко'), now=1.0))
+        # Повторы в канале разрешены, зато действует пауза автора
+        self.assertIsNone(self.check(make_message(text='одинаковый текст', user_id=1), now=2.0, profile=strict))
+        self.assertIsNone(self.check(make_message(text='одинаковый текст', user_id=2), now=3.0, profile=strict))
+        self.assertEqual(self.check(make_message(text='другой текст', user_id=1), now=4.0, profile=strict),
+                         'cooldown')
+        # Переопределение канала не меняет пороги по умолчанию для остальных
+        self.assertEqual(self.triage.defaults['min_chars'], 2)
+        self.assertIsNone(self.check(make_message(text='одинаковый текст', user_id=3), now=5.0))
+        self.assertEqual(self.check(make_message(text='одинаковый текст', user_id=4), now=6.0), 'duplicate')
+
+if __name__ == '__main__':
+    unittest.main()
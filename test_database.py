@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from database import JournaledUserDatabase, UserDatabase
+
+
+class JournalCompactionRaceTest(unittest.TestCase):
+    """Уплотнение журнала, запущенное между применением изменения и его записью в журнал"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'database.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _open(self):
+        # Фоновое уплотнение по таймеру не мешает: запускаем его вручную
+        return JournaledUserDatabase(self.path, compact_every=10 ** 6, compact_interval_ms=10 ** 7)
+
+    def test_counters_survive_reload_after_compaction_in_gap(self):
+        db = self._open()
+        db.add_user(1, 'owner')
+        db.add_channel(-100, 'Канал', 1)
+        db.add_channel_stats({'-100': {'total_messages': 1}})
+        db.update_user_activity(1, 'start')
+
+        persist = db._persist
+        compactions = []
+
+        def compact_then_persist(record):
+            # Применённое изменение уже видно; уплотнение в этот момент не должно его потерять или задвоить
+            compaction = threading.Thread(target=db.flush)
+            compaction.start()
+            compaction.join(0.2)
+            compactions.append(compaction)
+            persist(record)
+
+        db._persist = compact_then_persist
+        db.add_channel_stats({'-100': {'total_messages': 2}})
+        db.update_user_activity(1, 'start')
+        db._persist = persist
+        for compaction in compactions:
+            compaction.join()
+
+        expected_messages = db.get_channel(-100)['stats']['total_messages']
+        expected_commands = db.users['users']['1']['commands_used']
+        self.assertEqual(expected_messages, 3)
+        # Читаем файлы как есть, без итогового снимка при остановке - как после падения процесса
+        reloaded = self._open()
+        self.assertEqual(reloaded.get_channel(-100)['stats']['total_messages'], expected_messages)
+        self.assertEqual(reloaded.users['users']['1']['commands_used'], expected_commands)
+        reloaded.close()
+        db.close()
+
+
+class FailedSaveTest(unittest.TestCase):
+    """Неудачная запись снимка не теряет изменения: их сохраняет следующий сброс"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'database.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_data_failure_keeps_changes_dirty(self):
+        db = UserDatabase(self.path, write_behind=True, flush_interval_ms=10 ** 7)
+        db.add_user(1, 'owner')
+        with mock.patch('database.write_atomic', side_effect=OSError('диск заполнен')):
+            with self.assertRaises(OSError):
+                db.save_data()
+        self.assertTrue(db.flush())
+        self.assertEqual(UserDatabase(self.path).get_user_stats(1)['username'], 'owner')
+        db.close()
+
+
+class JournalOpenFailureTest(unittest.TestCase):
+    """Журнал, который не удалось открыть, не оставляет фоновый поток и обработчик atexit"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_flusher_when_journal_cannot_be_opened(self):
+        journal_path = os.path.join(self.directory, 'missing', 'database.json.journal')
+        flushers = {thread for thread in threading.enumerate() if thread.name == 'database-flusher'}
+        with mock.patch('database.atexit.register') as register:
+            with self.assertRaises(FileNotFoundError):
+                JournaledUserDatabase(os.path.join(self.directory, 'database.json'), journal_path=journal_path)
+        register.assert_not_called()
+        self.assertEqual({thread for thread in threading.enumerate() if thread.name == 'database-flusher'}, flushers)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import asyncio
+import unittest
+
+from llm_scheduler import LLMScheduler, SchedulerQueueFull
+
+
+class Abort(BaseException):
+    """Не Exception: так ведут себя отмена и остановка процесса"""
+
+
+class LLMSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    """Очереди каналов по кругу, политики переполнения и завершение ожидающих при отмене"""
+
+    def _scheduler(self, **options):
+        options.setdefault('max_concurrency', 1)
+        return LLMScheduler(requests_per_minute=10 ** 6, tokens_per_minute=10 ** 9, **options)
+
+    async def asyncTearDown(self):
+        await self.scheduler.close()
+
+    async def _occupy(self):
+        """Единственный слот занят, пока не откроется gate - следующие запросы копятся в очереди"""
+        gate = asyncio.Event()
+        running = asyncio.ensure_future(self.scheduler.submit('key', 'busy', gate.wait))
+        while self.scheduler.stats()['in_flight'] == 0:
+            await asyncio.sleep(0)
+        return gate, running
+
+    def _job(self, order, name):
+        async def call():
+            order.append(name)
+            return name
+        return call
+
+    async def test_channels_are_served_round_robin(self):
+        self.scheduler = self._scheduler()
+        gate, running = await self._occupy()
+        order = []
+        submitted = [self.scheduler.submit('key', 'noisy', self._job(order, f'noisy-{i}')) for i in range(3)]
+        submitted.append(self.scheduler.submit('key', 'quiet', self._job(order, 'quiet-0')))
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in submitted]
+        await asyncio.sleep(0)
+        self.assertEqual(self.scheduler.queue_depth(), 4)
+        self.assertEqual(self.scheduler.queue_depth('noisy'), 3)
+        gate.set()
+        results = await asyncio.gather(running, *tasks)
+        # Тихий канал не ждёт, пока шумный разберёт всю свою очередь
+        self.assertEqual(order, ['noisy-0', 'quiet-0', 'noisy-1', 'noisy-2'])
+        self.assertEqual(results[1:], ['noisy-0', 'noisy-1', 'noisy-2', 'quiet-0'])
+        self.assertEqual(self.scheduler.stats()['completed'], 5)
+
+    async def test_drop_new_rejects_request_over_channel_limit(self):
+        self.scheduler = self._scheduler(max_queue_per_channel=1)
+        gate, running = await self._occupy()
+        order = []
+        first = asyncio.ensure_future(self.scheduler.submit('key', 'chat', self._job(order, 'first')))
+        await asyncio.sleep(0)
+        with self.assertRaises(SchedulerQueueFull):
+            await self.scheduler.submit('key', 'chat', self._job(order, 'second'))
+        gate.set()
+        self.assertEqual(await first, 'first')
+        await running
+        self.assertEqual(order, ['first'])
+        self.assertEqual(self.scheduler.stats()['dropped'], 1)
+
+    async def test_drop_oldest_evicts_from_longest_queue(self):
+        self.scheduler = self._scheduler(max_queue=3, overflow_policy='drop_oldest')
+        gate, running = await self._occupy()
+        order = []
+        names = ['a-0', 'a-1', 'b-0', 'c-0']
+        tasks = {}
+        for name in names:
+            tasks[name] = asyncio.ensure_future(self.scheduler.submit('key', name[0], self._job(order, name)))
+            await asyncio.sleep(0)
+        gate.set()
+        await running
+        # Общая очередь заполнена: вытесняется самый старый запрос самой длинной очереди
+        with self.assertRaises(SchedulerQueueFull):
+            await tasks['a-0']
+        self.assertEqual(await asyncio.gather(tasks['a-1'], tasks['b-0'], tasks['c-0']), ['a-1', 'b-0', 'c-0'])
+        self.assertEqual(sorted(order), ['a-1', 'b-0', 'c-0'])
+
+    async def test_cancelled_job_settles_future(self):
+        self.scheduler = self._scheduler()
+
+        async def cancelled():
+            raise asyncio.CancelledError()
+
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(self.scheduler.submit('key', 'chat', cancelled), 1)
+
+        async def aborted():
+            raise Abort()
+
+        with self.assertRaises(Abort):
+            await asyncio.wait_for(self.scheduler.submit('key', 'chat', aborted), 1)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats['failed'], stats['in_flight']), (2, 0))
+
+    async def test_close_cancels_queued_requests(self):
+        self.scheduler = self._scheduler()
+        gate, running = await self._occupy()
+        queued = asyncio.ensure_future(self.scheduler.submit('key', 'chat', gate.wait))
+        await asyncio.sleep(0)
+        await self.scheduler.close()
+        with self.assertRaises(asyncio.CancelledError):
+            await queued
+        gate.set()
+        await running
+
+    async def test_queue_without_room_is_rejected(self):
+        self.scheduler = self._scheduler()
+        for options in ({'max_queue': 0}, {'max_queue_per_channel': 0}):
+            with self.assertRaises(ValueError):
+                LLMScheduler(**options)
+
+if __name__ == '__main__':
+    unittest.main()
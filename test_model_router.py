@@ -0,0 +1,96 @@
+import unittest
+
+from channel_profile import ChannelProfile, compile_word_matcher
+from model_router import ModelRouter, complexity_score, price_per_1k_tokens
+
+
+def make_channel(**assistant_settings):
+    assistant_settings.setdefault('model', 'gpt-4o')
+    assistant_settings.setdefault('max_tokens', 300)
+    settings = {'assistant_settings': assistant_settings}
+    return settings, ChannelProfile({'id': -100, 'owner_id': 1, 'settings': settings})
+
+
+class ComplexityScoreTest(unittest.TestCase):
+    """Локальная оценка сложности комментария"""
+
+    def test_simple_comments_score_low(self):
+        self.assertEqual(complexity_score('Спасибо!'), 0)
+        self.assertEqual(complexity_score('Отличный пост, спасибо большое за такой подробный разбор темы'), 1)
+        self.assertEqual(complexity_score('Когда эфир?'), 2)
+
+    def test_technical_questions_score_high(self):
+        # Длина, два вопроса, вопросительное слово и технические признаки
+        self.assertEqual(complexity_score('Почему запрос к /api/v2/ занимает 300 ms? Как это исправить?'), 5)
+        self.assertEqual(complexity_score('Где лежит config.yaml'), 2)
+
+    def test_topics_and_language(self):
+        topics = compile_word_matcher(['фотографию'])
+        self.assertEqual(complexity_score('Расскажите про фотографию'), 0)
+        self.assertEqual(complexity_score('Расскажите про фотографию', topics), 1)
+        # Текст не на русском и не на английском сразу набирает порог по умолчанию
+        self.assertEqual(complexity_score('Γεια σου, ωραία ανάρτηση για φωτογραφία'), 3)
+        self.assertEqual(complexity_score('Ein schöner Beitrag über Fotografie'), 0)
+
+
+class ModelRouterTest(unittest.TestCase):
+    """Включение по каналу, выбор уровня и max_tokens быстрого уровня"""
+
+    def route(self, router, comments, **assistant_settings):
+        settings, profile = make_channel(**assistant_settings)
+        return router.route(comments, settings, profile, profile.model, profile.max_tokens)
+
+    def test_disabled_unless_channel_opts_in(self):
+        router = ModelRouter()
+        self.assertIsNone(self.route(router, ['Спасибо!']))
+        decision = self.route(router, ['Спасибо!'], routing={'enabled': True})
+        self.assertEqual((decision.tier, decision.model), ('fast', 'gpt-4o-mini'))
+        # Включённая для всех маршрутизация выключается каналом
+        enabled = ModelRouter(enabled=True)
+        self.assertIsNotNone(self.route(enabled, ['Спасибо!']))
+        self.assertIsNone(self.route(enabled, ['Спасибо!'], routing={'enabled': False}))
+
+    def test_tier_follows_threshold(self):
+        router = ModelRouter(enabled=True, threshold=3)
+        question = 'Почему запрос к /api/v2/ занимает 300 ms? Как это исправить?'
+        decision = self.route(router, [question])
+        self.assertEqual((decision.tier, decision.model, decision.max_tokens, decision.score),
+                         ('full', 'gpt-4o', 300, 5))
+        self.assertEqual(self.route(router, ['Когда эфир?']).tier, 'fast')
+        # Пакет уходит полной модели, если сложен хотя бы один комментарий
+        self.assertEqual(self.route(router, ['Спасибо!', question]).tier, 'full')
+        # Порог и модель полного уровня переопределяются каналом
+        decision = self.route(router, ['Когда эфир?'], routing={'threshold': 2, 'full_model': 'gpt-4-turbo'})
+        self.assertEqual((decision.tier, decision.model), ('full', 'gpt-4-turbo'))
+
+    def test_force_tier(self):
+        router = ModelRouter(enabled=True)
+        self.assertEqual(self.route(router, ['Спасибо!'], routing={'force_tier': 'full'}).tier, 'full')
+        question = 'Почему запрос к /api/v2/ занимает 300 ms? Как это исправить?'
+        self.assertEqual(self.route(router, [question], routing={'force_tier': 'fast'}).tier, 'fast')
+
+    def test_fast_max_tokens_sized_to_comment(self):
+        router = ModelRouter(enabled=True, min_tokens=40)
+        # База 40, по 4 токена за слово и 40 за вопрос
+        self.assertEqual(self.route(router, ['Спасибо!']).max_tokens, 44)
+        self.assertEqual(self.route(router, ['Когда эфир?']).max_tokens, 88)
+        # В пакете - по самому длинному комментарию
+        self.assertEqual(self.route(router, ['Спасибо!', 'Когда эфир?']).max_tokens, 88)
+        # Не больше max_tokens канала
+        self.assertEqual(self.route(router, ['Когда эфир?'], max_tokens=60).max_tokens, 60)
+        self.assertEqual(self.route(router, []).max_tokens, 40)
+
+    def test_report_by_tier(self):
+        router = ModelRouter(enabled=True)
+        decision = self.route(router, ['Спасибо!'])
+        router.record(decision, 0.5, 1000)
+        router.record(decision, 1.5, None, error=True)
+        router.record(None, 9.0, 1000)
+        report = router.report()
+        self.assertEqual(report['fast'], {'requests': 2, 'errors': 1, 'avg_latency_s': 1.0, 'tokens': 1000,
+                                          'cost_usd': price_per_1k_tokens('gpt-4o-mini')})
+        self.assertEqual(report['full']['requests'], 0)
+        self.assertEqual(price_per_1k_tokens('gpt-4o-mini-2024-07-18'), 0.0004)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import asyncio
+import unittest
+
+from telegram.error import RetryAfter
+
+from outbound_dispatcher import OutboundDispatcher, Throttled, retry_after_seconds
+from streaming_reply import stream_reply
+
+PRIVATE_CHAT = 5
+GROUP_CHAT = -100
+DROP_IF_LIMITED = {'drop_if_limited': True}
+
+
+class OutboundDispatcherTest(unittest.IsolatedAsyncioTestCase):
+    """Полосы приоритета, повтор после RetryAfter и необязательные запросы drop_if_limited"""
+
+    async def asyncSetUp(self):
+        self.delivered = []
+
+    async def asyncTearDown(self):
+        await self.dispatcher.shutdown()
+
+    async def _start(self, **options):
+        self.dispatcher = OutboundDispatcher(**options)
+        await self.dispatcher.initialize()
+
+    def _send(self, chat_id, name, rate_limit_args=None, endpoint='sendMessage'):
+        async def callback():
+            self.delivered.append(name)
+            return name
+        return self.dispatcher.process_request(callback, (), {}, endpoint, {'chat_id': chat_id}, rate_limit_args)
+
+    def _callback(self, result):
+        async def callback():
+            return result
+        return callback
+
+    async def test_requests_without_chat_are_not_limited(self):
+        await self._start(global_rate=1)
+        results = await asyncio.gather(*(
+            self.dispatcher.process_request(self._callback(i), (), {}, 'getMe', {}, None) for i in range(5)
+        ))
+        self.assertEqual(results, list(range(5)))
+        self.assertEqual(self.dispatcher.stats['delivered'], 0)
+
+    async def test_interactive_lane_goes_first(self):
+        await self._start(global_rate=5, group_rate=6000, group_burst=10)
+        # Общее ведро исчерпано: дальше запросы ждут в полосах
+        await asyncio.gather(*(self._send(PRIVATE_CHAT + i, f'warmup-{i}') for i in range(5)))
+        bulk = asyncio.ensure_future(self._send(GROUP_CHAT, 'bulk'))
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(self._send(PRIVATE_CHAT, 'interactive'))
+        await asyncio.gather(bulk, interactive)
+        self.assertEqual(self.delivered[5:], ['interactive', 'bulk'])
+        self.assertEqual(self.dispatcher.queue_depth(), 0)
+
+    async def test_explicit_lane_overrides_chat_type(self):
+        await self._start(global_rate=5, group_rate=6000, group_burst=10)
+        await asyncio.gather(*(self._send(PRIVATE_CHAT + i, f'warmup-{i}') for i in range(5)))
+        private = asyncio.ensure_future(self._send(PRIVATE_CHAT, 'private', {'lane': 'bulk'}))
+        await asyncio.sleep(0)
+        group = asyncio.ensure_future(self._send(GROUP_CHAT, 'group', {'lane': 'interactive'}))
+        await asyncio.gather(private, group)
+        self.assertEqual(self.delivered[5:], ['group', 'private'])
+
+    async def test_retry_after_requeues_at_front(self):
+        # Один токен на чат раз в 0.1 с: пока первый запрос ждёт паузы, остальные стоят в очереди
+        await self._start(group_rate=600, group_burst=1)
+        failures = [RetryAfter(0)]
+
+        async def flaky():
+            if failures:
+                error = failures.pop()
+                # Пауза меньше интервала токенов: повтор ждёт следующий токен вместе с очередью
+                error.retry_after = 0.05
+                raise error
+            self.delivered.append('first')
+            return 'first'
+
+        first = asyncio.ensure_future(
+            self.dispatcher.process_request(flaky, (), {}, 'sendMessage', {'chat_id': GROUP_CHAT}, None))
+        await asyncio.sleep(0)
+        others = [asyncio.ensure_future(self._send(GROUP_CHAT, name)) for name in ('second', 'third')]
+        await asyncio.gather(first, *others)
+        # Повтор не теряет сообщение и не обгоняется следующими сообщениями чата
+        self.assertEqual(self.delivered, ['first', 'second', 'third'])
+        self.assertEqual(self.dispatcher.stats['retried'], 1)
+        self.assertEqual(self.dispatcher.stats['delivered'], 3)
+
+    async def test_drop_if_limited_raises_throttled(self):
+        await self._start(group_rate=20, group_burst=2)
+        await self._send(GROUP_CHAT, 'reply')
+        self.assertEqual(await self._send(GROUP_CHAT, 'edit-1', DROP_IF_LIMITED, 'editMessageText'), 'edit-1')
+        with self.assertRaises(Throttled) as caught:
+            await self._send(GROUP_CHAT, 'edit-2', DROP_IF_LIMITED, 'editMessageText')
+        # Токен чата появится через 3 с; Throttled - это RetryAfter с целым числом секунд
+        self.assertIsInstance(caught.exception, RetryAfter)
+        self.assertEqual(caught.exception.retry_after, 3)
+        self.assertEqual(retry_after_seconds(caught.exception), 3.0)
+        self.assertEqual(self.delivered, ['reply', 'edit-1'])
+        self.assertEqual(self.dispatcher.stats['throttled'], 1)
+        self.assertEqual(self.dispatcher.queue_depth(), 0)
+
+    async def test_drop_if_limited_yields_to_queued_messages(self):
+        await self._start(group_rate=600, group_burst=1)
+        await self._send(GROUP_CHAT, 'reply')
+        queued = asyncio.ensure_future(self._send(GROUP_CHAT, 'queued'))
+        await asyncio.sleep(0.15)
+        self.assertEqual(await queued, 'queued')
+        waiting = asyncio.ensure_future(self._send(GROUP_CHAT, 'waiting'))
+        await asyncio.sleep(0)
+        with self.assertRaises(Throttled):
+            await self._send(GROUP_CHAT, 'edit', DROP_IF_LIMITED, 'editMessageText')
+        await waiting
+        self.assertEqual(self.delivered, ['reply', 'queued', 'waiting'])
+
+    async def test_retry_after_on_optional_request_is_not_retried(self):
+        await self._start(group_rate=6000, group_burst=10)
+        calls = []
+
+        async def flood():
+            calls.append(1)
+            raise RetryAfter(30)
+
+        with self.assertRaises(RetryAfter):
+            await self.dispatcher.process_request(flood, (), {}, 'editMessageText', {'chat_id': GROUP_CHAT},
+                                                  DROP_IF_LIMITED)
+        self.assertEqual(len(calls), 1)
+        # Пауза чата действует и на следующие необязательные запросы
+        with self.assertRaises(Throttled) as caught:
+            await self._send(GROUP_CHAT, 'edit', DROP_IF_LIMITED, 'editMessageText')
+        self.assertGreaterEqual(caught.exception.retry_after, 29)
+
+
+class FakeReply:
+    def __init__(self, message_id, edit_error=None):
+        self.message_id = message_id
+        self.edit_error = edit_error
+        self.edits = []
+
+    async def edit_text(self, text, rate_limit_args=None):
+        if rate_limit_args is not None and self.edit_error is not None:
+            raise self.edit_error
+        self.edits.append((text, rate_limit_args))
+
+    async def delete(self):
+        pass
+
+
+class FakeMessage:
+    chat_id = GROUP_CHAT
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.sent = []
+
+    async def reply_text(self, text):
+        self.sent.append(text)
+        return self.reply
+
+
+class StreamingEditsTest(unittest.IsolatedAsyncioTestCase):
+    """Промежуточные правки потокового ответа пропускаются по Throttled, итоговая отправляется"""
+
+    async def _chunks(self, parts):
+        for part in parts:
+            yield part
+
+    async def test_throttled_intermediate_edit_is_skipped(self):
+        reply = FakeReply(42, edit_error=Throttled(0.01))
+        message = FakeMessage(reply)
+        parts = ['Первая часть ответа, ', 'вторая часть', ' и конец.']
+        text = await stream_reply(message, self._chunks(parts), edit_interval=0, first_chunk_chars=5,
+                                  edit_rate_limit_args=DROP_IF_LIMITED)
+        self.assertEqual(text, ''.join(parts))
+        self.assertEqual(len(message.sent), 1)
+        # Все промежуточные правки отброшены ограничителем, итоговая правка ушла без drop_if_limited
+        self.assertEqual(reply.edits, [(''.join(parts), None)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import post_index
+from post_index import LIVE_LOG_NAME, ChannelPostIndex, PostIndex
+
+POSTS = [
+    (1, 'Запуск нового курса по фотографии: съёмка портретов и пейзажей'),
+    (2, 'Отчёт о поездке в горы, много пейзажей и немного портретов'),
+    (3, 'Розыгрыш билетов на концерт среди подписчиков канала'),
+    (4, 'Фотография ночного города: выдержка, штатив и шумы'),
+    (5, 'Пейзажи, пейзажи, пейзажи - подборка лучших кадров'),
+]
+
+
+class ChannelPostIndexTest(unittest.TestCase):
+    """Ранжирование BM25, журнал сегмента в памяти, слияние сегментов и повторное открытие"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, '-100')
+        self.indexes = []
+
+    def tearDown(self):
+        for index in self.indexes:
+            index.close()
+        shutil.rmtree(self.directory)
+
+    def _open(self, **options):
+        index = ChannelPostIndex(self.path, **options)
+        self.indexes.append(index)
+        return index
+
+    def _crash(self, index):
+        """Остановка процесса без close: сегмент в памяти не записан, журнал просто закрыт"""
+        self.indexes.remove(index)
+        index._live_log.close()
+        for segment in index.segments:
+            segment.close()
+
+    def _fill(self, index, posts=POSTS):
+        for message_id, text in posts:
+            index.add(message_id, text)
+
+    def test_bm25_ranking(self):
+        index = self._open()
+        self._fill(index)
+        # Чаще встречающийся терм и более короткий пост - выше
+        self.assertEqual(index.search('пейзажи', k=3), [POSTS[4][1], POSTS[1][1], POSTS[0][1]])
+        # Редкий терм весит больше частого: пост с «концертом» обгоняет посты с «пейзажами»
+        self.assertEqual(index.search('пейзажи концерт', k=1), [POSTS[2][1]])
+        self.assertEqual(index.search('выдержка штатив', k=3), [POSTS[3][1]])
+        self.assertEqual(index.search('и на в'), [])
+        self.assertEqual(index.search('пейзажи', k=0), [])
+
+    def test_ranking_is_the_same_on_disk(self):
+        index = self._open()
+        self._fill(index)
+        in_memory = index.search('пейзажи фотография', k=5)
+        index.flush()
+        self.assertEqual(index.live.doc_count, 0)
+        self.assertEqual(index.search('пейзажи фотография', k=5), in_memory)
+        if post_index.numpy is not None:
+            post_index.numpy, numpy = None, post_index.numpy
+            try:
+                self.assertEqual(index.search('пейзажи фотография', k=5), in_memory)
+            finally:
+                post_index.numpy = numpy
+
+    def test_reopen_restores_segments_and_live_posts(self):
+        index = self._open(segment_size=3)
+        self._fill(index)
+        self.assertEqual((len(index.segments), index.live.doc_count), (1, 2))
+        self._crash(index)
+
+        reopened = self._open(segment_size=3)
+        self.assertEqual((len(reopened.segments), reopened.live.doc_count), (1, 2))
+        self.assertEqual(reopened.search('пейзажи', k=1), [POSTS[4][1]])
+        reopened.close()
+
+        # После close журнал пуст, все посты в сегментах
+        self.assertEqual(os.path.getsize(os.path.join(self.path, LIVE_LOG_NAME)), 0)
+        self.assertEqual(self._open(segment_size=3).doc_count, len(POSTS))
+
+    def test_torn_log_tail_is_dropped(self):
+        index = self._open()
+        self._fill(index, POSTS[:2])
+        self._crash(index)
+        with open(os.path.join(self.path, LIVE_LOG_NAME), 'ab') as f:
+            f.write(b'[3, "\xd0\xa0\xd0\xbe\xd0\xb7')
+
+        reopened = self._open()
+        self.assertEqual(list(reopened.live.message_ids), [1, 2])
+        # Обрезанный хвост не мешает дописывать журнал дальше
+        reopened.add(3, POSTS[2][1])
+        self._crash(reopened)
+        self.assertEqual(list(self._open().live.message_ids), [1, 2, 3])
+
+    def test_log_posts_already_in_segment_are_skipped(self):
+        index = self._open()
+        self._fill(index, POSTS[:3])
+        log_path = os.path.join(self.path, LIVE_LOG_NAME)
+        with open(log_path, 'rb') as f:
+            log = f.read()
+        index.flush()
+        self._crash(index)
+        # Процесс остановился после записи сегмента, но до очистки журнала
+        with open(log_path, 'wb') as f:
+            f.write(log)
+
+        reopened = self._open()
+        self.assertEqual((reopened.doc_count, reopened.live.doc_count), (3, 0))
+
+    def test_compaction_waits_for_dead_posts(self):
+        index = self._open(segment_size=2, max_segments=10, max_posts=8)
+        posts = [(message_id, f'пост номер {message_id} про пейзажи') for message_id in range(1, 11)]
+        self._fill(index, posts)
+        # Индекс заполнен, но два устаревших поста - меньше четверти max_posts: слияния ещё не было
+        self.assertEqual((len(index.segments), index.dead_count), (5, 2))
+        found = index.search('пейзажи', k=10)
+        self.assertEqual(len(found), 8)
+        self.assertNotIn(posts[0][1], found)
+        self.assertNotIn(posts[1][1], found)
+
+        self._fill(index, [(11, 'пост номер 11 про пейзажи'), (12, 'пост номер 12 про пейзажи')])
+        self.assertEqual((len(index.segments), index.doc_count, index.dead_count), (1, 8, 0))
+        self.assertEqual(list(index.segments[0].message_ids), list(range(5, 13)))
+        self.assertEqual(sorted(name for name in os.listdir(self.path) if name.endswith('.seg')),
+                         [os.path.basename(index.segments[0].path)])
+
+    def test_too_many_segments_are_merged(self):
+        index = self._open(segment_size=1, max_segments=3)
+        self._fill(index)
+        self.assertEqual(len(index.segments), 2)
+        self.assertEqual(index.doc_count, len(POSTS))
+        self.assertEqual(index.search('пейзажи', k=1), [POSTS[4][1]])
+
+
+class PostIndexTest(unittest.TestCase):
+    """Индексы каналов с вытеснением: вытесненный канал записывается на диск и открывается снова"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_evicted_channel_is_reopened(self):
+        index = PostIndex(self.directory, max_channels=1, max_post_chars=20)
+        index.add(-100, 1, 'Пейзажи гор и озёр на рассвете')
+        index.add(-200, 1, 'Розыгрыш билетов')
+        self.assertEqual(list(index._channels), ['-200'])
+        self.assertEqual(index.search(-100, 'пейзажи'), ['Пейзажи гор и озёр н'])
+        self.assertEqual(index.search(-200, 'пейзажи'), [])
+        self.assertEqual(index.stats, {'posts': 2, 'searches': 2, 'hits': 1})
+        # Поиск по каналу без постов не создаёт каталог
+        self.assertEqual(index.search(-300, 'пейзажи'), [])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, '-300')))
+        index.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from response_cache import ResponseCache, normalize_message, settings_fingerprint
+
+SETTINGS = {
+    'assistant_settings': {
+        'model': 'gpt-4o',
+        'temperature': 0.7,
+        'system_prompt': 'Ты - ассистент канала',
+        'forbidden_words': ['реклама'],
+    }
+}
+
+
+def with_assistant(**changes):
+    return {'assistant_settings': {**SETTINGS['assistant_settings'], **changes}}
+
+
+class CacheKeyTest(unittest.TestCase):
+    """Нормализация комментария и отпечаток настроек, от которых зависит ответ"""
+
+    def test_normalization(self):
+        self.assertEqual(normalize_message('  Ёлки,   ПАЛКИ!!! '), 'елки палки')
+        # Вопросительный знак меняет смысл и сохраняется
+        self.assertNotEqual(normalize_message('Когда эфир?'), normalize_message('Когда эфир'))
+        # Комментарии только из знаков различаются по исходному тексту
+        self.assertEqual(normalize_message(' +++ '), '+++')
+        self.assertNotEqual(normalize_message('+'), normalize_message('!'))
+
+    def test_equivalent_comments_share_key(self):
+        cache = ResponseCache()
+        self.assertEqual(cache.make_key(-100, 'Спасибо!', SETTINGS), cache.make_key('-100', 'спасибо', SETTINGS))
+        self.assertNotEqual(cache.make_key(-100, 'спасибо', SETTINGS), cache.make_key(-200, 'спасибо', SETTINGS))
+
+    def test_fingerprint_tracks_response_settings(self):
+        base = settings_fingerprint(SETTINGS['assistant_settings'])
+        for change in ({'model': 'gpt-4o-mini'}, {'temperature': 0.2}, {'system_prompt': 'Отвечай кратко'},
+                       {'forbidden_words': ['реклама', 'спам']}):
+            with self.subTest(change=change):
+                self.assertNotEqual(settings_fingerprint(with_assistant(**change)['assistant_settings']), base)
+        # Настройки, не влияющие на текст ответа, кэш не сбрасывают
+        self.assertEqual(settings_fingerprint(with_assistant(cache_ttl_seconds=10)['assistant_settings']), base)
+
+    def test_context_in_key_only_when_enabled(self):
+        context = [{'role': 'user', 'content': 'новый пост'}]
+        plain = ResponseCache()
+        self.assertEqual(plain.make_key(-100, 'да', SETTINGS, context), plain.make_key(-100, 'да', SETTINGS))
+        with_context = ResponseCache(include_context=True)
+        self.assertNotEqual(with_context.make_key(-100, 'да', SETTINGS, context),
+                            with_context.make_key(-100, 'да', SETTINGS))
+
+
+class ResponseCacheTest(unittest.TestCase):
+    """Поиск, срок жизни, сброс канала, ограничение памяти и дисковый уровень"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.now = 1_700_000_000.0
+        patcher = mock.patch('response_cache.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_changed_settings_miss(self):
+        cache = ResponseCache()
+        cache.put(-100, 'Привет', SETTINGS, 'Здравствуйте!')
+        self.assertEqual(cache.get(-100, 'привет!', SETTINGS), 'Здравствуйте!')
+        self.assertIsNone(cache.get(-100, 'привет', with_assistant(model='gpt-4o-mini')))
+        self.assertEqual((cache.stats['hits'], cache.stats['misses']), (1, 1))
+
+    def test_per_channel_ttl(self):
+        cache = ResponseCache(ttl_seconds=3600)
+        short = with_assistant(cache_ttl_seconds=60)
+        disabled = with_assistant(cache_ttl_seconds=0)
+        cache.put(-100, 'привет', SETTINGS, 'долгий')
+        cache.put(-200, 'привет', short, 'короткий')
+        cache.put(-300, 'привет', disabled, 'без кэша')
+        self.assertEqual(len(cache), 2)
+        self.now += 120
+        self.assertEqual(cache.get(-100, 'привет', SETTINGS), 'долгий')
+        self.assertIsNone(cache.get(-200, 'привет', short))
+        self.assertIsNone(cache.get(-300, 'привет', disabled))
+        # Просроченная запись удалена при чтении
+        self.assertEqual(len(cache), 1)
+
+    def test_invalidate_channel(self):
+        cache = ResponseCache(disk_path=os.path.join(self.directory, 'cache.sqlite3'))
+        cache.put(-100, 'привет', SETTINGS, 'a')
+        cache.put(-100, 'пока', SETTINGS, 'b')
+        cache.put(-200, 'привет', SETTINGS, 'c')
+        cache.invalidate_channel(-100)
+        self.assertIsNone(cache.get(-100, 'привет', SETTINGS))
+        self.assertIsNone(cache.get(-100, 'пока', SETTINGS))
+        self.assertEqual(cache.get(-200, 'привет', SETTINGS), 'c')
+        self.assertEqual(cache.stats['disk_hits'], 0)
+        cache.close()
+
+    def test_memory_limit_evicts_least_recently_used(self):
+        # Запись - ключ (40 байт) и ответ (10 байт): в лимит помещаются две
+        cache = ResponseCache(max_bytes=120)
+        cache.put(-100, 'раз', SETTINGS, 'ответ')
+        cache.put(-100, 'два', SETTINGS, 'ответ')
+        self.assertEqual(cache.get(-100, 'раз', SETTINGS), 'ответ')
+        cache.put(-100, 'три', SETTINGS, 'ответ')
+        self.assertEqual(cache.memory_bytes(), 100)
+        self.assertIsNone(cache.get(-100, 'два', SETTINGS))
+        self.assertEqual(cache.get(-100, 'раз', SETTINGS), 'ответ')
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_disk_tier_survives_reopen(self):
+        path = os.path.join(self.directory, 'cache.sqlite3')
+        cache = ResponseCache(disk_path=path)
+        cache.put(-100, 'привет', SETTINGS, 'Здравствуйте!')
+        cache.put(-100, 'пока', with_assistant(cache_ttl_seconds=60), 'До встречи!')
+        cache.close()
+
+        self.now += 120
+        reopened = ResponseCache(disk_path=path)
+        self.assertEqual(len(reopened), 0)
+        self.assertEqual(reopened.get(-100, 'Привет!', SETTINGS), 'Здравствуйте!')
+        self.assertEqual(reopened.stats['disk_hits'], 1)
+        # Запись поднята в память, повторное чтение - без диска
+        self.assertEqual(reopened.get(-100, 'привет', SETTINGS), 'Здравствуйте!')
+        self.assertEqual(reopened.stats['hits'], 1)
+        # Просроченные записи удаляются с диска при открытии
+        self.assertIsNone(reopened.get(-100, 'пока', with_assistant(cache_ttl_seconds=60)))
+        reopened.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from database import JournaledUserDatabase
+from sqlite_database import SQLiteUserDatabase
+from stats_aggregator import StatsAggregator, merge_windows, window_totals
+
+# Полдень фиксированного дня: все интервалы окон считаются от него
+NOW = 1_700_006_400.0
+
+
+class WindowBucketsTest(unittest.TestCase):
+    """Бакеты окон: сложение приращений, ограничение размера и суммы на момент чтения"""
+
+    def test_merge_adds_buckets_and_keeps_only_window(self):
+        stored = {'hour': {'100': [1, 0, 0, 0, 0, 0], '30': [5, 0, 0, 0, 0, 0]}}
+        merged = merge_windows(stored, {'hour': {'100': [2, 1, 0, 0, 0, 0], '101': [1, 0, 0, 0, 0, 0]}})
+        # Минута 30 старше часа от самой свежей минуты 101
+        self.assertEqual(merged['hour'], {'100': [3, 1, 0, 0, 0, 0], '101': [1, 0, 0, 0, 0, 0]})
+        self.assertEqual(stored['hour']['100'], [1, 0, 0, 0, 0, 0])
+
+    def test_totals_skip_expired_buckets(self):
+        minute = int(NOW // 60)
+        windows = {'hour': {str(minute): [1, 1, 0, 0, 0, 0], str(minute - 60): [7, 0, 0, 0, 0, 0]},
+                   'day': {str(int(NOW // 3600)): [8, 1, 0, 0, 0, 0]}}
+        totals = window_totals([windows, windows], NOW)
+        self.assertEqual(totals['hour']['messages'], 2)
+        self.assertEqual(totals['day']['messages'], 16)
+        self.assertEqual(totals['month']['messages'], 0)
+
+
+class PersistedWindowsTest(unittest.TestCase):
+    """Окна статистики записываются в хранилище и читаются из него после перезапуска"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _check_backend(self, open_db):
+        db = open_db()
+        db.add_user(1, 'owner')
+        db.add_channel(-100, 'Канал', 1)
+        db.add_channel(-200, 'Второй', 1)
+        stats = StatsAggregator(db, flush_interval_s=0)
+        stats.record(-100, now=NOW, messages=1, replies=1, tokens=30)
+        stats.record(-200, now=NOW - 7200, messages=1)
+        stats.record(-200, now=NOW, llm_calls=1, latency_ms=1500)
+        # Ещё не записанные приращения уже видны на экране владельца
+        windows = stats.windows_for(db.get_user_channels(1), now=NOW)
+        self.assertEqual(windows['hour']['messages'], 1)
+        self.assertEqual(windows['day']['messages'], 2)
+        stats.close()
+        db.close()
+
+        # Новый процесс (перезапуск или другой воркер) читает те же окна из хранилища
+        db = open_db()
+        stats = StatsAggregator(db, flush_interval_s=0)
+        windows = stats.windows_for(db.get_user_channels(1), now=NOW)
+        self.assertEqual(windows['hour'], {'messages': 1, 'replies': 1, 'skips': 0, 'tokens': 30,
+                                           'llm_calls': 1, 'latency_ms': 1500})
+        self.assertEqual(windows['day']['messages'], 2)
+        self.assertEqual(db.get_channel(-100)['stats']['total_messages'], 1)
+        self.assertEqual(stats.pending_for(-100), {})
+        stats.close()
+        db.close()
+
+    def test_journal_backend(self):
+        path = os.path.join(self.directory, 'database.json')
+        self._check_backend(lambda: JournaledUserDatabase(path))
+
+    def test_sqlite_backend(self):
+        path = os.path.join(self.directory, 'database.sqlite3')
+        self._check_backend(lambda: SQLiteUserDatabase(path))
+
+    def test_failed_flush_keeps_windows(self):
+        db = JournaledUserDatabase(os.path.join(self.directory, 'database.json'))
+        db.add_user(1, 'owner')
+        db.add_channel(-100, 'Канал', 1)
+        stats = StatsAggregator(db, flush_interval_s=0)
+        stats.record(-100, now=NOW, messages=1)
+        add_channel_stats = db.add_channel_stats
+
+        def fail(deltas):
+            raise OSError('диск заполнен')
+
+        db.add_channel_stats = fail
+        with self.assertRaises(OSError):
+            stats.flush()
+        stats.record(-100, now=NOW, messages=1)
+        db.add_channel_stats = add_channel_stats
+        stats.flush()
+        windows = stats.windows_for(db.get_user_channels(1), now=NOW)
+        self.assertEqual(windows['hour']['messages'], 2)
+        self.assertEqual(db.get_channel(-100)['stats']['total_messages'], 2)
+        stats.close()
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
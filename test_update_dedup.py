@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from update_dedup import UpdateDeduplicator
+
+
+class UpdateDeduplicatorTest(unittest.TestCase):
+    """Отметки обработки комментариев: занятие, завершение, снятие и восстановление после перезапуска"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'dedup.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _open(self):
+        return UpdateDeduplicator(window_size=100, filter_capacity=1000, snapshot_path=self.path)
+
+    def test_failed_attempt_is_answered_on_redelivery(self):
+        dedup = self._open()
+        self.assertTrue(dedup.claim(-100, 7))
+        # Повтор, пришедший во время обработки, не обрабатывается параллельно
+        self.assertFalse(dedup.claim(-100, 7))
+        # Ошибка OpenAI или Telegram: ответа нет
+        dedup.release(-100, 7)
+        self.assertTrue(dedup.claim(-100, 7))
+        dedup.set_reply(-100, 7, 501)
+        dedup.complete(-100, 7)
+        self.assertFalse(dedup.claim(-100, 7))
+        self.assertEqual(dedup.reply_for(-100, 7), 501)
+        dedup.close()
+
+    def test_unfinished_claim_is_lost_with_process(self):
+        dedup = self._open()
+        self.assertTrue(dedup.claim(-100, 1))
+        dedup.complete(-100, 1)
+        self.assertTrue(dedup.claim(-100, 2))
+        # Процесс упал до отправки ответа: журнал читается без итогового снимка
+        restarted = self._open()
+        self.assertFalse(restarted.claim(-100, 1))
+        self.assertTrue(restarted.claim(-100, 2))
+        restarted.close()
+        dedup.close()
+
+    def test_completed_marks_survive_reopen(self):
+        dedup = self._open()
+        for message_id in range(10):
+            dedup.claim(-100, message_id)
+            dedup.set_reply(-100, message_id, 1000 + message_id)
+            dedup.complete(-100, message_id)
+        dedup.close()
+        dedup = self._open()
+        self.assertEqual(len(dedup), 10)
+        self.assertEqual(dedup.reply_for(-100, 3), 1003)
+        self.assertFalse(dedup.claim(-100, 9))
+        self.assertEqual(dedup.stats['duplicates'], 1)
+        dedup.close()
+
+    def test_complete_after_release_is_ignored(self):
+        dedup = self._open()
+        dedup.claim(-100, 5)
+        dedup.release(-100, 5)
+        dedup.complete(-100, 5)
+        self.assertEqual(len(dedup), 0)
+        self.assertTrue(dedup.claim(-100, 5))
+        dedup.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,241 @@
+import hashlib
+import logging
+import math
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from fileutils import write_atomic
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b'UDDP'
+SNAPSHOT_VERSION = 1
+# magic, версия, число хэшей, размер фильтра в битах, заполнение текущего и предыдущего фильтра, записей окна
+_HEADER = struct.Struct('<4sHHIIII')
+# chat_id, message_id, время обработки, id ответа бота (0 - ответа нет)
+_RECORD = struct.Struct('<qqdq')
+_KEY = struct.Struct('<qq')
+
+
+class BloomFilter:
+    """Фильтр Блума по ключам (chat_id, message_id): k позиций из одного blake2b двойным хэшированием"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.num_bits = max(64, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: Tuple[int, int]):
+        digest = hashlib.blake2b(_KEY.pack(*key), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (first + i * second) % self.num_bits
+
+    def add(self, key: Tuple[int, int]):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: Tuple[int, int]) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class UpdateDeduplicator:
+    """
+    Идемпотентность обработки комментариев: каждое сообщение (chat_id, message_id) обрабатывается один раз,
+    даже если Telegram доставил его повторно (перезапуск, повтор polling). Окно и фильтр - в памяти
+    процесса: при шардировании у каждого воркера свои (и свой snapshot_path), а повторы одного чата
+    доходят до того же воркера благодаря маршрутизации ingress по chat_id.
+
+    Недавние сообщения лежат в точном окне (не больше window_size записей не старше window_ttl_s секунд)
+    вместе с id ответа бота - по нему правка комментария может отредактировать ответ. Все обработанные
+    сообщения попадают ещё и в фильтр Блума: два поколения по filter_capacity ключей, при заполнении
+    текущего старое поколение отбрасывается. Ложное срабатывание фильтра (error_rate) означает
+    пропущенный комментарий, а не повторный ответ.
+
+    claim только занимает сообщение на время обработки (повтор, пришедший в это время, пропускается);
+    обработанным оно становится после complete. Если обработка не удалась, release снимает отметку,
+    и повторная доставка обрабатывается заново; после падения процесса незавершённые отметки теряются
+    вместе с ним
+
+    На диске - снимок (фильтры и окно) и журнал, куда каждая отметка дописывается одной записью
+    фиксированного размера; когда в журнале набирается window_size записей, пишется новый снимок,
+    а журнал обнуляется
+    """
+
+    def __init__(self, window_size: int = 100000, window_ttl_s: float = 172800,
+                 filter_capacity: int = 500000, error_rate: float = 0.0001,
+                 snapshot_path: str = None):
+        self.window_size = window_size
+        self.window_ttl_s = window_ttl_s
+        self.filter_capacity = filter_capacity
+        self.error_rate = error_rate
+        self.snapshot_path = snapshot_path
+        # (chat_id, message_id) -> [время обработки, id ответа бота]; порядок - по времени обработки
+        self._window: 'OrderedDict[Tuple[int, int], List]' = OrderedDict()
+        # Сообщения в обработке: (chat_id, message_id) -> id ответа бота, если он уже отправлен
+        self._in_flight: Dict[Tuple[int, int], Optional[int]] = {}
+        self._current = BloomFilter(filter_capacity, error_rate)
+        self._previous = BloomFilter(filter_capacity, error_rate)
+        self._journal_fd = None
+        self._journal_records = 0
+        self.stats: Dict[str, int] = {'claimed': 0, 'duplicates': 0, 'approximate_duplicates': 0}
+        if self.snapshot_path:
+            self._load()
+            self._journal_fd = os.open(self._journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    @property
+    def _journal_path(self) -> str:
+        return self.snapshot_path + '.log'
+
+    def claim(self, chat_id: int, message_id: int) -> bool:
+        """
+        Отметка сообщения как обрабатываемого. True - сообщение новое и его нужно обработать
+        (затем complete или release), False - оно уже обработано или обрабатывается (повторная доставка)
+        """
+        key = (int(chat_id), int(message_id))
+        if key in self._window or key in self._in_flight:
+            self.stats['duplicates'] += 1
+            return False
+        if key in self._current or key in self._previous:
+            self.stats['duplicates'] += 1
+            self.stats['approximate_duplicates'] += 1
+            return False
+        self._in_flight[key] = None
+        self.stats['claimed'] += 1
+        return True
+
+    def complete(self, chat_id: int, message_id: int):
+        """Сообщение обработано: отметка попадает в окно, фильтр и журнал"""
+        key = (int(chat_id), int(message_id))
+        if key not in self._in_flight:
+            return
+        reply_id = self._in_flight.pop(key)
+        now = time.time()
+        self._remember(key, now, reply_id)
+        self._append(key, now, reply_id)
+
+    def release(self, chat_id: int, message_id: int):
+        """Обработка не удалась: отметка снимается, повторная доставка будет обработана"""
+        self._in_flight.pop((int(chat_id), int(message_id)), None)
+
+    def reply_for(self, chat_id: int, message_id: int) -> Optional[int]:
+        """id ответа бота на сообщение, если оно ещё в точном окне"""
+        entry = self._window.get((int(chat_id), int(message_id)))
+        return entry[1] if entry is not None else None
+
+    def set_reply(self, chat_id: int, message_id: int, reply_id: int):
+        """Запоминание id ответа бота - чтобы при правке комментария редактировать ответ, а не слать новый"""
+        key = (int(chat_id), int(message_id))
+        if key in self._in_flight:
+            # Сохранится вместе с отметкой в complete
+            self._in_flight[key] = reply_id
+            return
+        entry = self._window.get(key)
+        if entry is None:
+            return
+        entry[1] = reply_id
+        self._append(key, entry[0], reply_id)
+
+    def __len__(self):
+        return len(self._window)
+
+    def _remember(self, key: Tuple[int, int], seen_at: float, reply_id: Optional[int]):
+        if key not in self._window:
+            if self._current.count >= self.filter_capacity:
+                self._previous = self._current
+                self._current = BloomFilter(self.filter_capacity, self.error_rate)
+            self._current.add(key)
+        self._window[key] = [seen_at, reply_id]
+        # Окно ограничено и по числу записей, и по возрасту; старые ключи остаются только в фильтре
+        expire_before = time.time() - self.window_ttl_s
+        while self._window and (len(self._window) > self.window_size
+                                or next(iter(self._window.values()))[0] < expire_before):
+            self._window.popitem(last=False)
+
+    def _append(self, key: Tuple[int, int], seen_at: float, reply_id: Optional[int]):
+        """Дописывание отметки в журнал одним write; при переполнении журнала - новый снимок"""
+        if self._journal_fd is None:
+            return
+        try:
+            os.write(self._journal_fd, _RECORD.pack(key[0], key[1], seen_at, reply_id or 0))
+        except OSError as e:
+            logger.error(f"Не удалось записать журнал обработанных сообщений {self._journal_path}: {e}")
+            return
+        self._journal_records += 1
+        if self._journal_records >= self.window_size:
+            self.save_snapshot()
+
+    def _load(self):
+        """Снимок, затем журнал поверх него (повтор записей из журнала безопасен)"""
+        if os.path.exists(self.snapshot_path):
+            try:
+                self._load_snapshot()
+            except (OSError, ValueError, struct.error) as e:
+                logger.error(f"Не удалось прочитать снимок обработанных сообщений {self.snapshot_path}: {e}")
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path, 'rb') as f:
+                data = f.read()
+            # Обрезанная последняя запись (падение посреди write) отбрасывается, чтобы не сбить следующие
+            usable = len(data) - len(data) % _RECORD.size
+            if usable != len(data):
+                os.truncate(self._journal_path, usable)
+            for chat_id, message_id, seen_at, reply_id in _RECORD.iter_unpack(data[:usable]):
+                self._remember((chat_id, message_id), seen_at, reply_id or None)
+            self._journal_records = usable // _RECORD.size
+
+    def _load_snapshot(self):
+        with open(self.snapshot_path, 'rb') as f:
+            data = f.read()
+        magic, version, num_hashes, num_bits, current_count, previous_count, window_len = \
+            _HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("неизвестный формат снимка")
+        offset = _HEADER.size
+        filter_bytes = (num_bits + 7) // 8
+        # Фильтры с другими параметрами не подходят - восстанавливаем только окно
+        same_filters = num_bits == self._current.num_bits and num_hashes == self._current.num_hashes
+        if same_filters:
+            self._current.bits[:] = data[offset:offset + filter_bytes]
+            self._current.count = current_count
+            self._previous.bits[:] = data[offset + filter_bytes:offset + 2 * filter_bytes]
+            self._previous.count = previous_count
+        offset += 2 * filter_bytes
+        for chat_id, message_id, seen_at, reply_id in _RECORD.iter_unpack(
+                data[offset:offset + window_len * _RECORD.size]):
+            key = (chat_id, message_id)
+            if same_filters:
+                self._window[key] = [seen_at, reply_id or None]
+            else:
+                self._remember(key, seen_at, reply_id or None)
+
+    def save_snapshot(self):
+        """Запись снимка и обнуление журнала"""
+        if not self.snapshot_path:
+            return
+        payload = b''.join([
+            _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self._current.num_hashes, self._current.num_bits,
+                         self._current.count, self._previous.count, len(self._window)),
+            bytes(self._current.bits),
+            bytes(self._previous.bits),
+            b''.join(_RECORD.pack(key[0], key[1], seen_at, reply_id or 0)
+                     for key, (seen_at, reply_id) in self._window.items())
+        ])
+        write_atomic(self.snapshot_path, payload)
+        # Падение между снимком и обнулением не страшно: журнал повторяет уже сохранённые отметки
+        if self._journal_fd is not None:
+            os.ftruncate(self._journal_fd, 0)
+        self._journal_records = 0
+
+    def close(self):
+        """Снимок при остановке и закрытие журнала"""
+        if self._journal_fd is None:
+            return
+        self.save_snapshot()
+        os.close(self._journal_fd)
+        self._journal_fd = None
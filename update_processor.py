@@ -0,0 +1,61 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict, List
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Параллельная обработка обновлений (не больше max_concurrent_updates одновременно)
+    с сохранением порядка внутри пользователя и чата: обновления с общим пользователем
+    или чатом выполняются строго в порядке поступления, поэтому шаги мастера настройки
+    в button_handler не обгоняют друг друга. Обновления разных пользователей идут параллельно.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # ключ -> future завершения последнего обновления с этим ключом
+        self._tails: Dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def _ordering_keys(update: object) -> List[str]:
+        """Ключи упорядочивания обновления: пользователь и чат"""
+        keys = []
+        if isinstance(update, Update):
+            if update.effective_user is not None:
+                keys.append(f"user:{update.effective_user.id}")
+            if update.effective_chat is not None:
+                keys.append(f"chat:{update.effective_chat.id}")
+        return keys
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        keys = self._ordering_keys(update)
+        # Встаём в очередь по всем ключам сразу, до первого await, - так порядок поступления сохраняется
+        done = asyncio.get_running_loop().create_future()
+        previous = [self._tails[key] for key in keys if key in self._tails]
+        for key in keys:
+            self._tails[key] = done
+        started = False
+        try:
+            for future in previous:
+                await asyncio.shield(future)
+            started = True
+            await coroutine
+        finally:
+            if not started and asyncio.iscoroutine(coroutine):
+                coroutine.close()
+            done.set_result(None)
+            for key in keys:
+                # Очереди простаивающих ключей не храним
+                if self._tails.get(key) is done:
+                    del self._tails[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass